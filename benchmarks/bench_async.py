@@ -0,0 +1,129 @@
+"""
+Benchmark comparing the polling loop of :class:`irclib.session.Session`
+with :class:`irclib.aio.AsyncSession`, with many connections to a local
+fake server.
+
+The server sends every connection the same amount of PRIVMSG lines that
+carry the time they were sent at; the benchmark reports how many lines
+per second were turned into high level events and how long that took
+per line.
+
+Run it from the repository root:
+
+    python benchmarks/bench_async.py [connections] [lines per connection]
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import session, aio
+
+
+class FakeServer(threading.Thread):
+    """Accepts `connections` clients and sends each `lines` messages once
+    :attr:`start_sending` is set."""
+
+    def __init__(self, connections, lines):
+        super(FakeServer, self).__init__()
+        self.daemon = True
+        self.connections = connections
+        self.lines = lines
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(connections)
+        self.port = self.listener.getsockname()[1]
+        self.start_sending = threading.Event()
+
+    def run(self):
+        clients = [self.listener.accept()[0] for _ in range(self.connections)]
+        for client in clients:
+            client.sendall(b":fake.server 001 bench :Welcome\r\n")
+        self.start_sending.wait()
+        for _ in range(self.lines):
+            for client in clients:
+                client.sendall(":nick!user@host PRIVMSG #bench :{!r}\r\n"
+                               .format(time.time()).encode('ascii'))
+        self.start_sending.clear()
+        # Keep the connections open until the benchmark is done
+        self.start_sending.wait()
+        for client in clients:
+            client.close()
+
+
+class Collector(object):
+    """Records the latency of every text event."""
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []
+        self.on_done = None
+
+    def __call__(self, event):
+        if event.command != 'text':
+            return
+        self.latencies.append(time.time() - float(event.message))
+        if len(self.latencies) == self.expected and self.on_done:
+            self.on_done()
+
+
+def report(name, collector, elapsed):
+    latencies = sorted(collector.latencies)
+    total = len(latencies)
+    print("{:<8} {:>9.0f} lines/sec  latency median {:.1f}ms p99 {:.1f}ms"
+          .format(name, total / elapsed,
+                  latencies[total // 2] * 1000,
+                  latencies[int(total * 0.99)] * 1000))
+
+
+def run(name, irc, connections, lines):
+    server = FakeServer(connections, lines)
+    server.start()
+    collector = Collector(connections * lines)
+    collector.__name__ = str("collector")
+    session.register(collector)
+    try:
+        if isinstance(irc, aio.AsyncSession):
+            loop = irc.loop
+            done = aio.asyncio.Future(loop=loop)
+            collector.on_done = lambda: done.set_result(None)
+            for _ in range(connections):
+                loop.run_until_complete(
+                    irc.server().connect('127.0.0.1', server.port, 'bench'))
+            irc.process_once(0.1)
+            start = time.time()
+            server.start_sending.set()
+            loop.run_until_complete(done)
+        else:
+            finished = []
+            collector.on_done = lambda: finished.append(True)
+            for _ in range(connections):
+                irc.server().connect('127.0.0.1', server.port, 'bench')
+            irc.process_once(0.1)
+            start = time.time()
+            server.start_sending.set()
+            while not finished:
+                irc.process_once(0.01)
+        elapsed = time.time() - start
+    finally:
+        session.unregister(collector)
+    server.start_sending.set()
+    irc.disconnect_all()
+    report(name, collector, elapsed)
+
+
+def main(connections=200, lines=200):
+    print("{} connections, {} lines each".format(connections, lines))
+    run("Session", session.Session(), connections, lines)
+    run("asyncio", aio.AsyncSession(loop=aio.asyncio.new_event_loop()),
+        connections, lines)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,93 @@
+"""
+Benchmark comparing :class:`irclib.commands.CommandRouter` with a
+:meth:`irclib.session.Filters.match` handler per command.
+
+Registers a number of ``!command`` triggers both ways and routes channel
+messages, some of which are commands, through
+:meth:`irclib.session.Session._handle_event`. The handlers are also run
+without the handler index, the way every handler was called before, on a
+tenth of the messages. The time it takes to register the handlers and to
+build the index on the first message is reported as well.
+
+Run it from the repository root:
+
+    python benchmarks/bench_commands.py [commands] [messages]
+
+The defaults are 1000 commands and 20000 messages, which take a few
+seconds.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import connection
+from irclib import session
+from irclib.commands import CommandRouter
+from irclib.session import filters, register, unregister
+
+
+def noop(high_event, *args):
+    pass
+
+
+def make_events(commands, count):
+    words = ['hello', 'there', 'what', 'is', 'going', 'on', 'today', 'lol']
+    events = []
+    for i in range(count):
+        text = ' '.join(random.choice(words) for _ in range(8))
+        if i % 5 == 0:
+            text = '!{} {}'.format(random.choice(commands), text)
+        events.append(connection.Event('pubmsg', 'nick!user@host',
+                                       '#radio', [text]))
+    return events
+
+
+def bench(name, irc, server, events):
+    start = time.time()
+    for event in events:
+        irc._handle_event(server, event)
+    elapsed = time.time() - start
+    print("{:<16} {:.3f}s  {:.1f}us per message"
+          .format(name, elapsed, elapsed / len(events) * 1e6))
+
+
+def main(count=1000, messages=20000):
+    commands = ['command{}'.format(i) for i in range(count)]
+    irc = session.Session()
+    server = irc.server()
+    server.real_nickname = 'Hanyuu'
+    events = make_events(commands, messages)
+    print("{} commands, {} messages".format(count, messages))
+
+    router = CommandRouter()
+    for name in commands:
+        router.add(name, noop)
+    handler = router.register()
+    bench("router", irc, server, events)
+    unregister(handler)
+
+    start = time.time()
+    for name in commands:
+        wrapped = filters.match('^!{}\\b'.format(name))(noop)
+        wrapped.__name__ = str(name)
+        register(wrapped)
+    registered = time.time()
+    irc._handle_event(server, events[0])
+    print("{:<16} {:.3f}s  first message {:.3f}s"
+          .format("match register", registered - start,
+                  time.time() - registered))
+    bench("match indexed", irc, server, events)
+
+    everything = list(session.Session.handlers.values())
+    session.Session.handler_index.lookup = lambda high_event: everything
+    bench("match all", irc, server, events[:messages // 10])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,129 @@
+"""
+Benchmark of building high level events: how many
+:meth:`irclib.session.HighEvent.from_low_event` calls go through per
+second, and how many bytes the events that handlers keep around take.
+
+The low level events come from a pool of users, since the same few
+thousand users send most of the lines on a network. Each event has its
+nickname, channel and message read, like most handlers do. The size of
+an event counts the objects that only exist because of it: the event
+itself, its nicknames and the strings split from the hostmask; the low
+level event and the strings it already had are not counted. Objects are
+followed with :func:`gc.get_referents`, so the `__dict__` of a slotted
+object is only counted if it exists; reading ``obj.__dict__`` would
+create it.
+
+Run it from the repository root:
+
+    python benchmarks/bench_events.py [events] [users] [--tree PATH]
+
+With ``--tree`` the irclib package of another checkout is measured
+instead, for example the tree before a change:
+
+    git worktree add /tmp/before HEAD~1
+    python benchmarks/bench_events.py --tree /tmp/before
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import gc
+import os
+import random
+import sys
+import time
+
+if '--tree' in sys.argv:
+    _tree = sys.argv.pop(sys.argv.index('--tree') + 1)
+    sys.argv.remove('--tree')
+else:
+    _tree = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(_tree))
+
+from irclib import connection
+from irclib import session
+
+
+def make_events(count, users):
+    """Returns `count` low level events, mostly channel messages."""
+    masks = ['user{0}!~ident{0}@host-{0}.example.net'.format(i)
+             for i in range(users)]
+    kinds = ['pubmsg'] * 14 + ['join', 'part', 'quit', 'nick', 'kick',
+                               'action', 'ctcp', 'privmsg']
+    events = []
+    for i in range(count):
+        mask = random.choice(masks)
+        kind = random.choice(kinds)
+        if kind in ('pubmsg', 'privmsg'):
+            target = '#radio' if kind == 'pubmsg' else 'Hanyuu'
+            event = connection.Event(kind, mask, target,
+                                     ['hello there {}'.format(i)])
+        elif kind == 'join':
+            event = connection.Event(kind, mask, '#radio')
+        elif kind in ('part', 'quit'):
+            event = connection.Event(kind, mask, '#radio', ['bye'])
+        elif kind == 'nick':
+            event = connection.Event(kind, mask, 'renamed{}'.format(i))
+        elif kind == 'kick':
+            event = connection.Event(kind, mask, '#radio',
+                                     ['victim', 'go away'])
+        elif kind == 'action':
+            event = connection.Event(kind, mask, '#radio', ['waves'])
+        else:
+            event = connection.Event(kind, mask, 'Hanyuu', ['VERSION'])
+        events.append(event)
+    return events
+
+
+def build(server, events):
+    built = []
+    for event in events:
+        high_event = session.HighEvent.from_low_event(server, event)
+        high_event.nickname and high_event.nickname.name
+        high_event.channel
+        high_event.message
+        built.append(high_event)
+    return built
+
+
+def _size(obj, seen, skip):
+    """Returns the size of `obj` and what it refers to, leaving out the
+    objects in `seen` and the types in `skip`."""
+    if id(obj) in seen or isinstance(obj, skip) or obj is None:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    for referent in gc.get_referents(obj):
+        size += _size(referent, seen, skip)
+    return size
+
+
+def main(count=200000, users=2000):
+    irc = session.Session()
+    server = irc.server()
+    events = make_events(count, users)
+
+    # What the events already hold, and the per-process objects
+    seen = set()
+    skip = (connection.Event, connection.ServerConnection, type)
+    for event in events:
+        _size(event.source, seen, skip)
+        _size(event.target, seen, skip)
+        for argument in event.argument:
+            _size(argument, seen, skip)
+
+    start = time.time()
+    built = build(server, events)
+    elapsed = time.time() - start
+    print("{:>10.0f} events/sec ({} events in {:.3f}s)"
+          .format(count / elapsed, count, elapsed))
+
+    total = sum(_size(high_event, seen, skip) for high_event in built)
+    print("{:>10.1f} bytes per event".format(total / len(built)))
+    print("{:>10} of them have a __dict__".format(
+        sum(1 for high_event in built
+            if any(isinstance(referent, dict)
+                   for referent in gc.get_referents(high_event)))))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,81 @@
+"""
+Benchmark comparing the compiled handler index of
+:class:`irclib.session.Session` with calling every registered handler and
+letting its filters decide, like the Session did before.
+
+Registers a number of handlers that wait for a ``!command`` with
+:meth:`irclib.session.Filters.match`, a few that watch channels and
+nicknames, and dispatches channel messages that mostly trigger nothing.
+
+Run it from the repository root:
+
+    python benchmarks/bench_filters.py [handlers] [messages]
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import connection
+from irclib import session
+from irclib.session import filters, register
+
+
+def make_handler(name, *decorators):
+    def handler(high_event):
+        pass
+    handler.__name__ = str(name)
+    for decorator in reversed(decorators):
+        handler = decorator(handler)
+    return register(handler)
+
+
+def make_events(count):
+    words = ['hello', 'there', 'what', 'is', 'going', 'on', 'today', 'lol']
+    events = []
+    for i in range(count):
+        text = ' '.join(random.choice(words) for _ in range(8))
+        if i % 50 == 0:
+            text = '!cmd{} {}'.format(random.randrange(100), text)
+        channel = random.choice(['#radio', '#chat', '#bots'])
+        events.append(connection.Event('pubmsg', 'nick{}!user@host'
+                                       .format(i % 20), channel, [text]))
+    return events
+
+
+def bench(name, irc, server, events):
+    start = time.time()
+    for event in events:
+        irc._handle_event(server, event)
+    elapsed = time.time() - start
+    print("{:<10} {:.3f}s  {:.1f}us per message"
+          .format(name, elapsed, elapsed / len(events) * 1e6))
+
+
+def main(handlers=200, count=20000):
+    for i in range(handlers - 10):
+        make_handler('command{}'.format(i), filters.events('text'),
+                     filters.match('^!cmd{}\\b'.format(i)))
+    for i in range(5):
+        make_handler('channel{}'.format(i), filters.channels(['#radio']))
+        make_handler('nick{}'.format(i), filters.nicks('nick{}'.format(i)))
+    print("{} handlers, {} messages".format(handlers, count))
+
+    irc = session.Session()
+    server = irc.server()
+    events = make_events(count)
+    bench("indexed", irc, server, events)
+
+    index = session.Session.handler_index
+    everything = list(session.Session.handlers.values())
+    index.lookup = lambda high_event: everything
+    bench("all", irc, server, events)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,79 @@
+"""
+Benchmark of MODE lines, from the line that is read to the high level
+events of its single mode changes.
+
+It runs the kind of lines automated channel moderation sends: ban
+sweeps that set four bans a line, voice storms that voice four users a
+line, and single changes. A handler reads the `modes` of every mode
+event. The single changes include prefix modes without their nickname,
+which the tracker has to skip.
+
+Run it from the repository root:
+
+    python benchmarks/bench_modes.py [lines]
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import session
+from irclib.session import filters, register, unregister
+
+
+def ban_sweep(count):
+    return [":ChanServ!service@services.example.net MODE #radio +bbbb "
+            "*!*@a{0}.example.net *!*@b{0}.example.net *!*@c{0}.example.net "
+            "*!*@d{0}.example.net".format(i).encode('ascii')
+            for i in range(count)]
+
+
+def voice_storm(count):
+    return [":ChanServ!service@services.example.net MODE #radio +vvvv "
+            "user{0} user{1} user{2} user{3}"
+            .format(i, i + 1, i + 2, i + 3).encode('ascii')
+            for i in range(count)]
+
+
+def single(count):
+    lines = [":op!op@staff.example.net MODE #radio +m",
+             ":op!op@staff.example.net MODE #radio :+o",
+             ":Hanyuu MODE Hanyuu :+o"]
+    return [lines[i % 3].encode('ascii') for i in range(count)]
+
+
+def main(count=20000):
+    irc = session.Session()
+    server = irc.server()
+    server.real_server_name = 'irc.example.net'
+    server.real_nickname = 'Hanyuu'
+    server.encoding = 'utf-8'
+    server._process_line(b":Hanyuu!bot@example.net JOIN #radio")
+
+    changes = [0]
+
+    @filters.events('mode')
+    def moderation(high_event):
+        high_event.modes
+        changes[0] += 1
+    register(moderation)
+
+    for name, make in [('ban sweep', ban_sweep), ('voice storm', voice_storm),
+                       ('single', single)]:
+        lines = make(count)
+        changes[0] = 0
+        start = time.time()
+        for line in lines:
+            server._process_line(line)
+        elapsed = time.time() - start
+        print("{:<12} {:>8.0f} lines/sec  {:>8.0f} changes/sec"
+              .format(name, count / elapsed, changes[0] / elapsed))
+    unregister(moderation)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
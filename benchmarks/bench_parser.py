@@ -0,0 +1,83 @@
+"""
+Micro-benchmark comparing :func:`irclib.parser.parse` with the regular
+expression based parsing that :class:`irclib.connection.ServerConnection`
+used before.
+
+Run it from the repository root:
+
+    python benchmarks/bench_parser.py
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import utils, parser
+
+#: A mix of the lines a client sitting in a few busy channels receives.
+LINES = [line.encode('utf-8') for line in [
+    ":nick!user@host.example.com PRIVMSG #channel :hello there, how is everyone doing today?",
+    ":nick!user@host.example.com PRIVMSG #channel :\001ACTION waves\001",
+    ":other!ident@1.2.3.4 JOIN #channel",
+    ":other!ident@1.2.3.4 PART #channel :Leaving",
+    ":someone!~someone@user/someone QUIT :Ping timeout: 260 seconds",
+    ":irc.example.net 353 me = #channel :@op +voice user1 user2 user3 user4",
+    ":irc.example.net 005 me CHANTYPES=# PREFIX=(ov)@+ CHANMODES=b,k,l,imnpst :are supported by this server",
+    ":op!op@services.example.net MODE #channel +ov nick other",
+    "PING :irc.example.net",
+    "@time=2013-01-01T00:00:00.000Z;msgid=abc :nick!user@host PRIVMSG #channel :tagged",
+]]
+
+
+def regex_parse(line):
+    """The parsing steps from the old ServerConnection.process_data."""
+    prefix = None
+    command = None
+    arguments = None
+
+    line = line.decode('utf-8', 'replace')
+
+    m = utils._rfc_1459_command_regexp.match(line)
+    if m.group("prefix"):
+        prefix = m.group("prefix")
+
+    if m.group("command"):
+        command = m.group("command").lower()
+
+    if m.group("argument"):
+        a = m.group("argument").split(" :", 1)
+        arguments = a[0].split()
+        if len(a) == 2:
+            arguments.append(a[1])
+
+    if command in parser.numeric_events:
+        command = parser.numeric_events[command]
+    return prefix, command, arguments
+
+
+def bench(name, func, lines, rounds):
+    start = time.time()
+    for _ in range(rounds):
+        for line in lines:
+            func(line)
+    elapsed = time.time() - start
+    total = rounds * len(lines)
+    print("{:<10} {:>10.0f} lines/sec ({} lines in {:.3f}s)"
+          .format(name, total / elapsed, total, elapsed))
+
+
+def main(rounds=20000):
+    # The regex can't handle tagged lines, only compare on untagged ones.
+    untagged = [line for line in LINES if not line.startswith(b"@")]
+    bench("regex", regex_parse, untagged, rounds)
+    bench("parser", parser.parse, untagged, rounds)
+    bench("+params", lambda line: parser.parse(line).params, untagged, rounds)
+    bench("+tags", lambda line: parser.parse(line).tags, LINES, rounds)
+
+
+if __name__ == '__main__':
+    main()
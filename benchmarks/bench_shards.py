@@ -0,0 +1,152 @@
+"""
+Benchmark of :class:`irclib.shard.Supervisor` with 1 to N shard processes.
+
+A fake server process accepts a number of connections and sends each of
+them the same synthetic traffic: joins, parts and channel
+messages, some of which are bot commands. The shards track the channels
+and run a :class:`irclib.commands.CommandRouter` on the messages, the
+supervisor only hears about the INVITE that ends the traffic of each
+connection. The benchmark reports how many lines per second all shards
+together got through.
+
+With ``--central`` the text events are sent to a handler in the
+supervisor as well, which shows what the event bus costs.
+
+Run it from the repository root:
+
+    python benchmarks/bench_shards.py [connections] [lines per connection]
+        [most shards] [--central]
+
+The amount of shards is doubled from 1 up to the number of cores, or up
+to the given most shards.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import session
+from irclib.commands import CommandRouter
+from irclib.session import filters
+from irclib.shard import Supervisor
+
+
+def make_traffic(lines):
+    """Returns the bytes a connection is sent, about `lines` lines."""
+    out = [b":fake.server 001 bench :Welcome\r\n",
+           b":bench!bench@host JOIN #bench\r\n"]
+    for i in range(lines // 4):
+        nick = 'user{}'.format(i % 200)
+        out.append(":{0}!{0}@host JOIN #bench\r\n".format(nick)
+                   .encode('ascii'))
+        out.append(":{0}!{0}@host PRIVMSG #bench :hello there {1}\r\n"
+                   .format(nick, i).encode('ascii'))
+        out.append(":{0}!{0}@host PRIVMSG #bench :!np {1}\r\n"
+                   .format(nick, i).encode('ascii'))
+        out.append(":{0}!{0}@host PART #bench :bye\r\n".format(nick)
+                   .encode('ascii'))
+    out.append(b":fake.server INVITE bench #done\r\n")
+    return b''.join(out)
+
+
+def serve(listener, connections, traffic):
+    """The fake server: sends `traffic` to every client once it has
+    registered, on a thread per client."""
+    def send(client):
+        data = b''
+        while b'USER' not in data:
+            data += client.recv(4096)
+        client.sendall(traffic)
+        # Keep the connection open until the benchmark is done
+        while client.recv(4096):
+            pass
+
+    threads = []
+    for _ in range(connections):
+        client = listener.accept()[0]
+        thread = threading.Thread(target=send, args=(client,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+
+def run(shards, connections, traffic, lines, central):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(connections)
+    port = listener.getsockname()[1]
+    server = multiprocessing.Process(target=serve,
+                                     args=(listener, connections, traffic))
+    server.daemon = True
+    server.start()
+    listener.close()
+
+    irc = session.Session()
+    supervisor = Supervisor(irc, shards)
+    supervisor.start()
+
+    done = []
+    texts = [0]
+
+    @filters.events('invite')
+    def finished(high_event):
+        done.append(high_event.server)
+    supervisor.register(finished)
+
+    if central:
+        @filters.events('text')
+        def count(high_event):
+            texts[0] += 1
+        supervisor.register(count)
+
+    start = time.time()
+    for _ in range(connections):
+        supervisor.server().connect('127.0.0.1', port, 'bench')
+    while len(done) < connections:
+        irc.process_once(0.1)
+    elapsed = time.time() - start
+
+    supervisor.stop()
+    server.join(5)
+    total = lines * connections
+    print("{:>2} shards  {:>9.0f} lines/sec  {:.2f}s{}"
+          .format(shards, total / elapsed, elapsed,
+                  "  ({} central events)".format(texts[0]) if central
+                  else ""))
+
+
+def main(connections=8, lines=50000, most=None, central=False):
+    # The shard handlers, registered before the shards are forked
+    router = CommandRouter()
+
+    @router.command('np')
+    def now_playing(high_event):
+        high_event.server.tracker
+
+    router.register()
+
+    traffic = make_traffic(lines)
+    print("{} connections, {} lines each, {} cores"
+          .format(connections, lines, multiprocessing.cpu_count()))
+    most = min(most or multiprocessing.cpu_count(), connections)
+    shards = 1
+    while True:
+        run(shards, connections, traffic, lines, central)
+        if shards >= most:
+            break
+        shards = min(shards * 2, most)
+
+
+if __name__ == '__main__':
+    arguments = [argument for argument in sys.argv[1:]
+                 if argument != '--central']
+    main(*map(int, arguments), central='--central' in sys.argv)
@@ -0,0 +1,79 @@
+"""
+Benchmark comparing :class:`irclib.timers.Scheduler` with the sorted list
+:class:`irclib.session.Session` used for delayed commands before.
+
+Schedules a number of timers at random times, cancels half of them (the
+old list had to search and remove them) and then runs them all.
+
+Run it from the repository root:
+
+    python benchmarks/bench_timers.py [timers]
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import bisect
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from irclib import timers
+
+
+def noop():
+    pass
+
+
+class SortedList(object):
+    """The delayed_commands list of the old Session."""
+
+    def __init__(self):
+        self.delayed_commands = []
+
+    def call_at(self, when, function, arguments=()):
+        entry = (when, function, arguments)
+        bisect.insort(self.delayed_commands, entry)
+        return entry
+
+    def cancel(self, entry):
+        self.delayed_commands.remove(entry)
+
+    def run_due(self, t):
+        while self.delayed_commands:
+            if t >= self.delayed_commands[0][0]:
+                self.delayed_commands[0][1](*self.delayed_commands[0][2])
+                del self.delayed_commands[0]
+            else:
+                break
+
+
+def bench(name, scheduler, cancel, times):
+    start = time.time()
+    handles = [scheduler.call_at(when, noop) for when in times]
+    scheduled = time.time()
+    for handle in handles[::2]:
+        cancel(handle)
+    cancelled = time.time()
+    for when in sorted(times):
+        scheduler.run_due(when)
+    done = time.time()
+    print("{:<10} schedule {:.3f}s  cancel {:.3f}s  run {:.3f}s"
+          .format(name, scheduled - start, cancelled - scheduled,
+                  done - cancelled))
+
+
+def main(count=20000):
+    print("{} timers".format(count))
+    # Round the times so that many timers are due at once, like
+    # cooldowns that all started in the same second.
+    times = [round(random.uniform(0, 3600), 1) for _ in range(count)]
+    old = SortedList()
+    bench("list", old, old.cancel, times)
+    bench("heap", timers.Scheduler(), timers.Timer.cancel, times)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
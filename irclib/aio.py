@@ -0,0 +1,462 @@
+"""
+Module that runs IRC connections on an :mod:`asyncio` event loop instead
+of the :meth:`session.Session.process_forever` polling loop.
+
+:class:`AsyncSession` keeps the handler registration and the
+:class:`session.HighEvent` model of :class:`session.Session`; handlers
+that return a coroutine are scheduled as tasks on the loop. The protocol
+parsing is shared with :class:`connection.ServerConnection`, only the
+transport is different.
+
+On Python 2 this needs the trollius backport of asyncio.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import socket
+import time
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+from . import connection
+from . import framing
+from . import sendqueue
+from . import session
+from . import timers
+from .poller import SelectPoller
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+# asyncio.async was renamed to ensure_future
+ensure_future = getattr(asyncio, 'ensure_future', None) or \
+                getattr(asyncio, 'async')
+
+
+class RateLimitedWriter(object):
+    """Writes lines to a transport at the rate a
+    :class:`ratelimit.TokenBucket` allows.
+
+    Lines wait in a :class:`sendqueue.SendQueue`, so they go out by
+    priority and in turns per target, and are only encoded with `encode`
+    when they are written. Lines with the same key are combined with
+    `merge`, as for :class:`sendqueue.SendQueue`. Every write returns a
+    future that resolves once the line was handed to the transport, so a
+    coroutine can wait for its messages to go out.
+    """
+
+    def __init__(self, transport, loop, limiter, encode, merge=None):
+        self.transport = transport
+        self.loop = loop
+        self.limiter = limiter
+        self.encode = encode
+        self.merge = merge
+        # Lines waiting to be written and the futures they resolve
+        self.queue = sendqueue.SendQueue(merge and self._merge)
+        # The pending call to _write_queued, if any
+        self._handle = None
+        self._paused = False
+        self._drain_waiters = []
+
+    def write(self, line, priority=sendqueue.INTERACTIVE, target=None,
+              key=None):
+        """Queues `line` for writing.
+
+        Returns a future that resolves to the amount of bytes written.
+        """
+        future = asyncio.Future(loop=self.loop)
+        self.queue.put((line, [future]), priority, target, key)
+        if self._handle is None and not self._paused:
+            self._write_queued()
+        return future
+
+    def drain(self):
+        """Returns a future that resolves once every queued line has been
+        written."""
+        future = asyncio.Future(loop=self.loop)
+        if not self.queue.empty():
+            self._drain_waiters.append(future)
+        else:
+            future.set_result(None)
+        return future
+
+    def pause(self):
+        """Stops writing until :meth:`resume`, for when the transport's
+        buffer is full."""
+        self._paused = True
+
+    def resume(self):
+        """Continues writing after :meth:`pause`."""
+        self._paused = False
+        if self._handle is None:
+            self._write_queued()
+
+    def close(self, exception):
+        """Fails every queued line with `exception`."""
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        for line, futures in self.queue.clear():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(exception)
+        self._wake_drain_waiters()
+
+    def _write_queued(self):
+        """[Internal] Writes queued lines until the limit is reached."""
+        self._handle = None
+        queue = self.queue
+        while not queue.empty() and not self._paused:
+            delay = self.limiter.delay()
+            if delay:
+                self._handle = self.loop.call_later(delay, self._write_queued)
+                return
+            line, futures = queue.get()
+            data = self.encode(line)
+            self.transport.write(data)
+            self.limiter.consume(len(data))
+            for future in futures:
+                if not future.done():
+                    future.set_result(len(data))
+        if queue.empty():
+            self._wake_drain_waiters()
+
+    def _merge(self, entry, other):
+        """[Internal] Merges two queued lines and their futures."""
+        line = self.merge(entry[0], other[0])
+        if line is None:
+            return None
+        return line, entry[1] + other[1]
+
+    def _wake_drain_waiters(self):
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class AsyncServerConnection(connection.ServerConnection, asyncio.Protocol):
+    """A :class:`connection.ServerConnection` driven by an asyncio
+    transport.
+
+    .. note::
+        Do not instantiate :class:`AsyncServerConnection` directly; use
+        :meth:`AsyncSession.server` instead.
+    """
+
+    def __init__(self, irclibobj, rate_limiter=None):
+        connection.ServerConnection.__init__(self, irclibobj, rate_limiter)
+        self.loop = irclibobj.loop
+        self.transport = None
+        self.writer = None
+
+    def connect(self, server, port, nickname, password=None, username=None,
+                ircname=None, localaddress="", localport=0,
+                ssl=False, ipv6=False, encoding='utf-8', rate_limiter=None):
+        """Connect/reconnect to a server.
+
+        Takes the same arguments as
+        :meth:`connection.ServerConnection.connect`.
+
+        Returns a future that resolves to the AsyncServerConnection object
+        once the connection is made, or fails with
+        :exc:`connection.ServerConnectionError`.
+        """
+        self._stop_reconnecting()
+        return self._connect(server, port, nickname, password, username,
+                             ircname, localaddress, localport, ssl, ipv6,
+                             rate_limiter)
+
+    def _connect(self, server, port, nickname, password, username, ircname,
+                 localaddress, localport, ssl, ipv6, rate_limiter=None):
+        """[Internal] :meth:`connect`, without stopping the reconnect of
+        :meth:`_reconnect_soon`."""
+        if self.connected:
+            self.disconnect("Changing servers")
+        if rate_limiter is not None:
+            self.rate_limiter = rate_limiter
+
+        self._setup(server, port, nickname, password, username, ircname,
+                    localaddress, localport, ssl, ipv6)
+        local_addr = None
+        if localaddress or localport:
+            local_addr = (localaddress, localport)
+        family = socket.AF_INET6 if ipv6 else socket.AF_INET
+
+        result = asyncio.Future(loop=self.loop)
+        def connected(future):
+            if future.cancelled():
+                result.cancel()
+            elif future.exception() is not None:
+                result.set_exception(connection.ServerConnectionError(
+                    "Couldn't connect to socket: {}"
+                    .format(future.exception())))
+            else:
+                result.set_result(self)
+        ensure_future(self.loop.create_connection(lambda: self,
+                                                  server, port,
+                                                  ssl=ssl or None,
+                                                  family=family,
+                                                  local_addr=local_addr),
+                      loop=self.loop).add_done_callback(connected)
+        return result
+
+    def _start_reconnect(self, attempt, delay):
+        """[Internal] Connects for `attempt` on the loop, which doesn't
+        block; `delay` is how long to wait if that fails."""
+        self._reconnect_timer = None
+        if attempt is not self._reconnect_attempt:
+            return
+
+        def reconnected(future):
+            if future.cancelled() or attempt is not self._reconnect_attempt:
+                return
+            if future.exception() is not None:
+                logger.error("Could not reconnect to {}: {}, trying again "
+                             "in {} seconds".format(self.server,
+                                                    future.exception(),
+                                                    delay))
+                self._retry_reconnect(attempt, delay)
+            else:
+                self._reconnect_attempt = None
+        self._connect(self.server, self.port, self.nickname, self.password,
+                      self.username, self.ircname, self.localaddress,
+                      self.localport, self._ssl, self._ipv6) \
+            .add_done_callback(reconnected)
+
+    def connection_made(self, transport):
+        """[Internal] Called by the loop when the connection is made."""
+        self.transport = transport
+        self.socket = transport.get_extra_info('socket')
+        self.writer = RateLimitedWriter(transport, self.loop,
+                                        self.rate_limiter,
+                                        self._encode_line, self._merge_lines)
+        self.connected = 1
+        self._start_liveness()
+        self._log_on()
+
+    def data_received(self, data):
+        """[Internal] Called by the loop with data from the server."""
+        self._last_ping = time.time()
+        try:
+            for line in self.framer.feed(data):
+                if line:
+                    self._process_line(line.tobytes())
+        except framing.LineTooLongError:
+            # Broken or hostile server, don't buffer any more of it.
+            self.disconnect("Line too long")
+
+    def pause_writing(self):
+        """[Internal] Called by the transport when its buffer is full."""
+        if self.writer is not None:
+            self.writer.pause()
+
+    def resume_writing(self):
+        """[Internal] Called by the transport when its buffer drained."""
+        if self.writer is not None:
+            self.writer.resume()
+
+    def connection_lost(self, exc):
+        """[Internal] Called by the loop when the connection is closed."""
+        if self.connected:
+            self.connected = 0
+            self._closed("Connection reset by peer")
+
+    def disconnect(self, message=""):
+        """Hang up the connection."""
+        if not self.connected:
+            return
+
+        self.connected = 0
+
+        self.quit(message)
+        self.transport.close()
+        self._closed(message)
+
+    def _closed(self, message):
+        """[Internal] Cleans up after the connection was closed."""
+        error = connection.ServerNotConnectedError("Disconnected.")
+        self._stop_liveness()
+        self.writer.close(error)
+        self.transport = None
+        self.writer = None
+        self.socket = None
+        self.pending_replies.fail_all(error)
+        self._handle_event(connection.Event("disconnect", self.server, "",
+                                            [message]))
+
+    def send_raw_instant(self, string):
+        """Send raw string to the server, bypassing the flood protection.
+
+        Returns the amount of bytes sent.
+        """
+        if self.transport is None:
+            raise connection.ServerNotConnectedError("Not connected.")
+        message = self._encode_line(string)
+        self.transport.write(message)
+        return len(message)
+
+    def send_raw(self, string, priority=sendqueue.INTERACTIVE, target=None):
+        """Send raw string to the server.
+
+        The string will be padded with appropriate CR LF.
+
+        Returns a future that resolves once the line has been written.
+        """
+        if self.writer is None:
+            raise connection.ServerNotConnectedError("Not connected.")
+        key = None
+        if target is not None:
+            target = self.casemapping.fold(target)
+            key = connection._merge_key(string)
+        return self.writer.write(string, priority, target, key)
+
+    def drain(self):
+        """Returns a future that resolves once all queued messages have
+        been written."""
+        if self.writer is None:
+            raise connection.ServerNotConnectedError("Not connected.")
+        return self.writer.drain()
+
+    def _encode_line(self, string):
+        """[Internal] Terminates and encodes a line for the server."""
+        message = string + '\r\n'
+        if isinstance(message, unicode):
+            message = message.encode(self.encoding)
+        return message
+
+
+class AsyncSession(session.Session):
+    """A :class:`session.Session` that runs on an asyncio event loop.
+
+    Handlers are registered the same way. A handler that returns a
+    coroutine (like one decorated with :func:`asyncio.coroutine`) has it
+    scheduled as a task on the loop.
+    """
+
+    def __init__(self, encoding='utf-8', handle_ctcp=True, loop=None):
+        """Constructor for :class:`AsyncSession` objects.
+
+        :param encoding: The encoding that we should treat the incoming data as.
+        :param handle_ctcp: See :class:`session.Session`.
+        :param loop: The event loop to use, by default the current one.
+        """
+        # Needed by execute_delayed, which the Session already uses
+        self.loop = loop or asyncio.get_event_loop()
+        # The loop does the polling, the Session's poller stays empty.
+        session.Session.__init__(self, encoding, handle_ctcp,
+                                 poller=SelectPoller())
+
+    def server(self, rate_limiter=None):
+        """Creates and returns a :class:`AsyncServerConnection` object.
+
+        :param rate_limiter: See :meth:`session.Session.server`.
+        """
+        c = AsyncServerConnection(self, rate_limiter)
+        self.connections.append(c)
+        return c
+
+    def dcc(self, dcctype="chat", dccinfo=(None, 0)):
+        """Raises :class:`connection.IRCError`: a
+        :class:`dcc.DCCConnection` reads its socket when the Session's
+        poller reports data, and an AsyncSession never polls. Use a
+        :class:`session.Session` for DCC connections.
+        """
+        raise connection.IRCError("DCC connections need the Session's "
+                                  "poller, which AsyncSession doesn't run.")
+
+    def _create_waker(self):
+        """[Internal] The loop is never blocked in the poller, so there is
+        nothing to wake up."""
+        return None
+
+    def process_once(self, timeout=0):
+        """Runs the event loop for `timeout` seconds."""
+        self.loop.run_until_complete(asyncio.sleep(timeout, loop=self.loop))
+
+    def process_forever(self, timeout=None):
+        """Runs the event loop until it is stopped.
+
+        :param timeout: Ignored, the loop wakes up for its own events. It
+                        is only accepted for compatibility with
+                        :meth:`session.Session.process_forever`.
+        """
+        self.loop.run_forever()
+
+    def execute_at(self, at, function, arguments=()):
+        """Execute a function at a specified time.
+
+        :param at: Time to execute at (standard \"time_t\" time).
+        :param function: The function to call.
+        :param arguments: Arguments to give the function.
+
+        Returns the :class:`asyncio.Handle` of the call.
+        """
+        return self.execute_delayed(at - time.time(), function, arguments)
+
+    def execute_delayed(self, delay, function, arguments=()):
+        """Execute a function after a specified time.
+
+        :param delay: How many seconds to wait.
+        :param function: The function to call.
+        :param arguments: Arguments to give the function.
+
+        Returns the :class:`asyncio.Handle` of the call.
+        """
+        return self.loop.call_later(max(delay, 0), function, *arguments)
+
+    def execute_every(self, period, function, arguments=()):
+        """Execute a function every `period` seconds.
+
+        :param period: How many seconds to wait between calls.
+        :param function: The function to call.
+        :param arguments: Arguments to give the function.
+
+        Returns a :class:`timers.Timer` that can be cancelled.
+        """
+        timer = timers.Timer(self.loop.time() + period, function, arguments,
+                             period)
+        def run():
+            if timer.cancelled:
+                return
+            timer.when += period
+            self.loop.call_at(timer.when, run)
+            function(*arguments)
+        self.loop.call_at(timer.when, run)
+        return timer
+
+    def post(self, function, arguments=()):
+        """Calls `function` with `arguments` on the loop, as soon as
+        possible. This may be called from any thread."""
+        self.loop.call_soon_threadsafe(function, *arguments)
+
+    def _call_handler(self, function, high_event):
+        """Calls the handler `function` with `high_event`, scheduling the
+        coroutine it returns, if any.
+
+        Handlers marked with :func:`executor.blocking` are handed to the
+        :attr:`executor` instead, if there is one.
+        """
+        key = getattr(function, 'blocking', None)
+        if key is not None and self.executor is not None:
+            self.executor.submit(key(high_event), function, high_event)
+            return
+        try:
+            result = function(high_event)
+        except:
+            logger.exception('Exception in IRC handler')
+            return
+        if asyncio.iscoroutine(result):
+            ensure_future(result, loop=self.loop).add_done_callback(
+                _log_handler_exception)
+
+
+def _log_handler_exception(task):
+    """[Internal] Logs the exception a coroutine handler raised."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error('Exception in IRC handler: {!r}'
+                     .format(task.exception()))
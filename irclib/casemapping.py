@@ -0,0 +1,104 @@
+"""
+Module that compares nicknames and channel names the way the server does.
+
+IRC servers announce how they compare names with the CASEMAPPING feature
+of their ISUPPORT (005) reply. A :class:`CaseMapping` folds names into a
+key that is equal for every spelling the server considers the same name,
+so that names can be looked up with a single dictionary access.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import string
+
+#: The characters that are folded in each of the casemappings we know.
+#: RFC 1459 considers []\^ to be the uppercase versions of {}|~.
+mappings = {
+    'ascii': (string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': (string.ascii_uppercase + "[]\\^",
+                string.ascii_lowercase + "{}|~"),
+    'strict-rfc1459': (string.ascii_uppercase + "[]\\",
+                       string.ascii_lowercase + "{}|"),
+}
+
+#: The casemapping used when a server doesn't announce one we know
+default_mapping = 'rfc1459'
+
+#: The translation tables of each casemapping, built the first time they
+#: are needed; unicode and byte string tables respectively.
+_tables = {}
+
+
+def _get_tables(name):
+    """[Internal] Returns the translation tables for the casemapping
+    `name`."""
+    tables = _tables.get(name)
+    if tables is None:
+        upper, lower = mappings[name]
+        tables = _tables[name] = (dict(zip(map(ord, upper), map(ord, lower))),
+                                  string.maketrans(upper.encode('ascii'),
+                                                   lower.encode('ascii')))
+    return tables
+
+
+class CaseMapping(object):
+    """Folds names according to a server's casemapping.
+
+    The folded keys of recently seen names are cached, as the same few
+    nicknames and channels show up in most events. The cache is a plain
+    dictionary that is emptied when it is full: a hit costs a single
+    lookup, and it can be used from several threads at once.
+    """
+
+    def __init__(self, name=default_mapping, cache_size=1024):
+        """Constructor for :class:`CaseMapping` objects.
+
+        :param name: The name of the casemapping, as given by the server.
+        :param cache_size: The amount of folded names to remember.
+        """
+        self.cache_size = cache_size
+        self._cache = {}
+        self.name = None
+        self.set_mapping(name)
+
+    def set_mapping(self, name):
+        """Switches to the casemapping `name`.
+
+        Unknown casemappings fall back to :data:`default_mapping`.
+        """
+        name = (name or default_mapping).lower()
+        if name not in mappings:
+            name = default_mapping
+        if name == self.name:
+            return
+        self.name = name
+        self._table, self._bytes_table = _get_tables(name)
+        self._cache.clear()
+
+    def fold(self, name):
+        """Returns the key `name` is compared by; two names are the same
+        name to the server if their keys are equal."""
+        cache = self._cache
+        key = cache.get(name)
+        if key is None:
+            if isinstance(name, unicode):
+                key = name.translate(self._table)
+            else:
+                key = name.translate(self._bytes_table)
+            if len(cache) >= self.cache_size:
+                cache.clear()
+            cache[name] = key
+        return key
+
+    __call__ = fold
+
+    def equals(self, first, second):
+        """Returns True if `first` and `second` are the same name."""
+        return self.fold(first) == self.fold(second)
+
+    def __repr__(self):
+        return "<CaseMapping {}>".format(self.name)
+
+
+#: A shared RFC 1459 casemapping, for when no connection is at hand
+rfc1459 = CaseMapping()
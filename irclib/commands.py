@@ -0,0 +1,228 @@
+"""
+Module that routes bot commands like ``!np`` or ``Hanyuu: np`` to their
+handlers.
+
+Instead of registering a handler with a ``filters.match('^!np')`` regex
+for every command, which makes every text event go through all of them,
+commands are added to a :class:`CommandRouter`. The router is registered
+as a single handler for text events and looks up the command word of a
+message in a dictionary, so routing costs the same no matter how many
+commands there are.
+
+Example::
+
+    router = CommandRouter(prefixes=('!', '.'))
+
+    @router.command('np', 'nowplaying', channels=['#radio'])
+    def now_playing(high_event):
+        ...
+
+    @router.command('request', args=(int,))
+    def request(high_event, song_id):
+        ...
+
+    router.register()
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+from . import session
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+
+class ArgumentError(ValueError):
+    """The arguments of a command don't match its specification."""
+    pass
+
+
+class Command(object):
+    """A command known to a :class:`CommandRouter`."""
+
+    def __init__(self, name, handler, args=None, channels=None):
+        #: The name the command was added with
+        self.name = name
+        self.handler = handler
+        #: The converters of the arguments, or None if the handler takes
+        #: the argument string from the event
+        self.args = args
+        #: The channels the command is limited to, or None
+        self.channels = channels
+        if channels is not None:
+            self._channels = session._folded_names(channels)
+
+    def allowed(self, high_event):
+        """Returns True if the command may be used where `high_event`
+        happened."""
+        if self.channels is None:
+            return True
+        if high_event.channel is None:
+            return False
+        casemap = session._casemap(high_event)
+        return casemap.fold(high_event.channel) in self._channels(casemap)
+
+    def parse(self, arguments):
+        """Converts the argument string with :attr:`args`.
+
+        The last converter gets the rest of the string. Raises
+        :exc:`ArgumentError` if there are too few arguments or one can't be
+        converted.
+        """
+        if not self.args:
+            return []
+        parts = arguments.split(None, len(self.args) - 1)
+        if len(parts) < len(self.args):
+            raise ArgumentError("{} takes {} arguments"
+                                .format(self.name, len(self.args)))
+        try:
+            return [convert(part) for convert, part in zip(self.args, parts)]
+        except (TypeError, ValueError) as e:
+            raise ArgumentError(str(e))
+
+
+class CommandRouter(object):
+    """Dispatches text events to the handler of the command they start
+    with.
+
+    A message is a command if it starts with one of `prefixes`, or, if
+    `highlight` is True, with our nickname followed by ``:`` or ``,``.
+    The first word after that is the command name, which is compared
+    without regard to case.
+
+    Handlers are called with the high level event, which gets two extra
+    attributes: `trigger`, the command name as it was typed, and
+    `arguments`, the rest of the message. If the command has an argument
+    specification the converted arguments are passed as well.
+    """
+
+    def __init__(self, prefixes=('!',), highlight=True):
+        self.prefixes = tuple(prefixes)
+        self.highlight = highlight
+        #: Called with the event, the :class:`Command` and the
+        #: :exc:`ArgumentError` when a command is used with the wrong
+        #: arguments. By default this is only logged.
+        self.on_argument_error = None
+        # Maps the lowercased command names to their Command objects
+        self._commands = {}
+        self._handler = None
+
+    def __len__(self):
+        return len(self._commands)
+
+    def __contains__(self, name):
+        return name.lower() in self._commands
+
+    def add(self, name, handler, aliases=(), args=None, channels=None):
+        """Adds the command `name`, and its `aliases`, to the router.
+
+        :param handler: Called with the event and converted arguments.
+        :param args: A sequence of converters, like ``(int, unicode)``,
+                     that are applied to the words of the arguments; the
+                     last one gets the rest of the message. If this is
+                     None the handler is only called with the event.
+        :param channels: The channels the command works in. By default it
+                         works everywhere, including private messages.
+
+        Returns the :class:`Command`.
+        """
+        command = Command(name, handler, args, channels)
+        for alias in (name,) + tuple(aliases):
+            self._commands[alias.lower()] = command
+        return command
+
+    def command(self, name, *aliases, **kwargs):
+        """Decorator version of :meth:`add`.
+
+        Takes the same `args` and `channels` keyword arguments.
+        """
+        def decorator(handler):
+            self.add(name, handler, aliases, **kwargs)
+            return handler
+        return decorator
+
+    def remove(self, name):
+        """Removes the command `name` and its aliases."""
+        command = self._commands.get(name.lower())
+        if command is None:
+            return
+        for alias, other in list(self._commands.items()):
+            if other is command:
+                del self._commands[alias]
+
+    def split(self, high_event):
+        """Returns the command name and argument string of `high_event`,
+        or None if its message isn't a command."""
+        message = high_event.message
+        if not message:
+            return None
+        for prefix in self.prefixes:
+            if message.startswith(prefix):
+                message = message[len(prefix):]
+                break
+        else:
+            if not self.highlight:
+                return None
+            message = self._strip_highlight(high_event, message)
+            if message is None:
+                return None
+        parts = message.split(None, 1)
+        if not parts or message[0].isspace():
+            return None
+        return parts[0], parts[1] if len(parts) > 1 else ''
+
+    def _strip_highlight(self, high_event, message):
+        """[Internal] Returns `message` without our nickname in front, or
+        None if it doesn't start with it."""
+        server = high_event.server
+        nickname = server.get_nickname() if server is not None else None
+        if not nickname or len(message) <= len(nickname) or \
+                message[len(nickname)] not in ':,':
+            return None
+        casemap = session._casemap(high_event)
+        if not casemap.equals(message[:len(nickname)], nickname):
+            return None
+        return message[len(nickname) + 1:].lstrip()
+
+    def route(self, high_event):
+        """Calls the handler of the command in `high_event`, if any.
+
+        Returns what the handler returned, so that coroutines are
+        scheduled by :class:`aio.AsyncSession`.
+        """
+        split = self.split(high_event)
+        if split is None:
+            return None
+        trigger, arguments = split
+        command = self._commands.get(trigger.lower())
+        if command is None or not command.allowed(high_event):
+            return None
+        high_event.trigger = trigger
+        high_event.arguments = arguments
+        if command.args is None:
+            return command.handler(high_event)
+        try:
+            parsed = command.parse(arguments)
+        except ArgumentError as e:
+            if self.on_argument_error is not None:
+                return self.on_argument_error(high_event, command, e)
+            logger.debug("Bad arguments for {}: {}".format(trigger, e))
+            return None
+        return command.handler(high_event, *parsed)
+
+    def register(self):
+        """Registers the router as a high level handler of text events.
+
+        Returns the handler, which can be passed to
+        :func:`session.unregister`.
+        """
+        if self._handler is None:
+            @session.filters.events('text')
+            def handler(high_event):
+                return self.route(high_event)
+            # register keys handlers by name, every router needs its own
+            handler.__name__ = str('command_router_{:x}'.format(id(self)))
+            self._handler = handler
+        return session.register(self._handler)
@@ -24,14 +24,19 @@ import bisect
 import re
 import select
 import socket
+import ssl as ssl_module
+import errno
 import string
 import sys
 import time
+import threading
 import types
 import codecs
-import Queue
 import collections
-from . import utils, tracker
+from . import utils, tracker, framing, parser, replies, isupport
+from . import casemapping, ratelimit, sendqueue
+from .sendqueue import CONTROL, MODERATION, INTERACTIVE, BULK
+from .parser import numeric_events
 
 from . import logger
 
@@ -40,6 +45,19 @@ logger = logger.getChild(__name__)
 VERSION = 0, 5, 0
 DEBUG = 0
 
+#: The longest line we send, without the CR LF
+MAX_LINE_LENGTH = 510
+
+#: Seconds without data from a server after which we PING it
+PING_INTERVAL = 130.0
+#: Seconds we wait for data after that PING before we reconnect
+PING_TIMEOUT = 130.0
+#: Seconds before we try again when reconnecting after a ping timeout
+#: failed; the wait is doubled after every failure
+RECONNECT_DELAY = 5.0
+#: The longest wait between those tries
+RECONNECT_MAX_DELAY = 300.0
+
 
 class IRCError(Exception):
     """Represents an IRC exception."""
@@ -52,10 +70,48 @@ class Connection(object):
     """
     def __init__(self, irclibobj):
         self.irclibobj = irclibobj
+        #: Output the socket didn't take yet
+        self.out_buffer = bytearray()
+        self._want_write = False
 
     def _get_socket(self):
         raise IRCError("Not overridden")
 
+    def _write(self, data):
+        """[Internal] Buffers the bytes `data` and sends as much of the
+        buffer as the socket takes without blocking."""
+        self.out_buffer += data
+        self._flush()
+
+    def _flush(self):
+        """[Internal] Sends buffered output until the socket would block.
+
+        If output is left, the Session is asked to tell us when the socket
+        can be written to again; see :meth:`process_write`.
+        """
+        buf = self.out_buffer
+        try:
+            while buf:
+                sent = self.socket.send(buf)
+                del buf[:sent]
+        except socket.error, x:
+            if not _would_block(x):
+                del buf[:]
+                self.disconnect("Connection reset by peer.")
+                return
+        want_write = bool(buf)
+        if want_write != self._want_write:
+            self._want_write = want_write
+            self.irclibobj.want_write(self, want_write)
+
+    def process_write(self):
+        """Sends buffered output once the socket can be written to again.
+
+        Only for internal use.
+        """
+        if self.socket is not None:
+            self._flush()
+
     ##############################
     ### Convenience wrappers.
 
@@ -64,14 +120,30 @@ class Connection(object):
         
         .. seealso:: :meth:`session.Session.execute_at`
         """
-        self.irclibobj.execute_at(at, function, arguments)
+        return self.irclibobj.execute_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
         """Executes a function after a specified number of seconds.
         
         .. seealso:: :meth:`session.Session.execute_delayed`
         """
-        self.irclibobj.execute_delayed(delay, function, arguments)
+        return self.irclibobj.execute_delayed(delay, function, arguments)
+
+    def execute_every(self, period, function, arguments=()):
+        """Executes a function every `period` seconds.
+        
+        .. seealso:: :meth:`session.Session.execute_every`
+        """
+        return self.irclibobj.execute_every(period, function, arguments)
+
+
+def _would_block(error):
+    """[Internal] Returns True if the :exc:`socket.error` `error` only
+    means that a non-blocking socket isn't ready."""
+    if isinstance(error, ssl_module.SSLError):
+        return error.args[0] in (ssl_module.SSL_ERROR_WANT_READ,
+                                 ssl_module.SSL_ERROR_WANT_WRITE)
+    return error.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
 
 
 class ServerConnectionError(IRCError):
@@ -90,25 +162,48 @@ class ServerConnection(Connection):
     
     """
 
-    def __init__(self, irclibobj):
+    def __init__(self, irclibobj, rate_limiter=None):
         Connection.__init__(self, irclibobj)
-        self.tracker = tracker.IRCTracker()
+        #: Compares names the way the server does, see
+        #: :class:`casemapping.CaseMapping`
+        self.casemapping = casemapping.CaseMapping()
+        self.tracker = tracker.IRCTracker(self.casemapping)
         self.connected = 0  # Not connected yet.
         self.socket = None
-        self.ssl = None
-        self.message_queue = Queue.Queue()
-        self.sent_bytes = 0
-        self.send_time = 0
-        self.last_time = time.time()
+        #: Messages waiting for the flood control, see
+        #: :class:`sendqueue.SendQueue`
+        self.message_queue = sendqueue.SendQueue(self._merge_lines)
+        #: The flood control of :meth:`send_raw`, see
+        #: :class:`ratelimit.TokenBucket`
+        self.rate_limiter = rate_limiter or ratelimit.TokenBucket()
+        #: Seconds without data after which we PING the server
+        self.ping_interval = PING_INTERVAL
+        #: Seconds to wait for data after that PING before reconnecting
+        self.ping_timeout = PING_TIMEOUT
+        # When we last received data, when we sent our PING if we are
+        # waiting for an answer, and the timer that checks on them.
         self._last_ping = time.time()
+        self._ping_sent = None
+        self._liveness_timer = None
+        #: Seconds before the first retry of a failed reconnect after a
+        #: ping timeout, see :data:`RECONNECT_DELAY`
+        self.reconnect_delay = RECONNECT_DELAY
+        # The reconnect of _reconnect_soon in progress, and the timer of
+        # its next try.
+        self._reconnect_attempt = None
+        self._reconnect_timer = None
         self.encoding = irclibobj.encoding
+        self.framer = framing.LineFramer()
+        self.pending_replies = replies.PendingReplies(self)
         self.featurelist = {}
+        #: The parsed featurelist, see :class:`isupport.ISupport`
+        self.isupport = isupport.ISupport()
         # Contains the featurelist.PREFIX information, maps chars to modes
-        self.prefix = {}
+        self.prefix = self.isupport.prefix
     
     def connect(self, server, port, nickname, password=None, username=None,
                 ircname=None, localaddress="", localport=0,
-                ssl=False, ipv6=False, encoding='utf-8'):
+                ssl=False, ipv6=False, encoding='utf-8', rate_limiter=None):
         """Connect/reconnect to a server.
 
         :param server: Server name.
@@ -125,15 +220,61 @@ class ServerConnection(Connection):
         :param localport: Bind the connection to a specific local port.
         :param ssl: Enable support for ssl.
         :param ipv6: Enable support for ipv6.
+        :param rate_limiter: Replaces the :attr:`rate_limiter` of the
+                             connection, for servers that allow a different
+                             rate.
 
         This function can be called to reconnect a closed connection.
 
         Returns the ServerConnection object.
         """
+        self._stop_reconnecting()
         if self.connected:
             self.disconnect("Changing servers")
+        if rate_limiter is not None:
+            self.rate_limiter = rate_limiter
+
+        self._setup(server, port, nickname, password, username, ircname,
+                    localaddress, localport, ssl, ipv6)
+        self._connected(self._open_socket())
+        return self
 
-        self.previous_buffer = b""
+    def _open_socket(self):
+        """[Internal] Returns a socket connected to the server set up by
+        :meth:`_setup`.
+
+        This blocks on the address lookup, the TCP connect and the SSL
+        handshake; it touches nothing else, so it may run on any thread.
+        """
+        if self._ipv6:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.bind((self.localaddress, self.localport))
+            sock.connect((self.server, self.port))
+            if self._ssl:
+                sock = ssl_module.wrap_socket(sock)
+        except socket.error, x:
+            sock.close()
+            raise ServerConnectionError("Couldn't connect to socket: {}".format(x))
+        return sock
+
+    def _connected(self, sock):
+        """[Internal] Starts using the connected socket `sock`."""
+        self.socket = sock
+        # From here on reads and writes must never stall the Session
+        self.socket.setblocking(0)
+        self.connected = 1
+        self.irclibobj.register_socket(self.socket, self)
+        self._start_liveness()
+        self._log_on()
+
+    def _setup(self, server, port, nickname, password, username, ircname,
+               localaddress, localport, ssl, ipv6):
+        """[Internal] Resets the state of the connection before connecting
+        to `server`."""
+        self.framer = framing.LineFramer()
         self.real_server_name = ""
         self.real_nickname = nickname
         self.server = server
@@ -146,32 +287,70 @@ class ServerConnection(Connection):
         self.localport = localport
         self.localhost = socket.gethostname()
         self.featurelist = {}
+        #: The answers to STATUS queries that arrived after
+        #: :meth:`check_identified` stopped waiting, by nickname
         self.identities = {}
+        self.isupport = isupport.ISupport()
+        self.prefix = self.isupport.prefix
+        self.casemapping.set_mapping(self.isupport.casemapping)
         self.motd_sent = False
         self._ipv6 = ipv6
         self._ssl = ssl
-        if ipv6:
-            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-        else:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self.socket.bind((self.localaddress, self.localport))
-            self.socket.connect((self.server, self.port))
-            if ssl:
-                self.ssl = socket.ssl(self.socket)
-        except socket.error, x:
-            self.socket.close()
-            self.socket = None
-            raise ServerConnectionError("Couldn't connect to socket: {}".format(x))
-        self.connected = 1
-        self.irclibobj.register_socket(self.socket, self)
 
-        # Log on...
+    def _log_on(self):
+        """[Internal] Registers with the server once we are connected."""
         if self.password:
             self.pass_(self.password)
         self.nick(self.nickname)
         self.user(self.username, self.ircname)
-        return self
+
+    def _start_liveness(self):
+        """[Internal] Starts watching for a dead connection."""
+        self._last_ping = time.time()
+        self._ping_sent = None
+        self._liveness_timer = self.execute_at(
+            self._last_ping + self.ping_interval, self._check_liveness)
+
+    def _stop_liveness(self):
+        """[Internal] Stops watching the connection."""
+        if self._liveness_timer is not None:
+            self._liveness_timer.cancel()
+            self._liveness_timer = None
+
+    def _check_liveness(self):
+        """[Internal] PINGs the server once we haven't heard from it in
+        :attr:`ping_interval` seconds, and reconnects if it doesn't say
+        anything within :attr:`ping_timeout` seconds after that.
+
+        Received data only updates :attr:`_last_ping`; the timer is moved
+        forward when it runs, so reading stays cheap.
+        """
+        now = time.time()
+        self._liveness_timer = None
+        if self._ping_sent is not None:
+            if self._last_ping >= self._ping_sent:
+                # The server is still there
+                self._ping_sent = None
+            elif now - self._ping_sent >= self.ping_timeout:
+                idle = int(now - self._last_ping)
+                logger.info("No data in the past {} seconds, reconnecting"
+                            .format(idle))
+                self._reconnect_soon("Ping timeout: {} seconds".format(idle))
+                return
+            else:
+                self._liveness_timer = self.execute_at(
+                    self._ping_sent + self.ping_timeout, self._check_liveness)
+                return
+
+        deadline = self._last_ping + self.ping_interval
+        if now >= deadline:
+            self._ping_sent = now
+            try:
+                self.ping(self.real_server_name or self.server)
+            except ServerNotConnectedError:
+                return
+            deadline = now + self.ping_timeout
+        self._liveness_timer = self.execute_at(deadline, self._check_liveness)
 
     def close(self):
         """Close the connection.
@@ -181,6 +360,7 @@ class ServerConnection(Connection):
                 been called, the object is unusable.
         """
 
+        self._stop_reconnecting()
         self.disconnect("Closing object")
         self.irclibobj._remove_connection(self)
 
@@ -209,29 +389,43 @@ class ServerConnection(Connection):
 
         return self.real_nickname
 
-    def is_identified(self, nick):
-        """ Checks if a user has identified for their Nickname via NickServ
-            returns boolean
+    def check_identified(self, nick, callback=None, timeout=2):
+        """Checks if a user has identified for their Nickname via NickServ.
+
+        :param nick: The nickname to check.
+        :param callback: Called with the returned future once it is done.
+        :param timeout: How many seconds to wait for NickServ to answer.
+
+        Returns a :class:`replies.Future` that resolves to True or False
+        once NickServ has answered, or to False if it didn't answer in
+        time.
         """
         # Send Message to NickServ `STATUS {nick}`
         self.privmsg("NickServ", "STATUS {0}".format(nick))
-        
-        # Wait for NickServ's response
-        #    this is handled in the `process_data` function
-        start_time = time.time()
-        while not nick in self.identities:
-            # Timeout after two seconds
-            if (time.time() - start_time) > 2:
-                return False
-            
-            # Not sure if this line should be included.
-            time.sleep(0.1)
-        
-        # Cache the response so we can delete it from the dict
-        output = self.identities[nick]
-        del self.identities[nick]
-        
-        return output
+        request = replies.IdentityRequest(nick, self.casemapping)
+        return self.pending_replies.add(request, callback, timeout)
+
+    def is_identified(self, nick, timeout=2):
+        """Checks if a user has identified for their Nickname via NickServ.
+
+        Returns True or False, waiting up to `timeout` seconds for NickServ
+        to answer. The answer is read by the Session's thread, so this only
+        works from another thread, like a handler marked with
+        :func:`executor.blocking`; on the Session's thread it returns False
+        after `timeout`. :meth:`check_identified` doesn't block.
+        """
+        answered = threading.Event()
+        identified = []
+
+        def done(future):
+            identified.append(future.exception() is None and
+                              future.result())
+            answered.set()
+
+        # The pending replies belong to the Session's thread
+        self.irclibobj.post(self.check_identified, (nick, done, timeout))
+        answered.wait(timeout)
+        return bool(identified and identified[0])
 
     def process_data(self):
         """Processes incoming data and dispatches handlers.
@@ -239,193 +433,57 @@ class ServerConnection(Connection):
         Only for internal use.
         """
 
-        try:
-            if self.ssl:
-                new_data = self.ssl.read(2**14)
-            else:
-                new_data = self.socket.recv(2**14)
-        except socket.error, x:
-            # The server hung up.
-            self.disconnect("Connection reset by peer")
-            return
-        if not new_data:
-            # Read nothing: connection must be down.
-            self.disconnect("Connection reset by peer")
-            return
-        self._last_ping = time.time()
-        
-        lines = utils._linesep_regexp.split(self.previous_buffer + new_data)
-
-        # Save the last, unfinished line.
-        self.previous_buffer = lines.pop()
-
-        for line in lines:
-            line = line.decode(self.encoding, 'replace')
+        while True:
+            try:
+                received = self.framer.recv_into(self.socket)
+            except socket.error, x:
+                if not _would_block(x):
+                    # The server hung up.
+                    self.disconnect("Connection reset by peer")
+                return
+            if not received:
+                # Read nothing: connection must be down.
+                self.disconnect("Connection reset by peer")
+                return
+            self._last_ping = time.time()
+
+            try:
+                for line in self.framer.lines():
+                    if line:
+                        self._process_line(line.tobytes())
+            except framing.LineTooLongError:
+                # Broken or hostile server, don't buffer any more of it.
+                self.disconnect("Line too long")
+                return
+
+            # SSL may have decrypted more data than we read, the poller
+            # won't tell us about that.
+            if not (self._ssl and self.connected and self.socket.pending()):
+                return
+
+    def _process_line(self, line):
+        """Parses a single line of bytes and dispatches its events.
 
-            if not line:
-                continue
-
-            prefix = None
-            command = None
-            arguments = None
+        Only for internal use.
+        """
+        if self.irclibobj.wants("all_raw_messages"):
             self._handle_event(Event("all_raw_messages",
                                      self.get_server_name(),
                                      None,
-                                     [line]))
-
-            m = utils._rfc_1459_command_regexp.match(line)
-            if m.group("prefix"):
-                prefix = m.group("prefix")
-                if not self.real_server_name:
-                    self.real_server_name = prefix
-
-            if m.group("command"):
-                command = m.group("command").lower()
-
-            if m.group("argument"):
-                a = m.group("argument").split(" :", 1)
-                arguments = a[0].split()
-                if len(a) == 2:
-                    arguments.append(a[1])
-
-            # Translate numerics into more readable strings.
-            if command in numeric_events:
-                command = numeric_events[command]
-
-            if command == "nick":
-                old_nick = utils.nm_to_n(prefix)
-                if old_nick == self.real_nickname:
-                    # We changed our own nick
-                    self.real_nickname = arguments[0]
-                self.tracker.nick(old_nick, arguments[0])
-            elif command == "welcome":
-                # Record the nickname in case the client changed nick
-                # in a nicknameinuse callback.
-                self.real_nickname = arguments[0]
-
-            if command in ["privmsg", "notice"]:
-                target, message = arguments[0], arguments[1]
-                messages = utils._ctcp_dequote(message)
-
-                if command == "privmsg":
-                    if self.is_channel(target):
-                        command = "pubmsg"
-                else:
-                    if self.is_channel(target):
-                        command = "pubnotice"
-                    else:
-                        command = "privnotice"
-                        
-                        # Check if the privnotice is NickServ sending us a Nick Status
-                        #     see `is_identified` function
-                        sender = utils.nm_to_n(prefix)
-                        if sender.lower() == "nickserv":
-                            # Parse the message
-                            resp = re.match("STATUS (.*) (\d)", messages[0])
-                            
-                            # Stop if it isn't a Nick Status
-                            if not resp == None:
-                                nick   =  resp.group(1)
-                                # NickServ will return 2 or 3 if it is identified
-                                status = (resp.group(2) == '2' or resp.group(2) == '3')
-                                
-                                # Add the info to the dict
-                                self.identities[nick] = status
-                                
-                                return
-
-                for m in messages:
-                    if type(m) is types.TupleType:
-                        if command in ["privmsg", "pubmsg"]:
-                            command = "ctcp"
-                        else:
-                            command = "ctcpreply"
-
-                        m = list(m)
-                        
-                        if command == "ctcp" and m[0] == "ACTION":
-                            self._handle_event(Event("action", prefix, target, m[1:]))
-                        else:
-                            self._handle_event(Event(command, prefix, target, m))
-                    else:
-                        self._handle_event(Event(command, prefix, target, [m]))
-            else:
-                target = None
+                                     None,
+                                     line,
+                                     self.encoding))
 
-                if command == "quit":
-                    arguments = [arguments[0]]
-                    self.tracker.quit(utils.nm_to_n(prefix))
-                elif command == "ping":
-                    target = arguments[0]
-                else:
-                    target = arguments[0]
-                    arguments = arguments[1:]
-
-                if command in ["join", "part"]:
-                    getattr(self.tracker, command)(target, utils.nm_to_n(prefix))
-                elif command == "kick":
-                    self.tracker.part(target, arguments[0])
-                elif command == "topic":
-                    self.tracker.topic(target, arguments[0])
-                elif command == "currenttopic":
-                    self.tracker.topic(arguments[0], " ".join(arguments[1:]))
-                elif command == "notopic":
-                    self.tracker.topic(target, "")
-                elif command == "featurelist":
-                    for feature in arguments:
-                        split = feature.split("=")
-                        if (len(split) == 2):
-                            self.featurelist[split[0]] = split[1]
-                        elif (len(split) == 1):
-                            self.featurelist[split[0]] = ""
-                elif command == "endofmotd" and not self.motd_sent:
-                    # We know now that the motd was only sent once
-                    # So don't let us do this again
-                    self.motd_sent = True
-                    if 'CHANMODES' in self.featurelist:
-                        chanmodes = self.featurelist['CHANMODES']
-                        chansplit = chanmodes.split(',')
-                    if 'PREFIX' in self.featurelist:
-                        match = re.match(r"\((.*?)\)(.*?)$", self.featurelist['PREFIX'])
-                        # Map mode chars to modes
-                        # keys contains (@, %) etc, vals contains (o, h) etc.
-                        self.prefix = dict(zip(match.groups()[1], match.groups()[0]))
-                elif command == "namreply":
-                    # Process the name list for a newly joined channel
-                    # Argument 0 has something to do with channel type, ignore
-                    # Argument 1 is the channel name
-                    chan = arguments[1]
-                    # Argument 2 is the space delimited name list
-                    names = arguments[2].strip().split(' ')
-                    for name in names:
-                        # We need to find the spot where the nickname starts
-                        split = 0
-                        for c in name:
-                            # If we found a char that's not a mode char
-                            # (like + and @), we know the split point
-                            if c not in self.prefix:
-                                break
-                            split += 1
-                        modes = name[:split] # this contains mode CHARS
-                        nick = name[split:]
-                        # They've joined the channel...
-                        self.tracker.join(chan, nick)
-                        for mode in modes:
-                            # ...and they have these modes
-                            self.tracker.add_mode(chan, nick, self.prefix[mode])
-                if command == "mode":
-                    chan = target
-                    if not self.is_channel(target):
-                        command = "umode"
-                    # Just parse the modes and register them in the tracker
-                    modes = self._parse_modes(''.join(arguments))
-                    for (sign, mode, param) in modes:
-                        if mode in self.prefix.values():
-                            if sign == '+':
-                                self.tracker.add_mode(chan, param, mode)
-                            else:
-                                self.tracker.rem_mode(chan, param, mode)
-                self._handle_event(Event(command, prefix, target, arguments))
+        message = parser.parse(line, self.encoding)
+        if message.prefix and not self.real_server_name:
+            self.real_server_name = message.prefix
+
+        if message.command in self.pending_replies.commands and \
+                self.pending_replies.dispatch(message):
+            return
+
+        self.command_handlers.get(message.command, _generic_handler)(
+            self, message)
 
     def _handle_event(self, event):
         """Dispatches low level events to the associated 
@@ -440,22 +498,23 @@ class ServerConnection(Connection):
         """
         return self.connected
 
-    def action(self, target, action):
+    def action(self, target, action, priority=INTERACTIVE):
         """Send a CTCP ACTION command."""
-        self.ctcp("ACTION", target, action)
+        self.ctcp("ACTION", target, action, priority)
 
     def admin(self, server=""):
         """Send an ADMIN command."""
         self.send_raw(" ".join(["ADMIN", server]).strip())
 
-    def ctcp(self, ctcptype, target, parameter=""):
+    def ctcp(self, ctcptype, target, parameter="", priority=INTERACTIVE):
         """Send a CTCP command."""
         ctcptype = ctcptype.upper()
-        self.privmsg(target, "\001{}{}\001".format(ctcptype, parameter and (" " + parameter) or ""))
+        self.privmsg(target, "\001{}{}\001".format(ctcptype, parameter and (" " + parameter) or ""),
+                     priority)
 
-    def ctcp_reply(self, target, parameter):
+    def ctcp_reply(self, target, parameter, priority=INTERACTIVE):
         """Send a CTCP REPLY command."""
-        self.notice(target, "\001{}\001".format(parameter))
+        self.notice(target, "\001{}\001".format(parameter), priority)
 
     def disconnect(self, message=""):
         """Hang up the connection."""
@@ -463,14 +522,19 @@ class ServerConnection(Connection):
             return
 
         self.connected = 0
+        self._stop_liveness()
 
         self.quit(message)
 
+        self.irclibobj.unregister_socket(self.socket)
         try:
             self.socket.close()
         except socket.error, x:
             pass
         self.socket = None
+        del self.out_buffer[:]
+        self._want_write = False
+        self.pending_replies.fail_all(ServerNotConnectedError("Disconnected."))
         self._handle_event(Event("disconnect", self.server, "", [message]))
 
     def get_topic(self, channel):
@@ -502,9 +566,10 @@ class ServerConnection(Connection):
         """Send an INFO command."""
         self.send_raw(" ".join(["INFO", server]).strip())
 
-    def invite(self, nick, channel):
+    def invite(self, nick, channel, priority=MODERATION):
         """Send an INVITE command."""
-        self.send_raw(" ".join(["INVITE", nick, channel]).strip())
+        self.send_raw(" ".join(["INVITE", nick, channel]).strip(), priority,
+                      channel)
 
     def ishop(self, channel, nick):
         """Check if nick is half operator on a channel."""
@@ -526,13 +591,36 @@ class ServerConnection(Connection):
         """Check if nick has voice on a channel."""
         return self.tracker.has_modes(channel, nick, 'v')
     
-    def join(self, channel, key=""):
+    def join(self, channel, key="", priority=CONTROL):
         """Send a JOIN command."""
-        self.send_raw("JOIN {}{}".format(channel, (key and (" " + key))))
+        self.send_raw("JOIN {}{}".format(channel, (key and (" " + key))),
+                      priority)
 
-    def kick(self, channel, nick, comment=""):
+    def kick(self, channel, nick, comment="", priority=MODERATION):
         """Send a KICK command."""
-        self.send_raw("KICK {} {}{}".format(channel, nick, (comment and (" :" + comment))))
+        self.send_raw("KICK {} {}{}".format(channel, nick, (comment and (" :" + comment))),
+                      priority, channel)
+
+    def kick_many(self, channel, nicks, comment="", priority=MODERATION):
+        """Kick several nicknames from a channel in as few KICK commands as
+        the server allows (see the KICK limit of TARGMAX)."""
+        limit = self._target_limit("KICK")
+        suffix = comment and (u" :" + comment)
+        base = self._length(u"KICK {} {}".format(channel, suffix))
+        batch = []
+        length = 0
+        for nick in nicks:
+            size = self._length(nick) + bool(batch)
+            if batch and (limit is not None and len(batch) >= limit or
+                          base + length + size > MAX_LINE_LENGTH):
+                self.kick(channel, u",".join(batch), comment, priority)
+                batch = []
+                length = 0
+                size -= 1
+            batch.append(nick)
+            length += size
+        if batch:
+            self.kick(channel, u",".join(batch), comment, priority)
 
     def links(self, remote_server="", server_mask=""):
         """Send a LINKS command."""
@@ -556,41 +644,57 @@ class ServerConnection(Connection):
         """Send a LUSERS command."""
         self.send_raw(u"LUSERS" + (server and (u" " + server)))
 
-    def mode(self, target, command):
+    def mode(self, target, command, priority=MODERATION):
         """Send a MODE command."""
-        self.send_raw(u"MODE {} {}".format(target, command))
+        self.send_raw(u"MODE {} {}".format(target, command), priority, target)
 
     def motd(self, server=""):
         """Send an MOTD command."""
         self.send_raw(u"MOTD" + (server and (u" " + server)))
 
-    def names(self, channels=None):
-        """Send a NAMES command."""
+    def names(self, channels=None, callback=None, timeout=30):
+        """Send a NAMES command.
+
+        Returns a :class:`replies.Future` that resolves to a dictionary
+        mapping each channel to a dictionary of nicknames and their modes.
+        Without `channels` the reply for every visible channel is
+        collected.
+
+        :param callback: Called with the future once it is done.
+        :param timeout: Seconds after which the future fails with
+                        :exc:`replies.ReplyTimeout`.
+        """
+        if isinstance(channels, basestring):
+            channels = [channels]
         self.send_raw(u"NAMES" + (channels and (u" " + u",".join(channels)) or u""))
+        request = replies.NamesRequest(channels, self.casemapping)
+        return self.pending_replies.add(request, callback, timeout)
 
     def nick(self, newnick):
         """Send a NICK command."""
-        self.send_raw(u"NICK " + newnick)
+        self.send_raw(u"NICK " + newnick, CONTROL)
 
-    def notice(self, target, text):
+    def notice(self, target, text, priority=INTERACTIVE):
         """Send a NOTICE command."""
         # Should limit len(text) here!
-        self.send_raw(u"NOTICE {} :{}".format(target, text))
+        self.send_raw(u"NOTICE {} :{}".format(target, text), priority, target)
 
     def oper(self, nick, password):
         """Send an OPER command."""
         self.send_raw(u"OPER {} {}".format(nick, password))
 
-    def part(self, channels, message=""):
+    def part(self, channels, message="", priority=CONTROL):
         """Send a PART command."""
         if type(channels) == types.StringType:
-            self.send_raw(u"PART " + channels + (message and (u" " + message)))
+            self.send_raw(u"PART " + channels + (message and (u" " + message)),
+                          priority)
         else:
-            self.send_raw(u"PART " + u",".join(channels) + (message and (u" " + message)))
+            self.send_raw(u"PART " + u",".join(channels) + (message and (u" " + message)),
+                          priority)
 
     def pass_(self, password):
         """Send a PASS command."""
-        self.send_raw(u"PASS " + password)
+        self.send_raw(u"PASS " + password, CONTROL)
 
     def ping(self, target, target2=""):
         """Send a PING command."""
@@ -600,13 +704,14 @@ class ServerConnection(Connection):
         """Send a PONG command."""
         self.send_raw_instant(u"PONG {}{}".format(target, target2 and (u" " + target2)))
 
-    def privmsg(self, target, text):
+    def privmsg(self, target, text, priority=INTERACTIVE):
         """Send a PRIVMSG command."""
-        self.send_raw(u"PRIVMSG {} :{}".format(target, text))
+        self.send_raw(u"PRIVMSG {} :{}".format(target, text), priority, target)
 
-    def privmsg_many(self, targets, text):
+    def privmsg_many(self, targets, text, priority=INTERACTIVE):
         """Send a PRIVMSG command to multiple targets."""
-        self.send_raw(u"PRIVMSG {} :{}".format(u",".join(targets), text))
+        self.send_raw(u"PRIVMSG {} :{}".format(u",".join(targets), text),
+                      priority)
 
     def quit(self, message=""):
         """Send a QUIT command.
@@ -625,34 +730,183 @@ class ServerConnection(Connection):
         self.connect(self.server, self.port, self.nickname, self.password,
                     self.username, self.ircname, self.localaddress,
                     self.localport, self._ssl, self._ipv6)
+
+    def _reconnect_soon(self, message):
+        """[Internal] Like :meth:`reconnect`, without blocking the Session.
+
+        The socket is opened on a thread of its own, and the connection
+        registers with the Session once it is connected. If that fails it
+        is tried again after :attr:`reconnect_delay` seconds, twice as long
+        after every further failure, until it works or :meth:`connect` or
+        :meth:`close` is called.
+        """
+        self.disconnect(message)
+        self._stop_reconnecting()
+        attempt = self._reconnect_attempt = object()
+        self._start_reconnect(attempt, self.reconnect_delay)
+
+    def _stop_reconnecting(self):
+        """[Internal] Stops the reconnect of :meth:`_reconnect_soon`."""
+        self._reconnect_attempt = None
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
+
+    def _start_reconnect(self, attempt, delay):
+        """[Internal] Opens the socket of `attempt` on a thread; `delay` is
+        how long to wait if that fails."""
+        self._reconnect_timer = None
+        if attempt is not self._reconnect_attempt:
+            return
+        thread = threading.Thread(target=self._open_in_background,
+                                  args=(attempt, delay),
+                                  name='irclib-reconnect')
+        thread.daemon = True
+        thread.start()
+
+    def _open_in_background(self, attempt, delay):
+        """[Internal] The thread started by :meth:`_start_reconnect`."""
+        try:
+            sock = self._open_socket()
+        except ServerConnectionError as e:
+            logger.error("Could not reconnect to {}: {}, trying again in {} "
+                         "seconds".format(self.server, e, delay))
+            self.irclibobj.post(self._retry_reconnect, (attempt, delay))
+            return
+        self.irclibobj.post(self._reopened, (attempt, sock))
+
+    def _retry_reconnect(self, attempt, delay):
+        """[Internal] Schedules the next try of `attempt` in `delay`
+        seconds."""
+        if attempt is not self._reconnect_attempt:
+            return
+        self._reconnect_timer = self.execute_delayed(
+            delay, self._start_reconnect,
+            (attempt, min(delay * 2, RECONNECT_MAX_DELAY)))
+
+    def _reopened(self, attempt, sock):
+        """[Internal] Finishes :meth:`_reconnect_soon` on the Session's
+        thread."""
+        if self.connected or attempt is not self._reconnect_attempt:
+            # Connected again some other way in the meantime
+            sock.close()
+            return
+        self._reconnect_attempt = None
+        self._setup(self.server, self.port, self.nickname, self.password,
+                    self.username, self.ircname, self.localaddress,
+                    self.localport, self._ssl, self._ipv6)
+        self._connected(sock)
+
     def send_raw_instant(self, string):
-        """Send raw string to the server, bypassing the flood protection."""
+        """Send raw string to the server, bypassing the flood protection.
+
+        Returns the amount of bytes sent.
+        """
         if self.socket is None:
             raise ServerNotConnectedError("Not connected.")
-        try:
-            message = string + u'\r\n'
-            if (type(message) == unicode):
-                message = message.encode(self.encoding)
-            if self.ssl:
-                self.ssl.write(message)
-            else:
-                self.socket.sendall(message)
-            if DEBUG:
-                logger.debug("TO SERVER:" + message)
-        except socket.error, x:
-            self.disconnect("Connection reset by peer.")
-    def send_raw(self, string):
+        message = string + u'\r\n'
+        if (type(message) == unicode):
+            message = message.encode(self.encoding)
+        self._write(message)
+        if DEBUG:
+            logger.debug("TO SERVER:" + message)
+        return len(message)
+    def send_raw(self, string, priority=INTERACTIVE, target=None):
         """Send raw string to the server.
 
         The string will be padded with appropriate CR LF.
+
+        :param priority: The priority class of the message, one of the
+                         constants in :mod:`sendqueue`. Messages of a more
+                         urgent class are sent first.
+        :param target: The channel or nickname the message is for, if any.
+                       Targets within a class take turns, and a PRIVMSG
+                       or NOTICE with a target may be merged with the
+                       same text to other targets.
         """
         if self.socket is None:
             raise ServerNotConnectedError("Not connected.")
-        try:
-            self.message_queue.put(string)
-        except (Queue.Full):
-            # Ouch!
-            self.disconnect("Queue is full.")
+        key = None
+        if target is not None:
+            target = self.casemapping.fold(target)
+            key = _merge_key(string)
+        self.message_queue.put(string, priority, target, key)
+        self.irclibobj.queued(self)
+
+    def _merge_lines(self, line, other):
+        """[Internal] Merges two queued PRIVMSG or NOTICE lines with the
+        same text into one line to both targets.
+
+        Returns None if the server doesn't allow that many targets or the
+        line would be too long.
+        """
+        command, targets, text = line.split(' ', 2)
+        target = other.split(' ', 2)[1]
+        limit = self._target_limit(command)
+        if limit is not None and \
+                targets.count(',') + target.count(',') + 2 > limit:
+            return None
+        merged = ' '.join((command, targets + ',' + target, text))
+        if self._length(merged) > MAX_LINE_LENGTH:
+            return None
+        return merged
+
+    def _target_limit(self, command):
+        """[Internal] Returns how many targets we may send `command` to at
+        once, None if there is no limit."""
+        limit = self.isupport.max_targets(command)
+        if limit is None and command.upper() not in self.isupport.targmax:
+            # The server didn't tell, assume one target per command
+            return 1
+        return limit
+
+    def _length(self, string):
+        """[Internal] Returns the length of `string` once it is encoded."""
+        if isinstance(string, unicode):
+            return len(string.encode(self.encoding))
+        return len(string)
+
+    def set_modes(self, target, changes, priority=MODERATION):
+        """Send mode changes in as few MODE commands as the server allows.
+
+        :param changes: The changes as (sign, mode, parameter) tuples, like
+                        ``('+', 'v', nick)``, in the same format
+                        :meth:`_parse_modes` returns. The parameter is None
+                        for modes without one.
+
+        The changes are packed up to the MODES limit of the server and the
+        line length, in the order they are given, so changes to the same
+        nickname are applied in that order by the server and the tracker.
+        """
+        limit = self.isupport.modes
+        base = self._length(u"MODE {} ".format(target))
+        modes, params = [], []
+        sign = None
+        count = length = 0
+        for change_sign, mode, param in changes:
+            param_size = 0
+            if param is not None:
+                param_size = 1 + self._length(param)
+            size = len(mode) + (change_sign != sign) + param_size
+            if modes and (param is not None and limit is not None and
+                          count >= limit or
+                          base + length + size > MAX_LINE_LENGTH):
+                self.mode(target, u" ".join([u"".join(modes)] + params),
+                          priority)
+                modes, params = [], []
+                sign = None
+                count = length = 0
+            if change_sign != sign:
+                modes.append(change_sign)
+                sign = change_sign
+                length += 1
+            modes.append(mode)
+            length += len(mode) + param_size
+            if param is not None:
+                params.append(param)
+                count += 1
+        if modes:
+            self.mode(target, u" ".join([u"".join(modes)] + params), priority)
 
     def squit(self, server, comment=""):
         """Send an SQUIT command."""
@@ -666,7 +920,7 @@ class ServerConnection(Connection):
         """Send a TIME command."""
         self.send_raw(u"TIME" + (server and (u" " + server)))
 
-    def topic(self, channel, new_topic=None):
+    def topic(self, channel, new_topic=None, priority=MODERATION):
         """Send a TOPIC command.
         
             .. note:: This method does not return the topic for you; use
@@ -676,9 +930,10 @@ class ServerConnection(Connection):
         
         """
         if new_topic is None:
-            self.send_raw(u"TOPIC " + channel)
+            self.send_raw(u"TOPIC " + channel, priority, channel)
         else:
-            self.send_raw(u"TOPIC {} :{}".format(channel, new_topic))
+            self.send_raw(u"TOPIC {} :{}".format(channel, new_topic),
+                          priority, channel)
 
     def trace(self, target=""):
         """Send a TRACE command."""
@@ -686,7 +941,7 @@ class ServerConnection(Connection):
 
     def user(self, username, realname):
         """Send a USER command."""
-        self.send_raw(u"USER {} 0 * :{}".format(username, realname))
+        self.send_raw(u"USER {} 0 * :{}".format(username, realname), CONTROL)
 
     def userhost(self, nicks):
         """Send a USERHOST command."""
@@ -704,13 +959,36 @@ class ServerConnection(Connection):
         """Send a WALLOPS command."""
         self.send_raw(u"WALLOPS :" + text)
 
-    def who(self, target="", op=""):
-        """Send a WHO command."""
+    def who(self, target="", op="", callback=None, timeout=30):
+        """Send a WHO command.
+
+        Returns a :class:`replies.Future` that resolves to a list with a
+        dictionary for every user in the reply.
+
+        :param callback: Called with the future once it is done.
+        :param timeout: Seconds after which the future fails with
+                        :exc:`replies.ReplyTimeout`.
+        """
         self.send_raw(u"WHO{}{}".format(target and (u" " + target), op and (u" o")))
+        return self.pending_replies.add(replies.WhoRequest(),
+                                        callback, timeout)
 
-    def whois(self, targets):
-        """Send a WHOIS command."""
+    def whois(self, targets, callback=None, timeout=30):
+        """Send a WHOIS command.
+
+        Returns a :class:`replies.Future` that resolves to a dictionary
+        mapping each of the nicknames in `targets` to a dictionary of
+        information about them, or None if there is no such nickname.
+
+        :param callback: Called with the future once it is done.
+        :param timeout: Seconds after which the future fails with
+                        :exc:`replies.ReplyTimeout`.
+        """
+        if isinstance(targets, basestring):
+            targets = [targets]
         self.send_raw(u"WHOIS " + ",".join(targets))
+        request = replies.WhoisRequest(targets, self.casemapping)
+        return self.pending_replies.add(request, callback, timeout)
 
     def whowas(self, nick, max="", server=""):
         """Send a WHOWAS command."""
@@ -726,26 +1004,14 @@ class ServerConnection(Connection):
         and parameter is an optional parameter to the mode. If no parameter
         was specified, the value is None.
         
-        The default values are taken from Rizon's ircd.
+        The mode types come from :attr:`isupport`, whose defaults are
+        taken from Rizon's ircd.
         """
-        
+        # Groups A and B and the prefix modes need a parameter
+        always_param = self.isupport.always_param
+        # Group C only needs a parameter when set
+        set_param = self.isupport.set_param
 
-        if 'CHANMODES' in self.featurelist:
-            chanmodes = self.featurelist['CHANMODES'].split(',')
-            # Groups A and B and the prefix modes need a parameter
-            always_param =  chanmodes[0] +\
-                            chanmodes[1] +\
-                            str(self.prefix.values())
-            # Group C only needs a parameter when set
-            set_param = chanmodes[2]
-            # Group D does not need a parameter
-            no_param = chanmodes[3]
-        else:
-            always_param = 'beIkqaohv'
-            set_param = 'l'
-            no_param='BCMNORScimnpstz'
-        
-        
         modes = []
         sign = ''
         param_index = 0;
@@ -776,19 +1042,297 @@ class ServerConnection(Connection):
     
         Returns True if the argument is a channel name, otherwise False.
         """
-        chan_prefixes = self.featurelist.get('CHANTYPES', None)        
-        return string and string[0] in (chan_prefixes or "#&+!")
+        return string and string[0] in self.isupport.chantypes
 
 
 
     
 
-Event = collections.namedtuple('Event', ('eventtype', 'source',
-                                         'target', 'argument'))
+#: Low level command handlers, keyed by event name.
+#: See :func:`command_handler` for how to add your own.
+ServerConnection.command_handlers = {}
 
-class Event(Event):
+
+def command_handler(*commands):
+    """Decorator that registers a function as the handler of the low level
+    `commands` for every :class:`ServerConnection`.
+
+    The names are event names as produced by the parser, so numerics are
+    given by their name in :data:`numeric_events` (or the bare number if
+    they are not in there). A handler is called as
+    ``handler(connection, message)`` with a :class:`parser.Message` and is
+    responsible for updating the tracker and dispatching the
+    :class:`Event` objects for the line. Registering a command that
+    already has a handler replaces the existing one.
+
+    To change the handlers of a single connection, assign a copy of
+    :attr:`ServerConnection.command_handlers` to its `command_handlers`
+    attribute and modify that instead.
+    """
+    def decorator(func):
+        for command in commands:
+            ServerConnection.command_handlers[command] = func
+        return func
+    return decorator
+
+
+def _merge_key(line):
+    """[Internal] Returns what a line has to have in common with others to
+    be merged with them, or None if it can't be merged."""
+    if not isinstance(line, unicode):
+        return None
+    command, _, rest = line.partition(' ')
+    if command.upper() not in ('PRIVMSG', 'NOTICE'):
+        return None
+    targets, _, text = rest.partition(' ')
+    if not text.startswith(':'):
+        return None
+    return (command.upper(), text)
+
+
+def _target(message):
+    """Returns the first parameter of `message`, which some servers send as
+    the trailing parameter when it's the only one."""
+    if message.middle:
+        return message.middle[0]
+    return message.trailing
+
+
+def _generic_handler(connection, message, command=None):
+    """Dispatches any command that has no handler of its own; the first
+    argument is treated as the target.
+
+    The trailing argument is passed on undecoded.
+    """
+    command = command or message.command
+    if not connection.irclibobj.wants(command):
+        return
+    connection._handle_event(_generic_event(message, command))
+
+
+def _generic_event(message, command):
+    """[Internal] Returns the low level event of `message` the way
+    :func:`_generic_handler` makes it."""
+    middle = message.middle
+    if middle:
+        return Event(command, message.prefix, middle[0], middle[1:],
+                     message.raw_trailing, message.encoding)
+    return Event(command, message.prefix, message.trailing)
+
+
+@command_handler("privmsg", "notice")
+def _on_message(connection, message):
+    prefix = message.prefix
+    command = message.command
+    target = message.middle[0]
+
+    if command == "privmsg":
+        if connection.is_channel(target):
+            command = "pubmsg"
+    else:
+        if connection.is_channel(target):
+            command = "pubnotice"
+        else:
+            command = "privnotice"
+
+            # A NickServ STATUS answer that no request was waiting for
+            # any more; see check_identified
+            if prefix and connection.casemapping.fold(
+                    utils.nm_to_n(prefix)) == "nickserv":
+                status = replies.parse_status(message.params[-1])
+                if status is not None:
+                    nick, identified = status
+                    connection.identities[nick] = identified
+                    return
+
+    wants = connection.irclibobj.wants
+    raw = message.raw_trailing
+    if raw is not None and b"\001" not in raw and b"\020" not in raw:
+        # There's no CTCP to dequote, so the text itself isn't needed
+        # yet and is only decoded once someone reads it.
+        if wants(command):
+            connection._handle_event(Event(command, prefix, target, None,
+                                           raw, message.encoding))
+        return
+
+    messages = utils._ctcp_dequote(message.params[1])
+    for m in messages:
+        if type(m) is types.TupleType:
+            if command in ("privmsg", "pubmsg"):
+                command = "ctcp"
+            else:
+                command = "ctcpreply"
+
+            m = list(m)
+            
+            if command == "ctcp" and m[0] == "ACTION":
+                if wants("action"):
+                    connection._handle_event(Event("action", prefix, target, m[1:]))
+            elif wants(command):
+                connection._handle_event(Event(command, prefix, target, m))
+        elif wants(command):
+            connection._handle_event(Event(command, prefix, target, [m]))
+
+
+@command_handler("nick")
+def _on_nick(connection, message):
+    old_nick = utils.nm_to_n(message.prefix)
+    new_nick = _target(message)
+    if old_nick == connection.real_nickname:
+        # We changed our own nick
+        connection.real_nickname = new_nick
+    connection.tracker.nick(old_nick, new_nick)
+    _generic_handler(connection, message)
+
+
+@command_handler("welcome")
+def _on_welcome(connection, message):
+    # Record the nickname in case the client changed nick
+    # in a nicknameinuse callback.
+    connection.real_nickname = message.middle[0]
+    _generic_handler(connection, message)
+
+
+@command_handler("quit")
+def _on_quit(connection, message):
+    connection.tracker.quit(utils.nm_to_n(message.prefix))
+    if connection.irclibobj.wants(message.command):
+        connection._handle_event(Event(message.command, message.prefix, None,
+                                       message.middle[:1],
+                                       message.raw_trailing,
+                                       message.encoding))
+
+
+@command_handler("ping")
+def _on_ping(connection, message):
+    if connection.irclibobj.wants(message.command):
+        connection._handle_event(Event(message.command, message.prefix,
+                                       _target(message), message.params))
+
+
+@command_handler("join")
+def _on_join(connection, message):
+    connection.tracker.join(_target(message), utils.nm_to_n(message.prefix))
+    _generic_handler(connection, message)
+
+
+@command_handler("part")
+def _on_part(connection, message):
+    connection.tracker.part(_target(message), utils.nm_to_n(message.prefix))
+    _generic_handler(connection, message)
+
+
+@command_handler("kick")
+def _on_kick(connection, message):
+    arguments = message.params
+    connection.tracker.part(arguments[0], arguments[1])
+    _generic_handler(connection, message)
+
+
+@command_handler("topic")
+def _on_topic(connection, message):
+    arguments = message.params
+    connection.tracker.topic(arguments[0], arguments[1])
+    _generic_handler(connection, message)
+
+
+@command_handler("currenttopic")
+def _on_currenttopic(connection, message):
+    arguments = message.params
+    connection.tracker.topic(arguments[1], " ".join(arguments[2:]))
+    _generic_handler(connection, message)
+
+
+@command_handler("notopic")
+def _on_notopic(connection, message):
+    connection.tracker.topic(message.params[0], "")
+    _generic_handler(connection, message)
+
+
+@command_handler("featurelist")
+def _on_featurelist(connection, message):
+    for feature in message.params[1:]:
+        split = feature.split("=")
+        if (len(split) == 2):
+            connection.featurelist[split[0]] = split[1]
+        elif (len(split) == 1):
+            connection.featurelist[split[0]] = ""
+    # The last parameter is the "are supported by this server" text
+    connection.isupport.update(message.middle[1:])
+    connection.prefix = connection.isupport.prefix
+    connection.casemapping.set_mapping(connection.isupport.casemapping)
+    _generic_handler(connection, message)
+
+
+@command_handler("endofmotd")
+def _on_endofmotd(connection, message):
+    if not connection.motd_sent:
+        # We know now that the motd was only sent once
+        # So don't let us do this again
+        connection.motd_sent = True
+    _generic_handler(connection, message)
+
+
+@command_handler("namreply")
+def _on_namreply(connection, message):
+    arguments = message.params
+    # Process the name list for a newly joined channel
+    # Argument 0 is our own nickname, argument 1 has something to do
+    # with channel type, ignore
+    # Argument 2 is the channel name
+    chan = arguments[2]
+    # Argument 3 is the space delimited name list
+    names = arguments[3].strip().split(' ')
+    for name in names:
+        # We need to find the spot where the nickname starts
+        split = 0
+        for c in name:
+            # If we found a char that's not a mode char
+            # (like + and @), we know the split point
+            if c not in connection.prefix:
+                break
+            split += 1
+        modes = name[:split] # this contains mode CHARS
+        nick = name[split:]
+        # They've joined the channel...
+        connection.tracker.join(chan, nick)
+        for mode in modes:
+            # ...and they have these modes
+            connection.tracker.add_mode(chan, nick, connection.prefix[mode])
+    _generic_handler(connection, message)
+
+
+@command_handler("mode")
+def _on_mode(connection, message):
+    arguments = message.params
+    chan = arguments[0]
+    command = "mode"
+    if not connection.is_channel(chan):
+        command = "umode"
+    # Parse the modes once, for the tracker and for the event
+    modes = connection._parse_modes(' '.join(arguments[1:]))
+    prefix_modes = connection.isupport.prefix_modes
+    for (sign, mode, param) in modes:
+        # A prefix mode without its nickname is malformed, skip it
+        if mode in prefix_modes and param is not None:
+            if sign == '+':
+                connection.tracker.add_mode(chan, param, mode)
+            else:
+                connection.tracker.rem_mode(chan, param, mode)
+    if not connection.irclibobj.wants(command):
+        return
+    event = _generic_event(message, command)
+    event.modes = modes
+    connection._handle_event(event)
+
+
+class Event(object):
     """Class representing an IRC event."""
-    def __init__(self, eventtype, source, target, arguments=None):
+    __slots__ = ('eventtype', 'source', 'target', '_argument',
+                 '_raw_argument', '_encoding', 'modes')
+
+    def __init__(self, eventtype, source, target, arguments=None,
+                 raw_argument=None, encoding='utf-8', modes=None):
         """Constructor of Event objects.
 
         Arguments:
@@ -800,172 +1344,39 @@ class Event(Event):
             target -- The target of the event (a nick or a channel).
 
             arguments -- Any event specific arguments.
+
+            raw_argument -- Optionally, a last argument as the bytes received
+                            from the server. It is decoded with `encoding`
+                            and appended to the arguments the first time
+                            they are read.
+
+            modes -- For mode and umode events, the mode changes as
+                     :meth:`ServerConnection._parse_modes` returns them,
+                     so that they are only parsed once.
         """
-        arguments = arguments if arguments else []
-        super(Event, self).__init__(eventtype, source, target, arguments)
-
-# Numeric table mostly stolen from the Perl IRC module (Net::IRC).
-numeric_events = {
-    "001": "welcome",
-    "002": "yourhost",
-    "003": "created",
-    "004": "myinfo",
-    "005": "featurelist",
-    "200": "tracelink",
-    "201": "traceconnecting",
-    "202": "tracehandshake",
-    "203": "traceunknown",
-    "204": "traceoperator",
-    "205": "traceuser",
-    "206": "traceserver",
-    "207": "traceservice",
-    "208": "tracenewtype",
-    "209": "traceclass",
-    "210": "tracereconnect",
-    "211": "statslinkinfo",
-    "212": "statscommands",
-    "213": "statscline",
-    "214": "statsnline",
-    "215": "statsiline",
-    "216": "statskline",
-    "217": "statsqline",
-    "218": "statsyline",
-    "219": "endofstats",
-    "221": "umodeis",
-    "231": "serviceinfo",
-    "232": "endofservices",
-    "233": "service",
-    "234": "servlist",
-    "235": "servlistend",
-    "241": "statslline",
-    "242": "statsuptime",
-    "243": "statsoline",
-    "244": "statshline",
-    "250": "luserconns",
-    "251": "luserclient",
-    "252": "luserop",
-    "253": "luserunknown",
-    "254": "luserchannels",
-    "255": "luserme",
-    "256": "adminme",
-    "257": "adminloc1",
-    "258": "adminloc2",
-    "259": "adminemail",
-    "261": "tracelog",
-    "262": "endoftrace",
-    "263": "tryagain",
-    "265": "n_local",
-    "266": "n_global",
-    "300": "none",
-    "301": "away",
-    "302": "userhost",
-    "303": "ison",
-    "305": "unaway",
-    "306": "nowaway",
-    "307": "whoisidentified",
-    "311": "whoisuser",
-    "312": "whoisserver",
-    "313": "whoisoperator",
-    "314": "whowasuser",
-    "315": "endofwho",
-    "316": "whoischanop",
-    "317": "whoisidle",
-    "318": "endofwhois",
-    "319": "whoischannels",
-    "321": "liststart",
-    "322": "list",
-    "323": "listend",
-    "324": "channelmodeis",
-    "329": "channelcreate",
-    "331": "notopic",
-    "332": "currenttopic",
-    "333": "topicinfo",
-    "341": "inviting",
-    "342": "summoning",
-    "346": "invitelist",
-    "347": "endofinvitelist",
-    "348": "exceptlist",
-    "349": "endofexceptlist",
-    "351": "version",
-    "352": "whoreply",
-    "353": "namreply",
-    "361": "killdone",
-    "362": "closing",
-    "363": "closeend",
-    "364": "links",
-    "365": "endoflinks",
-    "366": "endofnames",
-    "367": "banlist",
-    "368": "endofbanlist",
-    "369": "endofwhowas",
-    "371": "info",
-    "372": "motd",
-    "373": "infostart",
-    "374": "endofinfo",
-    "375": "motdstart",
-    "376": "endofmotd",
-    "377": "motd2",        # 1997-10-16 -- tkil
-    "381": "youreoper",
-    "382": "rehashing",
-    "384": "myportis",
-    "391": "time",
-    "392": "usersstart",
-    "393": "users",
-    "394": "endofusers",
-    "395": "nousers",
-    "401": "nosuchnick",
-    "402": "nosuchserver",
-    "403": "nosuchchannel",
-    "404": "cannotsendtochan",
-    "405": "toomanychannels",
-    "406": "wasnosuchnick",
-    "407": "toomanytargets",
-    "409": "noorigin",
-    "411": "norecipient",
-    "412": "notexttosend",
-    "413": "notoplevel",
-    "414": "wildtoplevel",
-    "421": "unknowncommand",
-    "422": "nomotd",
-    "423": "noadmininfo",
-    "424": "fileerror",
-    "431": "nonicknamegiven",
-    "432": "erroneusnickname", # Thiss iz how its speld in thee RFC.
-    "433": "nicknameinuse",
-    "436": "nickcollision",
-    "437": "unavailresource",  # "Nick temporally unavailable"
-    "441": "usernotinchannel",
-    "442": "notonchannel",
-    "443": "useronchannel",
-    "444": "nologin",
-    "445": "summondisabled",
-    "446": "usersdisabled",
-    "451": "notregistered",
-    "461": "needmoreparams",
-    "462": "alreadyregistered",
-    "463": "nopermforhost",
-    "464": "passwdmismatch",
-    "465": "yourebannedcreep", # I love this one...
-    "466": "youwillbebanned",
-    "467": "keyset",
-    "471": "channelisfull",
-    "472": "unknownmode",
-    "473": "inviteonlychan",
-    "474": "bannedfromchan",
-    "475": "badchannelkey",
-    "476": "badchanmask",
-    "477": "nochanmodes",  # "Channel doesn't support modes"
-    "478": "banlistfull",
-    "481": "noprivileges",
-    "482": "chanoprivsneeded",
-    "483": "cantkillserver",
-    "484": "restricted",   # Connection is restricted
-    "485": "uniqopprivsneeded",
-    "491": "nooperhost",
-    "492": "noservicehost",
-    "501": "umodeunknownflag",
-    "502": "usersdontmatch",
-}
+        self.eventtype = eventtype
+        self.source = source
+        self.target = target
+        self._argument = arguments if arguments else []
+        self._raw_argument = raw_argument
+        self._encoding = encoding
+        self.modes = modes
+
+    @property
+    def argument(self):
+        """The list of event specific arguments."""
+        if self._raw_argument is not None:
+            self._argument.append(utils.decode(self._raw_argument,
+                                               self._encoding))
+            self._raw_argument = None
+        return self._argument
+
+    def __iter__(self):
+        return iter((self.eventtype, self.source, self.target, self.argument))
+
+    def __repr__(self):
+        return "Event(eventtype={!r}, source={!r}, target={!r}, argument={!r})"\
+               .format(self.eventtype, self.source, self.target, self.argument)
 
 generated_events = [
     # Generated events
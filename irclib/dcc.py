@@ -4,6 +4,7 @@ from __future__ import absolute_import
 import socket
 from . import utils
 from . import connection
+from . import framing
 
 from . import logger
 
@@ -48,7 +49,7 @@ class DCCConnection(connection.Connection):
         self.peeraddress = socket.gethostbyname(address)
         self.peerport = port
         self.socket = None
-        self.previous_buffer = ""
+        self.framer = framing.LineFramer()
         self.handlers = {}
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.passive = 0
@@ -56,6 +57,7 @@ class DCCConnection(connection.Connection):
             self.socket.connect((self.peeraddress, self.peerport))
         except socket.error, x:
             raise DCCConnectionError("Couldn't connect to socket: {}".format(x))
+        self.socket.setblocking(0)
         self.connected = 1
         self.irclibobj.register_socket(self.socket, self)
         return self
@@ -70,7 +72,7 @@ class DCCConnection(connection.Connection):
         address and port are available as :attr:`peeraddress` and
         :attr:`peerport`.
         """
-        self.previous_buffer = b""
+        self.framer = framing.LineFramer()
         self.handlers = {}
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.passive = 1
@@ -80,6 +82,7 @@ class DCCConnection(connection.Connection):
             self.socket.listen(10)
         except socket.error, x:
             raise DCCConnectionError("Couldn't bind socket: {}".format(x))
+        self.socket.setblocking(0)
         self.irclibobj.register_socket(self.socket, self)
         return self
 
@@ -96,11 +99,14 @@ class DCCConnection(connection.Connection):
             return
 
         self.connected = 0
+        self.irclibobj.unregister_socket(self.socket)
         try:
             self.socket.close()
         except socket.error, x:
             pass
         self.socket = None
+        del self.out_buffer[:]
+        self._want_write = False
         self.irclibobj._handle_event(
             self,
             connection.Event("dcc_disconnect", self.peeraddress, "", [message]))
@@ -110,10 +116,18 @@ class DCCConnection(connection.Connection):
         """[Internal]"""
 
         if self.passive and not self.connected:
-            conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            try:
+                conn, (self.peeraddress, self.peerport) = self.socket.accept()
+            except socket.error, x:
+                if connection._would_block(x):
+                    return
+                raise
+            conn.setblocking(0)
+            self.irclibobj.unregister_socket(self.socket)
             self.socket.close()
             self.socket = conn
             self.connected = 1
+            self.irclibobj.register_socket(self.socket, self)
             if DEBUG:
                 logger.debug("DCC connection from {}:{}"
                              .format(self.peeraddress, self.peerport))
@@ -123,12 +137,17 @@ class DCCConnection(connection.Connection):
             return
 
         try:
-            new_data = self.socket.recv(2**14)
+            if self.dcctype == "chat":
+                received = self.framer.recv_into(self.socket)
+            else:
+                new_data = self.socket.recv(2**14)
+                received = len(new_data)
         except socket.error, x:
-            # The server hung up.
-            self.disconnect("Connection reset by peer")
+            if not connection._would_block(x):
+                # The peer hung up.
+                self.disconnect("Connection reset by peer")
             return
-        if not new_data:
+        if not received:
             # Read nothing: connection must be down.
             self.disconnect("Connection reset by peer")
             return
@@ -136,15 +155,7 @@ class DCCConnection(connection.Connection):
         if self.dcctype == "chat":
             # The specification says lines are terminated with LF, but
             # it seems safer to handle CR LF terminations too.
-            chunks = utils._linesep_regexp.split(self.previous_buffer + new_data)
-
-            # Save the last, unfinished line.
-            self.previous_buffer = chunks[-1]
-            if len(self.previous_buffer) > 2**14:
-                # Bad peer! Naughty peer!
-                self.disconnect()
-                return
-            chunks = chunks[:-1]
+            chunks = self._chat_lines()
         elif self.dcctype == "send":
             # We are going to sidestep the events a bit
             size = len(new_data)
@@ -166,6 +177,11 @@ class DCCConnection(connection.Connection):
                 connection.Event('dcc_complete', self.peeraddress, None, None))
 
         command = "dccmsg"
+        if not self.irclibobj.wants(command):
+            # Still consume the chunks, the framer needs them read.
+            for chunk in chunks:
+                pass
+            return
         prefix = self.peeraddress
         target = None
         for chunk in chunks:
@@ -179,6 +195,15 @@ class DCCConnection(connection.Connection):
                 self,
                 connection.Event(command, prefix, target, arguments))
 
+    def _chat_lines(self):
+        """[Internal] Yields the complete lines received from the peer."""
+        try:
+            for line in self.framer.lines():
+                yield line.tobytes()
+        except framing.LineTooLongError:
+            # Bad peer! Naughty peer!
+            self.disconnect()
+
     def _get_socket(self):
         """[Internal]"""
         return self.socket
@@ -189,12 +214,10 @@ class DCCConnection(connection.Connection):
         The string will be padded with appropriate LF if it's a DCC
         CHAT session.
         """
-        try:
-            self.socket.send(string)
-            if self.dcctype == "chat":
-                self.socket.send("\n")
-            if DEBUG:
-                print("TO PEER: {}\n".format(string))
-        except socket.error, x:
-            # Ouch!
-            self.disconnect("Connection reset by peer.")
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        if self.dcctype == "chat":
+            string += b"\n"
+        self._write(string)
+        if DEBUG:
+            print("TO PEER: {}\n".format(string))
@@ -0,0 +1,203 @@
+"""
+Module that runs slow event handlers on worker threads.
+
+Handlers run on the thread of the :class:`session.Session` loop, so a
+handler that waits for a web request or a database stops every connection
+from reading, answering PINGs and sending. Handlers that may block can be
+marked with :func:`blocking`; once an :class:`OrderedExecutor` is set as
+the :attr:`session.Session.executor` they run on its threads instead.
+
+Events with the same key, by default the same channel of the same
+connection, are handled one after another in the order they arrived, so
+a handler never sees the events of a channel out of order.
+
+Example::
+
+    irc.executor = OrderedExecutor(irc, workers=4)
+
+    @register
+    @filters.events('text')
+    @blocking
+    def lookup(high_event):
+        ...
+
+Results are handed back to the Session's thread with
+:meth:`session.Session.post`; :meth:`OrderedExecutor.submit` returns a
+:class:`replies.Future` whose callbacks run there.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import collections
+import threading
+import time
+
+from . import casemapping
+from . import replies
+from . import session
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+
+def by_channel(high_event):
+    """Orders the events of each channel of a connection, and the events
+    without a channel of that connection."""
+    channel = high_event.channel
+    if channel is not None:
+        casemap = getattr(high_event.server, 'casemapping',
+                          casemapping.rfc1459)
+        channel = casemap.fold(channel)
+    return high_event.server, channel
+
+
+def by_server(high_event):
+    """Orders all events of a connection."""
+    return high_event.server
+
+
+def blocking(func=None, key=by_channel):
+    """Marks a handler as one that may block, so that it runs on the
+    :attr:`session.Session.executor`.
+
+    :param key: A function that returns the ordering key of an event;
+                events with the same key are handled in order.
+
+    Can be used as ``@blocking`` or ``@blocking(key=by_server)``.
+    """
+    def decorator(func):
+        func.blocking = key
+        # Filters compiled by register call the undecorated function
+        function, conditions = session._filter_chain(func)
+        if function is not func:
+            function.blocking = key
+        return func
+    if func is None:
+        return decorator
+    return decorator(func)
+
+
+class OrderedExecutor(object):
+    """A pool of worker threads that runs calls in order per key.
+
+    At most `max_pending` calls can wait or run at once; :meth:`submit`
+    blocks until there is room again, which keeps the Session from
+    reading more events than the workers can keep up with.
+    """
+
+    def __init__(self, irclibobj, workers=4, max_pending=1000):
+        self.irclibobj = irclibobj
+        self.max_pending = max_pending
+        self._condition = threading.Condition()
+        # The calls of each key, the first one is running or about to
+        self._queues = {}
+        # The keys whose first call can be started
+        self._ready = collections.deque()
+        self._pending = 0
+        self._closed = False
+
+        #: Amount of calls submitted, finished and failed
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        #: The most calls that were pending at once
+        self.high_water = 0
+        #: How often and how long :meth:`submit` waited for room
+        self.waits = 0
+        self.wait_time = 0.0
+
+        self._threads = []
+        for number in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='irclib-worker-{}'.format(number))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __len__(self):
+        """Returns the amount of calls waiting or running."""
+        return self._pending
+
+    def stats(self):
+        """Returns a dictionary with the backpressure metrics."""
+        with self._condition:
+            return {'pending': self._pending,
+                    'keys': len(self._queues),
+                    'max_pending': self.max_pending,
+                    'high_water': self.high_water,
+                    'submitted': self.submitted,
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time}
+
+    def submit(self, key, function, *arguments):
+        """Calls `function` with `arguments` on a worker thread, after the
+        calls submitted earlier with the same `key`.
+
+        Returns a :class:`replies.Future` that is resolved with the result
+        on the Session's thread.
+        """
+        future = replies.Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The executor has been shut down.")
+            if self._pending >= self.max_pending:
+                start = time.time()
+                self.waits += 1
+                while self._pending >= self.max_pending:
+                    self._condition.wait()
+                self.wait_time += time.time() - start
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = collections.deque()
+                self._ready.append(key)
+            queue.append((function, arguments, future))
+            self._pending += 1
+            self.submitted += 1
+            self.high_water = max(self.high_water, self._pending)
+            self._condition.notify_all()
+        return future
+
+    def shutdown(self, wait=True):
+        """Stops the workers once every submitted call has run."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _work(self):
+        """[Internal] The loop of a worker thread."""
+        while True:
+            with self._condition:
+                while not self._ready and not self._closed:
+                    self._condition.wait()
+                if not self._ready:
+                    return
+                key = self._ready.popleft()
+                function, arguments, future = self._queues[key][0]
+
+            try:
+                result = function(*arguments)
+            except Exception as e:
+                logger.exception('Exception in IRC handler')
+                self.irclibobj.post(future.set_exception, (e,))
+                failed = 1
+            else:
+                self.irclibobj.post(future.set_result, (result,))
+                failed = 0
+
+            with self._condition:
+                queue = self._queues[key]
+                queue.popleft()
+                if queue:
+                    self._ready.append(key)
+                else:
+                    del self._queues[key]
+                self._pending -= 1
+                self.completed += 1
+                self.failed += failed
+                self._condition.notify_all()
@@ -0,0 +1,127 @@
+"""
+Incremental line framing for the byte streams we get from IRC servers and
+DCC CHAT peers.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+
+
+class LineTooLongError(Exception):
+    """Raised when a peer sends more data than fits in a single line."""
+    pass
+
+
+class LineFramer(object):
+    """Splits a byte stream into lines.
+
+    Incoming data is read straight into a preallocated :class:`bytearray`
+    and only the bytes that arrived since the last call are scanned for
+    line terminators, so a long partial line is never copied or searched
+    more than once.
+
+    Lines are yielded as :class:`memoryview` slices of the internal buffer
+    with the terminator stripped. Lines can be terminated by either CR LF
+    or a lone LF, since some IRC servers seem to use \\n only.
+
+    .. warning::
+        The slices are only valid until the next read into the framer;
+        copy them with :meth:`memoryview.tobytes` if you need to keep them.
+    """
+
+    def __init__(self, max_line_length=2**14, read_size=2**14):
+        """Constructor for :class:`LineFramer` objects.
+
+        :param max_line_length: The longest unfinished line we are willing
+                                to buffer. A peer that sends more than this
+                                without a line terminator will cause
+                                :exc:`LineTooLongError` to be raised.
+        :param read_size: The maximum amount of bytes read at once.
+        """
+        self.max_line_length = max_line_length
+        self.read_size = read_size
+        self._buffer = bytearray(max_line_length + read_size)
+        self._view = memoryview(self._buffer)
+        self.reset()
+
+    def reset(self):
+        """Discards all buffered data."""
+        # Start of the unfinished line, end of the valid data and the
+        # position where we should continue looking for a terminator.
+        self._start = 0
+        self._end = 0
+        self._scan = 0
+
+    def __len__(self):
+        """Returns the amount of buffered bytes that are not yet part of
+        a complete line."""
+        return self._end - self._start
+
+    def _make_room(self):
+        """Moves the unfinished line to the front of the buffer if there
+        isn't enough room left for another read behind it."""
+        if self._end + self.read_size <= len(self._buffer):
+            return
+        start, end = self._start, self._end
+        self._buffer[:end - start] = self._buffer[start:end]
+        self._start = 0
+        self._end = end - start
+        self._scan -= start
+
+    def recv_into(self, sock):
+        """Reads data from `sock` directly into the buffer.
+
+        Returns the amount of bytes read; zero means the peer hung up.
+        Call :meth:`lines` afterwards to get the completed lines.
+        """
+        self._make_room()
+        received = sock.recv_into(self._view[self._end:], self.read_size)
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Appends `data` to the buffer and yields the lines it completes.
+
+        This is meant for sources that don't support :meth:`recv_into`,
+        such as SSL objects. Note that this is a generator; `data` is only
+        consumed as the result is iterated over.
+        """
+        view = memoryview(data)
+        for offset in range(0, len(view), self.read_size):
+            chunk = view[offset:offset + self.read_size]
+            self._make_room()
+            self._buffer[self._end:self._end + len(chunk)] = chunk
+            self._end += len(chunk)
+            for line in self.lines():
+                yield line
+
+    def lines(self):
+        """Yields every complete line in the buffer.
+
+        Raises :exc:`LineTooLongError` once the remaining unfinished line
+        grows beyond `max_line_length`.
+        """
+        buf = self._buffer
+        view = self._view
+        end = self._end
+        pos = self._scan
+        while True:
+            newline = buf.find(b"\n", pos, end)
+            if newline < 0:
+                break
+            start = self._start
+            stop = newline
+            if stop > start and buf[stop - 1] == 13:
+                # Strip the CR of a CR LF terminator
+                stop -= 1
+            pos = self._scan = self._start = newline + 1
+            yield view[start:stop]
+
+        if self._start == end:
+            # Everything was consumed, start over at the front.
+            self.reset()
+        else:
+            self._scan = end
+            if end - self._start > self.max_line_length:
+                raise LineTooLongError("Line exceeds {} bytes"
+                                       .format(self.max_line_length))
@@ -0,0 +1,124 @@
+"""
+Module that contains a parsed model of the ISUPPORT (005) features of a
+server.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import re
+
+#: Regex used to split the PREFIX feature into modes and their symbols
+_prefix_regexp = re.compile(r"^\((.*?)\)(.*)$")
+
+
+class ISupport(object):
+    """The features a server announced in its ISUPPORT (005) replies.
+
+    Every derived value is computed once, when :meth:`update` is called
+    for a new 005 line, so that looking them up is a plain attribute and
+    set access.
+
+    The defaults are used until the server says otherwise; the channel
+    modes are taken from Rizon's ircd.
+    """
+
+    #: Features assumed before the server sends its own
+    defaults = {
+        'CHANMODES': 'beI,k,l,BCMNORScimnpstz',
+        'PREFIX': '(qaohv)~&@%+',
+        'CHANTYPES': '#&+!',
+        'MODES': '3',
+        'CASEMAPPING': 'rfc1459',
+    }
+
+    def __init__(self):
+        #: The raw features, as given by the server
+        self.features = dict(self.defaults)
+        self._compile()
+
+    def update(self, tokens):
+        """Updates the features from the tokens of a 005 reply.
+
+        :param tokens: The parameters of the reply, without our own
+                       nickname and the trailing "are supported" text.
+        """
+        for token in tokens:
+            if token.startswith('-'):
+                # The server no longer supports this feature
+                name = token[1:]
+                if name in self.defaults:
+                    self.features[name] = self.defaults[name]
+                else:
+                    self.features.pop(name, None)
+            else:
+                name, _, value = token.partition('=')
+                self.features[name] = value
+        self._compile()
+
+    def _compile(self):
+        """[Internal] Recomputes the derived values from the features."""
+        features = self.features
+
+        chanmodes = (features['CHANMODES'].split(',') + ['', '', '', ''])[:4]
+        #: Modes that always take a parameter (type A, lists)
+        self.list_modes = frozenset(chanmodes[0])
+        #: Modes that always take a parameter (type B)
+        self.param_modes = frozenset(chanmodes[1])
+        #: Modes that only take a parameter when set (type C)
+        self.set_param = frozenset(chanmodes[2])
+        #: Modes that never take a parameter (type D)
+        self.no_param = frozenset(chanmodes[3])
+
+        match = _prefix_regexp.match(features['PREFIX'])
+        if match:
+            modes, symbols = match.groups()
+        else:
+            modes = symbols = ''
+        #: Maps the nickname prefix symbols (like @) to their modes (like o)
+        self.prefix = dict(zip(symbols, modes))
+        #: The modes that are given to nicknames in a channel
+        self.prefix_modes = frozenset(modes)
+        #: The symbols that stand for those modes in NAMES replies
+        self.prefix_symbols = frozenset(symbols)
+
+        #: Modes that always take a parameter, including the prefix modes
+        self.always_param = self.list_modes | self.param_modes | \
+                            self.prefix_modes
+
+        #: The characters channel names can start with
+        self.chantypes = frozenset(features['CHANTYPES'])
+
+        #: How many modes with a parameter may be sent in one MODE command
+        self.modes = _to_int(features['MODES'])
+
+        #: Maximum number of targets per command, None if unlimited
+        self.targmax = {}
+        for item in features.get('TARGMAX', '').split(','):
+            command, _, limit = item.partition(':')
+            if command:
+                self.targmax[command.upper()] = _to_int(limit)
+
+        #: Maximum number of targets for commands not in TARGMAX
+        self.maxtargets = _to_int(features.get('MAXTARGETS', ''))
+
+        #: The maximum length of a nickname
+        self.nicklen = _to_int(features.get('NICKLEN', ''))
+
+        #: The casemapping the server uses to compare names
+        self.casemapping = features['CASEMAPPING'].lower()
+
+    def max_targets(self, command):
+        """Returns how many targets `command` may be sent to at once, or
+        None if there is no known limit."""
+        command = command.upper()
+        if command in self.targmax:
+            return self.targmax[command]
+        return self.maxtargets
+
+
+def _to_int(value):
+    """[Internal] Converts a feature value to an int, None if it is empty."""
+    try:
+        return int(value)
+    except ValueError:
+        return None
@@ -0,0 +1,333 @@
+"""
+Parser that turns lines received from IRC servers into :class:`Message`
+objects.
+
+Lines are parsed in a single pass with plain string methods. Commands and
+numerics are translated into canonical lowercase event names from a lookup
+table, so the same string object is used for every occurrence of a command.
+IRCv3 message tags and the trailing parameter are kept as raw bytes until
+someone reads :attr:`Message.tags` or :attr:`Message.trailing`.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+from . import utils
+
+
+# Numeric table mostly stolen from the Perl IRC module (Net::IRC).
+numeric_events = {
+    "001": "welcome",
+    "002": "yourhost",
+    "003": "created",
+    "004": "myinfo",
+    "005": "featurelist",
+    "200": "tracelink",
+    "201": "traceconnecting",
+    "202": "tracehandshake",
+    "203": "traceunknown",
+    "204": "traceoperator",
+    "205": "traceuser",
+    "206": "traceserver",
+    "207": "traceservice",
+    "208": "tracenewtype",
+    "209": "traceclass",
+    "210": "tracereconnect",
+    "211": "statslinkinfo",
+    "212": "statscommands",
+    "213": "statscline",
+    "214": "statsnline",
+    "215": "statsiline",
+    "216": "statskline",
+    "217": "statsqline",
+    "218": "statsyline",
+    "219": "endofstats",
+    "221": "umodeis",
+    "231": "serviceinfo",
+    "232": "endofservices",
+    "233": "service",
+    "234": "servlist",
+    "235": "servlistend",
+    "241": "statslline",
+    "242": "statsuptime",
+    "243": "statsoline",
+    "244": "statshline",
+    "250": "luserconns",
+    "251": "luserclient",
+    "252": "luserop",
+    "253": "luserunknown",
+    "254": "luserchannels",
+    "255": "luserme",
+    "256": "adminme",
+    "257": "adminloc1",
+    "258": "adminloc2",
+    "259": "adminemail",
+    "261": "tracelog",
+    "262": "endoftrace",
+    "263": "tryagain",
+    "265": "n_local",
+    "266": "n_global",
+    "300": "none",
+    "301": "away",
+    "302": "userhost",
+    "303": "ison",
+    "305": "unaway",
+    "306": "nowaway",
+    "307": "whoisidentified",
+    "311": "whoisuser",
+    "312": "whoisserver",
+    "313": "whoisoperator",
+    "314": "whowasuser",
+    "315": "endofwho",
+    "316": "whoischanop",
+    "317": "whoisidle",
+    "318": "endofwhois",
+    "319": "whoischannels",
+    "321": "liststart",
+    "322": "list",
+    "323": "listend",
+    "324": "channelmodeis",
+    "329": "channelcreate",
+    "331": "notopic",
+    "332": "currenttopic",
+    "333": "topicinfo",
+    "341": "inviting",
+    "342": "summoning",
+    "346": "invitelist",
+    "347": "endofinvitelist",
+    "348": "exceptlist",
+    "349": "endofexceptlist",
+    "351": "version",
+    "352": "whoreply",
+    "353": "namreply",
+    "361": "killdone",
+    "362": "closing",
+    "363": "closeend",
+    "364": "links",
+    "365": "endoflinks",
+    "366": "endofnames",
+    "367": "banlist",
+    "368": "endofbanlist",
+    "369": "endofwhowas",
+    "371": "info",
+    "372": "motd",
+    "373": "infostart",
+    "374": "endofinfo",
+    "375": "motdstart",
+    "376": "endofmotd",
+    "377": "motd2",        # 1997-10-16 -- tkil
+    "381": "youreoper",
+    "382": "rehashing",
+    "384": "myportis",
+    "391": "time",
+    "392": "usersstart",
+    "393": "users",
+    "394": "endofusers",
+    "395": "nousers",
+    "401": "nosuchnick",
+    "402": "nosuchserver",
+    "403": "nosuchchannel",
+    "404": "cannotsendtochan",
+    "405": "toomanychannels",
+    "406": "wasnosuchnick",
+    "407": "toomanytargets",
+    "409": "noorigin",
+    "411": "norecipient",
+    "412": "notexttosend",
+    "413": "notoplevel",
+    "414": "wildtoplevel",
+    "421": "unknowncommand",
+    "422": "nomotd",
+    "423": "noadmininfo",
+    "424": "fileerror",
+    "431": "nonicknamegiven",
+    "432": "erroneusnickname", # Thiss iz how its speld in thee RFC.
+    "433": "nicknameinuse",
+    "436": "nickcollision",
+    "437": "unavailresource",  # "Nick temporally unavailable"
+    "441": "usernotinchannel",
+    "442": "notonchannel",
+    "443": "useronchannel",
+    "444": "nologin",
+    "445": "summondisabled",
+    "446": "usersdisabled",
+    "451": "notregistered",
+    "461": "needmoreparams",
+    "462": "alreadyregistered",
+    "463": "nopermforhost",
+    "464": "passwdmismatch",
+    "465": "yourebannedcreep", # I love this one...
+    "466": "youwillbebanned",
+    "467": "keyset",
+    "471": "channelisfull",
+    "472": "unknownmode",
+    "473": "inviteonlychan",
+    "474": "bannedfromchan",
+    "475": "badchannelkey",
+    "476": "badchanmask",
+    "477": "nochanmodes",  # "Channel doesn't support modes"
+    "478": "banlistfull",
+    "481": "noprivileges",
+    "482": "chanoprivsneeded",
+    "483": "cantkillserver",
+    "484": "restricted",   # Connection is restricted
+    "485": "uniqopprivsneeded",
+    "491": "nooperhost",
+    "492": "noservicehost",
+    "501": "umodeunknownflag",
+    "502": "usersdontmatch",
+}
+
+#: Textual commands we know about, mapped to their event names.
+protocol_commands = [
+    "ACCOUNT",
+    "AUTHENTICATE",
+    "AWAY",
+    "BATCH",
+    "CAP",
+    "CHGHOST",
+    "ERROR",
+    "INVITE",
+    "JOIN",
+    "KICK",
+    "KILL",
+    "MODE",
+    "NICK",
+    "NOTICE",
+    "PART",
+    "PING",
+    "PONG",
+    "PRIVMSG",
+    "QUIT",
+    "SETNAME",
+    "TAGMSG",
+    "TOPIC",
+    "WALLOPS",
+]
+
+#: Maps raw commands as sent by the server to their canonical event names.
+commands = dict((command, command.lower()) for command in protocol_commands)
+commands.update(numeric_events)
+
+#: Escape sequences used in IRCv3 tag values.
+_tag_escapes = {
+    ":": ";",
+    "s": " ",
+    "\\": "\\",
+    "r": "\r",
+    "n": "\n",
+}
+
+
+class Message(object):
+    """A single parsed line from the server.
+
+    :attr:`prefix` is None if the line had no prefix, :attr:`command` is
+    the canonical event name of the command and :attr:`middle` is a list
+    of the parameters before the trailing one. These are decoded while
+    parsing; the trailing parameter is kept as bytes in
+    :attr:`raw_trailing` (None if there is none) and only decoded when
+    :attr:`trailing` or :attr:`params` is read.
+    """
+    __slots__ = ('_tags', 'prefix', 'command', 'middle', 'raw_trailing',
+                 '_trailing', 'encoding')
+
+    def __init__(self, tags, prefix, command, middle, raw_trailing=None,
+                 encoding='utf-8'):
+        self._tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.middle = middle
+        self.raw_trailing = raw_trailing
+        self._trailing = None
+        self.encoding = encoding
+
+    @property
+    def tags(self):
+        """The IRCv3 message tags of this message as a dictionary.
+
+        The tags are only parsed the first time this is accessed.
+        """
+        tags = self._tags
+        if not isinstance(tags, dict):
+            tags = self._tags = parse_tags(tags, self.encoding)
+        return tags
+
+    @property
+    def trailing(self):
+        """The decoded trailing parameter, or None if there is none."""
+        trailing = self._trailing
+        if trailing is None and self.raw_trailing is not None:
+            trailing = self._trailing = utils.decode(self.raw_trailing,
+                                                     self.encoding)
+        return trailing
+
+    @property
+    def params(self):
+        """All the decoded parameters, including the trailing one."""
+        if self.raw_trailing is None:
+            return list(self.middle)
+        return self.middle + [self.trailing]
+
+    def __repr__(self):
+        return "Message({!r}, {!r}, {!r}, {!r}, {!r})".format(
+            self._tags, self.prefix, self.command, self.middle,
+            self.raw_trailing)
+
+
+def parse(line, encoding='utf-8'):
+    """Parses a line of bytes (without line terminator) into a
+    :class:`Message`, using `encoding` for anything that isn't ASCII."""
+    tags = None
+    prefix = None
+    trailing = None
+
+    if line[:1] == b"@":
+        tags, _, line = line[1:].partition(b" ")
+        line = line.lstrip(b" ")
+
+    if b" :" in line:
+        line, _, trailing = line.partition(b" :")
+    line = utils.decode(line, encoding)
+
+    if line[:1] == ":":
+        prefix, _, line = line[1:].partition(" ")
+
+    params = line.split()
+    if params:
+        command = params.pop(0)
+        command = commands.get(command) or command.lower()
+    else:
+        command = ""
+    return Message(tags, prefix, command, params, trailing, encoding)
+
+
+def parse_tags(tags, encoding='utf-8'):
+    """Parses the raw IRCv3 tags part of a message (without the leading
+    @) into a dictionary. Tags without a value are mapped to ''."""
+    result = {}
+    if not tags:
+        return result
+    for tag in utils.decode(tags, encoding).split(";"):
+        if not tag:
+            continue
+        key, sep, value = tag.partition("=")
+        if "\\" in value:
+            value = _unescape_tag_value(value)
+        result[key] = value
+    return result
+
+
+def _unescape_tag_value(value):
+    """[Internal] Undoes the escaping of an IRCv3 tag value."""
+    chars = []
+    escaped = False
+    for ch in value:
+        if escaped:
+            chars.append(_tag_escapes.get(ch, ch))
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        else:
+            chars.append(ch)
+    # A lone backslash at the end is dropped
+    return "".join(chars)
@@ -0,0 +1,216 @@
+"""
+Module that searches a message for many regular expressions at once.
+
+Python's :mod:`re` has no multi-pattern automaton, but a single
+alternation of patterns is scanned in one call, and patterns that are
+anchored to the start of the message are only tried there once the
+anchor is taken out of the alternation. The combined expressions are
+used to find out quickly that none of their patterns match, which is the
+common case for handlers that wait for a trigger. Every pattern in an
+alternation is a named group, so a match also tells which pattern matched;
+only the halves of the alternation without that pattern, the halves of
+those halves and so on are searched again to find the others. The halves
+are compiled the first time they are searched.
+
+Compiled patterns and alternations are cached. The patterns are sorted
+and the alternations are cut where the patterns themselves say, so that a
+set built again with one more pattern only compiles the alternation the
+pattern is added to.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import re
+import sre_constants
+import sre_parse
+
+#: Python 2 refuses expressions with more than 100 groups
+MAX_GROUPS = 99
+
+#: About one in this many patterns ends an alternation, see _combine
+SPREAD = 64
+
+#: The amount of compiled patterns, and of alternations, that are cached
+CACHE_SIZE = 1024
+
+# The compiled patterns and how they can be combined by (type, pattern,
+# flags), and the alternations by (template, flags, patterns)
+_expressions = {}
+_trees = {}
+
+# Backreferences count groups, which breaks when patterns are combined
+_backref_regexp = re.compile(r"\\[1-9]|\(\?P=|\(\?\(")
+
+
+class PatternSet(object):
+    """A set of regular expressions that are searched for together.
+
+    All patterns are compiled with `flags`, like :func:`re.search` would.
+    """
+
+    def __init__(self, patterns, flags=re.I):
+        #: The patterns, :meth:`search` returns indices into this list
+        self.patterns = list(patterns)
+        self.flags = flags
+        prepared = [self._prepare(pattern) for pattern in self.patterns]
+        self._compiled = [compiled for compiled, kind in prepared]
+        # The indices of the combined patterns with their alternation, see
+        # _Node, and the patterns that have to be searched on their own.
+        self._groups = []
+        self._single = []
+
+        anchored, floating = [], []
+        for index, (compiled, kind) in enumerate(prepared):
+            if kind == 'anchored':
+                anchored.append(index)
+            elif kind == 'floating':
+                floating.append(index)
+            else:
+                self._single.append(index)
+        self._combine(anchored, lambda index: self.patterns[index][1:],
+                      '^(?:{})')
+        self._combine(floating, lambda index: self.patterns[index], '{}')
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _prepare(self, pattern):
+        """[Internal] Returns `pattern` compiled and how it can be
+        combined, see :meth:`_classify`."""
+        key = (type(pattern), pattern, self.flags)
+        prepared = _expressions.get(key)
+        if prepared is None:
+            compiled = re.compile(pattern, self.flags)
+            prepared = (compiled, self._classify(pattern, compiled))
+            if len(_expressions) >= CACHE_SIZE:
+                _expressions.clear()
+            _expressions[key] = prepared
+        return prepared
+
+    def _classify(self, pattern, compiled):
+        """[Internal] Returns how `pattern` can be combined: 'anchored' if
+        it only matches at the start, 'floating' if it can be combined
+        as is and None if it can't be combined."""
+        if compiled.groupindex or _backref_regexp.search(pattern):
+            return None
+        try:
+            parsed = sre_parse.parse(pattern, self.flags)
+        except (sre_constants.error, OverflowError):
+            return None
+        if parsed.pattern.flags != self.flags:
+            # Inline flags like (?x) would apply to the whole alternation
+            return None
+        data = parsed.data
+        if pattern.startswith('^') and data and \
+                data[0] == (sre_constants.AT, sre_constants.AT_BEGINNING):
+            return 'anchored'
+        return 'floating'
+
+    def _combine(self, indices, source, template):
+        """[Internal] Builds alternations of the patterns at `indices`,
+        each with fewer groups than Python allows, counting the group that
+        names each pattern.
+
+        The patterns are sorted and an alternation ends after a pattern
+        whose hash is a multiple of :data:`SPREAD`, so that the other
+        alternations stay the same when a pattern is added or removed.
+        """
+        chunks = []
+        chunk, groups = [], 0
+        for index in sorted(indices, key=source):
+            size = self._compiled[index].groups + 1
+            if chunk and groups + size > MAX_GROUPS:
+                chunks.append(chunk)
+                chunk, groups = [], 0
+            chunk.append(index)
+            groups += size
+            if hash(source(index)) % SPREAD == 0:
+                chunks.append(chunk)
+                chunk, groups = [], 0
+        if chunk:
+            chunks.append(chunk)
+
+        for chunk in chunks:
+            sources = tuple(source(index) for index in chunk)
+            key = (template, self.flags, sources)
+            tree = _trees.get(key)
+            if tree is None:
+                tree = _Node(sources, range(len(sources)), template,
+                             self.flags)
+                try:
+                    tree.compile()
+                except (re.error, OverflowError, AssertionError):
+                    self._single.extend(chunk)
+                    continue
+                if len(_trees) >= CACHE_SIZE:
+                    _trees.clear()
+                _trees[key] = tree
+            self._groups.append((chunk, tree))
+
+    def search(self, string):
+        """Returns the set of indices of the patterns found in `string`."""
+        found = set()
+        for chunk, tree in self._groups:
+            # The whole alternation is compiled by _combine
+            if tree.compiled.search(string) is None:
+                continue
+            nodes = [tree]
+            while nodes:
+                node = nodes.pop()
+                match = (node.compiled or node.compile()).search(string)
+                if match is None:
+                    continue
+                halves = node.halves
+                if halves is None:
+                    found.update(chunk[position] for position in node.members)
+                    continue
+                position = int(match.lastgroup[1:])
+                found.add(chunk[position])
+                # The halves on the way down to the pattern that matched
+                # are known to match, the other halves are searched.
+                while halves is not None:
+                    first, second = halves
+                    if position in first.members:
+                        nodes.append(second)
+                        halves = first.halves
+                    else:
+                        nodes.append(first)
+                        halves = second.halves
+        compiled = self._compiled
+        for index in self._single:
+            if compiled[index].search(string) is not None:
+                found.add(index)
+        return found
+
+
+class _Node(object):
+    """[Internal] The alternation of the patterns `sources` at
+    `positions`, and the nodes of both halves of it, if there is more
+    than one pattern.
+
+    The positions are into `sources`, not the indices of a
+    :class:`PatternSet`, so that the node can be shared by sets.
+    """
+    __slots__ = ('expression', 'flags', 'members', 'halves', 'compiled')
+
+    def __init__(self, sources, positions, template, flags):
+        self.flags = flags
+        #: The positions of the patterns in the alternation
+        self.members = frozenset(positions)
+        #: The compiled alternation, once it was needed
+        self.compiled = None
+        if len(positions) == 1:
+            self.expression = template.format(sources[positions[0]])
+            self.halves = None
+            return
+        self.expression = template.format('|'.join(
+            '(?P<p{}>{})'.format(position, sources[position])
+            for position in positions))
+        middle = len(positions) // 2
+        self.halves = (_Node(sources, positions[:middle], template, flags),
+                       _Node(sources, positions[middle:], template, flags))
+
+    def compile(self):
+        """Compiles the alternation and returns it."""
+        self.compiled = re.compile(self.expression, self.flags)
+        return self.compiled
@@ -0,0 +1,214 @@
+"""
+Module that contains the readiness backends the Session uses to wait for
+data on its connections.
+
+Sockets are registered once, when their connection is established, and
+unregistered when it is closed. Waiting for data then only costs time for
+the sockets that are actually ready, instead of for every connection the
+Session has. Connections with output the socket didn't take yet also ask
+to be told when they can write again.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import errno
+import math
+import select
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+
+class Poller(object):
+    """Base class for the readiness backends.
+
+    Maps the file descriptors of registered sockets to their connections;
+    subclasses only have to tell the operating system about them and
+    implement :meth:`poll`.
+    """
+
+    def __init__(self):
+        # Maps file descriptors to connections
+        self.fd_map = {}
+        # Maps sockets to their file descriptors, which can't be asked
+        # from a socket anymore once it is closed
+        self.socket_fds = {}
+        # The descriptors we also wait on to become writable
+        self.write_fds = set()
+
+    def __len__(self):
+        """Returns the amount of registered sockets."""
+        return len(self.fd_map)
+
+    def register(self, socket, conn):
+        """Starts watching `socket`, which belongs to `conn`, for data."""
+        fd = socket.fileno()
+        stale = self.socket_fds.get(socket)
+        if stale is not None and stale != fd:
+            self.unregister(socket)
+        self.socket_fds[socket] = fd
+        self.fd_map[fd] = conn
+        self.write_fds.discard(fd)
+        self._register(fd)
+
+    def unregister(self, socket):
+        """Stops watching `socket`. Unknown sockets are ignored."""
+        fd = self.socket_fds.pop(socket, None)
+        if fd is None:
+            return
+        self.fd_map.pop(fd, None)
+        self.write_fds.discard(fd)
+        try:
+            self._unregister(fd)
+        except (EnvironmentError, ValueError, KeyError):
+            # The descriptor was already closed
+            pass
+
+    def set_writable(self, socket, writable):
+        """Sets whether we want to know when `socket` can be written to."""
+        fd = self.socket_fds.get(socket)
+        if fd is None or (fd in self.write_fds) == writable:
+            return
+        if writable:
+            self.write_fds.add(fd)
+        else:
+            self.write_fds.discard(fd)
+        self._modify(fd, writable)
+
+    def poll(self, timeout):
+        """Waits at most `timeout` seconds for data.
+
+        Returns two lists: the connections that have data to read, or
+        that were hung up on, and the connections that can write again.
+        """
+        try:
+            readable, writable = self._poll(timeout)
+        except (EnvironmentError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return [], []
+            raise
+        fd_map = self.fd_map
+        return ([fd_map[fd] for fd in readable if fd in fd_map],
+                [fd_map[fd] for fd in writable if fd in fd_map])
+
+    def _register(self, fd):
+        pass
+
+    def _unregister(self, fd):
+        pass
+
+    def _modify(self, fd, writable):
+        pass
+
+    def _poll(self, timeout):
+        raise NotImplementedError
+
+    def close(self):
+        """Releases the resources of the poller."""
+        self.fd_map.clear()
+        self.socket_fds.clear()
+        self.write_fds.clear()
+
+
+class SelectPoller(Poller):
+    """Backend using :func:`select.select`, available everywhere but
+    limited to FD_SETSIZE descriptors."""
+
+    def _poll(self, timeout):
+        readable, writable, _ = select.select(list(self.fd_map),
+                                              list(self.write_fds), [],
+                                              timeout)
+        return readable, writable
+
+
+class PollPoller(Poller):
+    """Backend using :func:`select.poll`."""
+
+    _flags = select.POLLIN | select.POLLPRI | select.POLLERR | \
+        select.POLLHUP if hasattr(select, 'poll') else 0
+
+    def __init__(self):
+        super(PollPoller, self).__init__()
+        self._poll_obj = select.poll()
+
+    def _register(self, fd):
+        self._poll_obj.register(fd, self._flags)
+
+    def _unregister(self, fd):
+        self._poll_obj.unregister(fd)
+
+    def _modify(self, fd, writable):
+        self._poll_obj.modify(fd, self._flags | select.POLLOUT if writable
+                              else self._flags)
+
+    def _poll(self, timeout):
+        if timeout is not None:
+            # poll wants milliseconds; round up so that we don't wake
+            # up just before a deadline.
+            timeout = int(math.ceil(timeout * 1000))
+        return _split_events(self._poll_obj.poll(timeout), self._flags,
+                             select.POLLOUT)
+
+
+class EpollPoller(Poller):
+    """Backend using :func:`select.epoll`, only available on Linux."""
+
+    _flags = select.EPOLLIN | select.EPOLLPRI | select.EPOLLERR | \
+        select.EPOLLHUP if hasattr(select, 'epoll') else 0
+
+    def __init__(self):
+        super(EpollPoller, self).__init__()
+        self._epoll = select.epoll()
+
+    def _register(self, fd):
+        try:
+            self._epoll.register(fd, self._flags)
+        except EnvironmentError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            # A closed socket's descriptor was reused
+            self._epoll.modify(fd, self._flags)
+
+    def _unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def _modify(self, fd, writable):
+        self._epoll.modify(fd, self._flags | select.EPOLLOUT if writable
+                           else self._flags)
+
+    def _poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        else:
+            # epoll truncates the timeout to milliseconds; round up so
+            # that we don't wake up just before a deadline.
+            timeout = (math.ceil(timeout * 1000) + 0.5) / 1000
+        return _split_events(self._epoll.poll(timeout), self._flags,
+                             select.EPOLLOUT)
+
+    def close(self):
+        super(EpollPoller, self).close()
+        self._epoll.close()
+
+
+def _split_events(events, read_flags, write_flag):
+    """[Internal] Splits (fd, event) pairs into the readable and the
+    writable descriptors."""
+    readable = []
+    writable = []
+    for fd, event in events:
+        if event & read_flags:
+            readable.append(fd)
+        if event & write_flag:
+            writable.append(fd)
+    return readable, writable
+
+
+def best_poller():
+    """Returns an instance of the most scalable backend available."""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
@@ -0,0 +1,64 @@
+"""
+Module that contains the flood control applied to the messages we send to
+servers.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import time
+
+
+class TokenBucket(object):
+    """A token bucket that limits how fast a connection sends.
+
+    Every line costs `line_cost` tokens plus `byte_cost` tokens per byte.
+    Tokens are refilled continuously at `rate` per second, up to `burst`.
+    A line may be sent as long as the bucket isn't in debt, so a line
+    bigger than the whole bucket still goes out once it is full.
+
+    The defaults allow the same 2500 bytes per 1.3 seconds the Session
+    has always used. A server that counts a penalty per line, like many
+    ircds do, can be matched with `line_cost`.
+    """
+
+    def __init__(self, rate=2500 / 1.3, burst=2500, line_cost=0, byte_cost=1):
+        """Constructor for :class:`TokenBucket` objects.
+
+        :param rate: Tokens added per second.
+        :param burst: The most tokens the bucket holds.
+        :param line_cost: Tokens every line costs.
+        :param byte_cost: Tokens every byte of a line costs.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.line_cost = line_cost
+        self.byte_cost = byte_cost
+        self.tokens = burst
+        self._updated = time.time()
+
+    def _refill(self, now):
+        """[Internal] Adds the tokens that accumulated since the last call."""
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self._updated = now
+
+    def delay(self, now=None):
+        """Returns the seconds until the next line may be sent, 0 if it may
+        be sent right away."""
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def consume(self, size, now=None):
+        """Takes the tokens for a line of `size` bytes that was sent."""
+        if now is None:
+            now = time.time()
+        self._refill(now)
+        self.tokens -= self.line_cost + self.byte_cost * size
+
+    def __repr__(self):
+        return "<TokenBucket {:.0f}/{} tokens>".format(self.tokens, self.burst)
@@ -0,0 +1,379 @@
+"""
+Module that correlates replies from the server with the requests that
+caused them.
+
+Commands like WHOIS, WHO and NAMES are answered with a series of numerics
+that is closed by an end-of-list numeric. Instead of waiting for those,
+the :class:`connection.ServerConnection` methods that send these commands
+return a :class:`Future` that is resolved once the whole answer has been
+received by the Session's loop.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import re
+
+from . import utils, casemapping
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+
+class ReplyError(Exception):
+    """Represents a problem with getting the reply to a request."""
+    pass
+
+class ReplyTimeout(ReplyError):
+    """The server did not answer a request in time."""
+    pass
+
+
+class Future(object):
+    """The result of a request that the server will answer later.
+
+    Replies are processed by the Session's loop, so a Future can't be
+    waited on; register a callback with :meth:`add_done_callback` or check
+    :meth:`done` instead.
+    """
+    def __init__(self):
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """Returns True if the request has been answered or has failed."""
+        return self._done
+
+    def result(self):
+        """Returns the result of the request.
+
+        Raises the exception the request failed with, or :exc:`ReplyError`
+        if it hasn't been answered yet.
+        """
+        if not self._done:
+            raise ReplyError("The request has not been answered yet.")
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        """Returns the exception the request failed with, if any."""
+        return self._exception
+
+    def __nonzero__(self):
+        # A Future in place of a bool, like the result of
+        # ServerConnection.check_identified mistaken for the one of
+        # is_identified, would pass every `if`.
+        raise TypeError("A Future has no truth value, use result() or "
+                        "add_done_callback().")
+
+    def add_done_callback(self, callback):
+        """Calls `callback` with this Future once it is done.
+
+        If it already is, `callback` is called right away.
+        """
+        if self._done:
+            self._call(callback)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        """Marks the request as answered with `result`."""
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        """Marks the request as failed with `exception`."""
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except:
+            logger.exception('Exception in reply callback')
+
+
+class Request(object):
+    """Base class for a request waiting on replies from the server.
+
+    Subclasses list the low level commands they are interested in, decide
+    whether a message belongs to them in :meth:`matches` and collect it in
+    :meth:`feed`, resolving :attr:`future` when they are complete.
+    """
+    #: The commands (event names) of the replies to this request.
+    commands = ()
+    #: If True, matched messages are not dispatched as events.
+    consumes = False
+
+    def __init__(self):
+        self.future = Future()
+        #: The timer that expires the request, if it has a timeout
+        self.timer = None
+
+    def matches(self, message):
+        """Returns True if `message` is part of the reply to this request."""
+        return True
+
+    def feed(self, connection, message):
+        """Collects `message`, which :meth:`matches` accepted."""
+        raise NotImplementedError
+
+    def expire(self):
+        """Called when the request timed out."""
+        self.future.set_exception(ReplyTimeout("No reply from the server."))
+
+
+class WhoisRequest(Request):
+    """Collects the reply to a WHOIS command.
+
+    The result is a dictionary that maps each of the requested nicknames
+    to a dictionary of the information the server gave, or to None if
+    the server says there is no such nick.
+    """
+    commands = ('whoisuser', 'whoisserver', 'whoisoperator', 'whoisidle',
+                'whoischannels', 'whoisidentified', 'away', 'nosuchnick',
+                '330', '671', 'endofwhois')
+
+    def __init__(self, nicks, casemap=casemapping.rfc1459):
+        super(WhoisRequest, self).__init__()
+        self.fold = casemap.fold
+        self.waiting = dict((self.fold(nick), nick) for nick in nicks)
+        self.info = {}
+
+    def matches(self, message):
+        middle = message.middle
+        fold = self.fold
+        return len(middle) > 1 and fold(middle[1]) in self.waiting \
+            or message.command == 'endofwhois' and len(middle) > 1 and \
+            any(fold(nick) in self.waiting for nick in middle[1].split(','))
+
+    def feed(self, connection, message):
+        command = message.command
+        params = message.params
+        if command == 'endofwhois':
+            for nick in params[1].split(','):
+                nick = self.waiting.pop(self.fold(nick), None)
+                if nick is not None:
+                    self.info.setdefault(nick, {})
+            if not self.waiting:
+                self.future.set_result(self.info)
+            return
+
+        nick = self.waiting[self.fold(params[1])]
+        if command == 'nosuchnick':
+            self.info[nick] = None
+            return
+        info = self.info.setdefault(nick, {})
+        if info is None:
+            return
+        if command == 'whoisuser':
+            info['user'] = params[2]
+            info['host'] = params[3]
+            info['realname'] = params[-1]
+        elif command == 'whoisserver':
+            info['server'] = params[2]
+            info['server_info'] = params[-1]
+        elif command == 'whoisoperator':
+            info['operator'] = True
+        elif command == 'whoisidle':
+            info['idle'] = int(params[2])
+            if len(params) > 4:
+                info['signon'] = int(params[3])
+        elif command == 'whoischannels':
+            info.setdefault('channels', []).extend(params[-1].split())
+        elif command == 'whoisidentified':
+            info['identified'] = True
+        elif command == 'away':
+            info['away'] = params[-1]
+        elif command == '330':
+            info['account'] = params[2]
+        elif command == '671':
+            info['secure'] = True
+
+
+class WhoRequest(Request):
+    """Collects the reply to a WHO command.
+
+    The result is a list of dictionaries with the channel, user, host,
+    server, nick, flags, hopcount and realname of each reply.
+    Servers answer WHO requests in order, so replies are simply collected
+    until the first end of WHO numeric.
+    """
+    commands = ('whoreply', 'endofwho')
+
+    def __init__(self):
+        super(WhoRequest, self).__init__()
+        self.users = []
+
+    def feed(self, connection, message):
+        if message.command == 'endofwho':
+            self.future.set_result(self.users)
+            return
+        params = message.params
+        hopcount, _, realname = params[7].partition(' ')
+        self.users.append({'channel': params[1],
+                           'user': params[2],
+                           'host': params[3],
+                           'server': params[4],
+                           'nick': params[5],
+                           'flags': params[6],
+                           'hopcount': hopcount,
+                           'realname': realname})
+
+
+class NamesRequest(Request):
+    """Collects the reply to a NAMES command.
+
+    The result is a dictionary that maps each channel to a dictionary of
+    the nicknames in it and their channel modes (like 'o' or 'v').
+    """
+    commands = ('namreply', 'endofnames')
+
+    def __init__(self, channels, casemap=casemapping.rfc1459):
+        super(NamesRequest, self).__init__()
+        self.fold = casemap.fold
+        # An empty NAMES lists every channel and is ended with '*'
+        self.waiting = dict((self.fold(channel), channel)
+                            for channel in channels or ['*'])
+        self.names = {}
+
+    def matches(self, message):
+        middle = message.middle
+        if message.command == 'namreply':
+            return len(middle) > 2 and ('*' in self.waiting or
+                                        self.fold(middle[2]) in self.waiting)
+        return len(middle) > 1 and self.fold(middle[1]) in self.waiting
+
+    def feed(self, connection, message):
+        params = message.params
+        if message.command == 'endofnames':
+            self.waiting.pop(self.fold(params[1]), None)
+            if not self.waiting:
+                self.future.set_result(self.names)
+            return
+        names = self.names.setdefault(params[2], {})
+        for name in params[3].split():
+            nick = name.lstrip(''.join(connection.prefix))
+            names[nick] = ''.join(connection.prefix[char]
+                                  for char in name[:len(name) - len(nick)])
+
+
+_status_regexp = re.compile(r"STATUS (\S+) (\d)")
+
+
+def parse_status(text):
+    """Parses NickServ's answer to a STATUS query.
+
+    Returns a ``(nick, identified)`` tuple, or None if `text` isn't one.
+    """
+    match = _status_regexp.match(text)
+    if match is None:
+        return None
+    # NickServ will return 2 or 3 if it is identified
+    return match.group(1), match.group(2) in ('2', '3')
+
+
+class IdentityRequest(Request):
+    """Waits for NickServ's answer to a STATUS query.
+
+    The result is True if the nickname is identified. If NickServ doesn't
+    answer in time the result is False.
+    """
+    commands = ('notice',)
+    consumes = True
+
+    def __init__(self, nick, casemap=casemapping.rfc1459):
+        super(IdentityRequest, self).__init__()
+        self.fold = casemap.fold
+        self.nick = self.fold(nick)
+
+    def matches(self, message):
+        if not message.prefix or \
+                self.fold(utils.nm_to_n(message.prefix)) != 'nickserv':
+            return False
+        status = parse_status(message.params[-1])
+        return status is not None and self.fold(status[0]) == self.nick
+
+    def feed(self, connection, message):
+        self.future.set_result(parse_status(message.params[-1])[1])
+
+    def expire(self):
+        self.future.set_result(False)
+
+
+class PendingReplies(object):
+    """The requests of a connection that are waiting for replies."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.requests = []
+        #: Maps the commands pending requests want to how many want them.
+        self.commands = {}
+
+    def add(self, request, callback=None, timeout=None):
+        """Starts waiting for the replies to `request`.
+
+        :param callback: Called with the future once it is done.
+        :param timeout: Seconds after which the request expires.
+
+        Returns the future of the request.
+        """
+        self.requests.append(request)
+        for command in request.commands:
+            self.commands[command] = self.commands.get(command, 0) + 1
+        if callback is not None:
+            request.future.add_done_callback(callback)
+        if timeout is not None:
+            request.timer = self.connection.execute_delayed(
+                timeout, self._expire, (request,))
+        return request.future
+
+    def dispatch(self, message):
+        """Hands `message` to the first request it belongs to.
+
+        Returns True if the message should not be processed any further.
+        """
+        command = message.command
+        for request in self.requests:
+            if command in request.commands and request.matches(message):
+                try:
+                    request.feed(self.connection, message)
+                except Exception as e:
+                    logger.exception('Malformed reply to request')
+                    request.future.set_exception(e)
+                if request.future.done():
+                    self._remove(request)
+                return request.consumes
+        return False
+
+    def fail_all(self, exception):
+        """Fails every pending request with `exception`."""
+        requests, self.requests = self.requests, []
+        self.commands.clear()
+        for request in requests:
+            if request.timer is not None:
+                request.timer.cancel()
+            request.future.set_exception(exception)
+
+    def _remove(self, request):
+        self.requests.remove(request)
+        if request.timer is not None:
+            request.timer.cancel()
+        for command in request.commands:
+            self.commands[command] -= 1
+            if not self.commands[command]:
+                del self.commands[command]
+
+    def _expire(self, request):
+        request.timer = None
+        self._remove(request)
+        request.expire()
@@ -0,0 +1,173 @@
+"""
+Module that contains the queue outgoing messages wait in for the flood
+control to let them out.
+
+Messages are sorted into priority classes, and within a class every
+target gets its turn, so that a burst of messages to one channel doesn't
+hold up everything else that is sent. Messages that say the same thing to
+different targets can be merged into one line when they are taken out.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import collections
+
+#: Registration and other commands the connection depends on
+CONTROL = 0
+#: Channel management, like MODE and KICK
+MODERATION = 1
+#: Messages and commands in reply to users, the default
+INTERACTIVE = 2
+#: Anything that can wait, like announcements to many channels
+BULK = 3
+
+#: All the priority classes, from the most to the least urgent
+priorities = (CONTROL, MODERATION, INTERACTIVE, BULK)
+
+
+class SendQueue(object):
+    """A queue of outgoing messages with priority classes and round-robin
+    fairness across the targets within each class.
+
+    Any thread may :meth:`put` messages, but only one thread may take
+    them out. New messages are appended to a plain deque, which is
+    thread safe, and only sorted into their class by the consumer.
+
+    Messages that are put with the same `key` and priority may be merged
+    by the `merge` function, which is called with two messages and
+    returns their combination, or None if they can't be combined (for
+    example because the result would be too long). A message is only
+    merged into another if it is the next one waiting for its target, so
+    the order of the messages to a target is kept, and only with messages
+    of its own class, so that no message goes out before its turn.
+    """
+
+    def __init__(self, merge=None):
+        self.merge = merge
+        # Messages that still have to be sorted into their class
+        self._incoming = collections.deque()
+        # Per class, the targets with messages in the order they get
+        # their turn, and the entries of each target. An entry is a list
+        # of the message, its key, class and target; the key is set to
+        # None once the entry was taken out.
+        self._turns = [collections.deque() for _ in priorities]
+        self._messages = [{} for _ in priorities]
+        # The entries that may be merged, by key and class and then by
+        # target
+        self._similar = {}
+        self._size = 0
+
+    def put(self, message, priority=INTERACTIVE, target=None, key=None):
+        """Adds `message` for `target` to the queue.
+
+        :param key: Messages with the same key may be merged. None if
+                    the message can't be merged with others.
+        """
+        self._incoming.append([message, key, priority, target])
+
+    def _sort_incoming(self):
+        """[Internal] Moves new messages into their classes."""
+        incoming = self._incoming
+        while incoming:
+            entry = incoming.popleft()
+            message, key, priority, target = entry
+            messages = self._messages[priority]
+            queue = messages.get(target)
+            if queue is None:
+                queue = messages[target] = collections.deque()
+                self._turns[priority].append(target)
+            queue.append(entry)
+            if key is not None and self.merge is not None:
+                similar = self._similar.get((key, priority))
+                if similar is None:
+                    similar = self._similar[(key, priority)] = \
+                        collections.OrderedDict()
+                entries = similar.get(target)
+                if entries is None:
+                    entries = similar[target] = collections.deque()
+                entries.append(entry)
+            self._size += 1
+
+    def get(self):
+        """Removes and returns the next message to send.
+
+        Raises :exc:`IndexError` if the queue is empty.
+        """
+        self._sort_incoming()
+        for turns, messages in zip(self._turns, self._messages):
+            if turns:
+                target = turns.popleft()
+                queue = messages[target]
+                entry = queue.popleft()
+                if queue:
+                    # Back of the line for the other targets
+                    turns.append(target)
+                else:
+                    del messages[target]
+                self._size -= 1
+                if entry[1] is not None and self.merge is not None:
+                    return self._merge_similar(entry)
+                return entry[0]
+        raise IndexError("get from an empty SendQueue")
+
+    def _merge_similar(self, entry):
+        """[Internal] Takes the entries with the same key and class as
+        `entry` out of the queue while they can be merged into its
+        message."""
+        message, key, priority = entry[0], entry[1], entry[2]
+        entry[1] = None
+        similar = self._similar.get((key, priority))
+        if similar is None:
+            return message
+        for target, entries in list(similar.items()):
+            while entries and entries[0][1] is None:
+                entries.popleft()
+            if not entries:
+                del similar[target]
+                continue
+            if target == entry[3]:
+                continue
+            other = entries[0]
+            queue = self._messages[priority][target]
+            if queue[0] is not other:
+                continue
+            merged = self.merge(message, other[0])
+            if merged is None:
+                break
+            message = merged
+            other[1] = None
+            entries.popleft()
+            if not entries:
+                del similar[target]
+            queue.popleft()
+            if not queue:
+                del self._messages[priority][target]
+                self._turns[priority].remove(target)
+            self._size -= 1
+        if not similar:
+            del self._similar[(key, priority)]
+        return message
+
+    def empty(self):
+        """Returns True if there are no messages waiting."""
+        return not self._size and not self._incoming
+
+    def qsize(self):
+        """Returns the amount of messages waiting."""
+        self._sort_incoming()
+        return self._size
+
+    __len__ = qsize
+
+    def clear(self):
+        """Removes every message and returns them, most urgent first.
+
+        The messages are returned as they were put, without merging them.
+        """
+        merge, self.merge = self.merge, None
+        removed = []
+        while not self.empty():
+            removed.append(self.get())
+        self._similar.clear()
+        self.merge = merge
+        return removed
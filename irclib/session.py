@@ -8,6 +8,10 @@ from __future__ import absolute_import
 from . import utils
 from . import connection
 from . import dcc
+from . import casemapping
+from . import timers
+from .patterns import PatternSet
+from .poller import best_poller
 
 from . import logger
 import logging
@@ -16,10 +20,11 @@ logger.setLevel(logging.DEBUG)
 
 import time
 import select
-import bisect
+import socket
 import collections
 import re
 import weakref
+import functools
 
 # TODO: move this somewhere else
 DEBUG = 0
@@ -46,6 +51,18 @@ high_level_events = ['connect',
                      'raw'
                      ]
 
+#: Low level events that turn into a differently named high level event.
+#: Anything not in here keeps its name.
+high_level_names = {'welcome': 'connect',
+                    'pubmsg': 'text',
+                    'pubnotice': 'text',
+                    'privmsg': 'text',
+                    'privnotice': 'text',
+                    'currenttopic': 'topic',
+                    'notopic': 'topic',
+                    'all_raw_messages': 'raw',
+                    }
+
 class Session:
     """Class that handles one or several IRC server connections.
 
@@ -53,14 +70,14 @@ class Session:
     Connection objects that represent the IRC connections.  The
     responsibility of the Session object is to provide a high-level
     event-driven framework for the connections and to keep the connections
-    alive. It runs a select loop to poll each connection's TCP socket and
-    hands over the sockets with incoming data for processing by the
-    corresponding connection. It then encapsulates the low level IRC
+    alive. It waits for data on each connection's TCP socket with a
+    :class:`poller.Poller` and hands over the sockets with incoming data
+    for processing by the corresponding connection. It then encapsulates the low level IRC
     events generated by the Connection objects into higher level
     versions.
     """
 
-    def __init__(self, encoding='utf-8', handle_ctcp=True):
+    def __init__(self, encoding='utf-8', handle_ctcp=True, poller=None):
         """Constructor for :class:`Session` objects.
 
         :param encoding: The encoding that we should treat the incoming data as.
@@ -68,6 +85,9 @@ class Session:
                             common CTCP commands like VERSION and PING
                             on its own. It will still generate high level
                             events.
+        :param poller: The :class:`poller.Poller` used to wait for data.
+                       By default the most scalable one the platform
+                       supports is used (epoll, poll or select).
 
         See :meth:`process_once` for information on how to run the Session
         object.
@@ -75,20 +95,54 @@ class Session:
 
         self.connections = []
         self.socket_map = weakref.WeakKeyDictionary()
-        self.delayed_commands = [] # list of tuples in the format (time, function, arguments)
+        if poller is None:
+            poller = best_poller()
+        self.poller = poller
+        #: The calls scheduled with :meth:`execute_delayed` and friends
+        self.timers = timers.Scheduler()
+        # When the flood protection lets queued messages out again, if
+        # any are waiting
+        self._send_deadline = None
+        # The connections that may have messages in their message_queue,
+        # see queued()
+        self._send_ready = set()
+        # True while process_once is waiting for data
+        self._polling = False
+        # Set by wakeup(), so that process_once doesn't start waiting when
+        # something was queued after it last looked
+        self._wake_pending = False
+        # Calls posted by other threads, see post()
+        self._posted = collections.deque()
+        #: Runs the handlers marked with :func:`executor.blocking` on
+        #: worker threads, if set to an :class:`executor.OrderedExecutor`.
+        #: By default every handler runs on the Session's thread.
+        self.executor = None
+        self._waker = self._create_waker()
         self.encoding = encoding
         self.handle_ctcp = handle_ctcp
 
+        # Low level events the Session needs itself, whether or not any
+        # handler is interested in them.
+        self.internal_events = set(['ping'])
+        if handle_ctcp:
+            self.internal_events.add('ctcp')
+
         # CTCP response values
         #: Used to respond to CTCP VERSION messages.
         self.ctcp_version = "Hanyuu IRC Lib 1.3"
         #: Used to respond to CTCP SOURCE messages.
         self.ctcp_source = "https://github.com/R-a-dio/Hanyuu-sama/"
 
-    def server(self):
-        """Creates and returns a :class:`connection.ServerConnection` object."""
+    def server(self, rate_limiter=None):
+        """Creates and returns a :class:`connection.ServerConnection` object.
 
-        c = connection.ServerConnection(self)
+        :param rate_limiter: The flood control for the messages sent with
+                             :meth:`connection.ServerConnection.send_raw`;
+                             a :class:`ratelimit.TokenBucket` with its
+                             defaults if not given.
+        """
+
+        c = connection.ServerConnection(self, rate_limiter)
         self.connections.append(c)
         return c
 
@@ -108,100 +162,157 @@ class Session:
 
         .. seealso:: :meth:`process_once`
         """
-        t = time.time()
-        while self.delayed_commands:
-            if t >= self.delayed_commands[0][0]:
-                self.delayed_commands[0][1](*self.delayed_commands[0][2])
-                del self.delayed_commands[0]
-            else:
-                break
+        self.timers.run_due(time.time())
 
     def _send_once(self):
         """This method will send data to the servers from the message queue
-        at a limited rate. The default is 2500 bytes per 1.3 seconds. This
-        value cannot currently be changed.
+        at the rate the :attr:`rate_limiter` of each connection allows.
+
+        Nothing is taken from the queue of a connection whose socket still
+        has to take earlier output. Only the connections that said they
+        have messages queued (see :meth:`queued`) are looked at.
+
+        Returns the time at which the flood protection allows sending the
+        messages that are still queued, or None if every queue is empty.
 
         .. warning::
             This method is internal and should not be called manually.
         """
-
-        for c in self.connections:
-            try:
-                delta = time.time() - c.last_time
-            except (AttributeError):
+        deadline = None
+        now = time.time()
+        ready = self._send_ready
+        # A copy, other threads may queue messages while we send
+        for c in list(ready):
+            # Taken out before its queue is checked, so that a message
+            # queued by another thread after the check puts it back
+            ready.discard(c)
+            if c.socket is None:
+                # Whatever is left goes out after a reconnect
                 continue
-            c.last_time = time.time()
-            c.send_time += delta
-            if c.send_time >= 1.3:
-                c.send_time = 0
-                c.sent_bytes = 0
-
-            while not c.message_queue.empty():
-                if c.sent_bytes <= 2500:
-                    message = c.message_queue.get()
-                    try:
-                        if c.ssl:
-                            c.send_raw_instant(message)
-                        else:
-                            c.send_raw_instant(message)
-                    except (AttributeError):
-                        c.reconnect()
-                    c.sent_bytes += len(message.encode('utf-8'))
-                    if DEBUG:
-                        logger.debug("TO SERVER:" + message)
-                else:
+            limiter = c.rate_limiter
+
+            while not c.message_queue.empty() and not c.out_buffer:
+                delay = limiter.delay(now)
+                if delay:
+                    if deadline is None or now + delay < deadline:
+                        deadline = now + delay
                     break
+                message = c.message_queue.get()
+                try:
+                    size = c.send_raw_instant(message)
+                except (AttributeError):
+                    c.reconnect()
+                    continue
+                limiter.consume(size, now)
+            if not c.message_queue.empty():
+                ready.add(c)
+        return deadline
 
     def process_once(self, timeout=0):
         """Process data from connections once.
 
-        :param timeout: How long the select() call should wait if no
-                        data is available.
+        :param timeout: How long we should wait if no data is available.
 
         This method should be called periodically to check and process
         incoming and outgoing data, if there is any.
 
-        It calls :meth:`process_data`, :meth:`_send_once` and
-        :meth:`process_timeout`.
-
-        It will also examine when we last received data from the server; if it
-        exceeds a specified time limit, the Session assumes that we have lost
-        connection to the server and will attempt to reconnect us.
+        It calls :meth:`process_data`, the calls made with :meth:`post`,
+        :meth:`process_timeout` and :meth:`_send_once`.
 
         If calling it manually seems boring, look at the
         :meth:`process_forever` method.
         """
-        sockets = [conn._get_socket() for conn in self.connections
-                   if conn._get_socket() is not None]
-        if sockets:
-            (i, o, e) = select.select(sockets, [], [], timeout)
-            # Process incoming data
-            self.process_data(i)
-        else:
-            time.sleep(timeout)
-        _current_time = time.time()
-        for connection in self.connections:
-            try:
-                _difference = _current_time - connection._last_ping
-            except (AttributeError):
-                continue
-            if (_difference >= 260.0):
-                logger.info("No data in the past 260 seconds, disconnect")
-                connection.reconnect("Ping timeout: 260 seconds")
-        # Send outgoing data
-        self._send_once()
+        readable = writable = ()
+        self._polling = True
+        try:
+            if self._posted or self._wake_pending:
+                # Queued before we started waiting, nobody woke us up
+                timeout = 0
+            if self.poller:
+                readable, writable = self.poller.poll(timeout)
+            else:
+                time.sleep(timeout)
+        finally:
+            self._polling = False
+        # Continue sending what the sockets didn't take before
+        for conn in writable:
+            conn.process_write()
+        # Process incoming data
+        for conn in readable:
+            conn.process_data()
+        # Run what other threads posted
+        self._run_posted()
         # Check delayed calls
         self.process_timeout()
+        # What is queued from here on has to wake up the next wait
+        self._wake_pending = False
+        # Send outgoing data, including what the delayed calls queued
+        self._send_deadline = self._send_once()
+
+    def next_deadline(self):
+        """Returns the time at which the Session has something to do even
+        if no data arrives, or None if it can wait for data forever.
 
-    def process_forever(self, timeout=0.2):
+        That is when the next delayed call is due, or when the flood
+        protection lets queued messages out.
+        """
+        deadline = self.timers.next_deadline()
+        if self._send_deadline is not None and \
+                (deadline is None or self._send_deadline < deadline):
+            deadline = self._send_deadline
+        return deadline
+
+    def process_forever(self, timeout=None):
         """Run an infinite loop, processing data from connections.
 
-        This method repeatedly calls :meth:`process_once`.
+        This method repeatedly calls :meth:`process_once`, waiting for data
+        until the next deadline (see :meth:`next_deadline`).
 
-        :param timeout: Parameter to pass to process_once.
+        :param timeout: The longest time to wait at once, or None to only
+                        wake up for data and deadlines.
         """
+        if self._waker is None and timeout is None:
+            # Messages queued by other threads can't wake us up
+            timeout = 0.2
         while 1:
-            self.process_once(timeout)
+            wait = timeout
+            deadline = self.next_deadline()
+            if deadline is not None:
+                wait = max(deadline - time.time(), 0)
+                if timeout is not None:
+                    wait = min(wait, timeout)
+            self.process_once(wait)
+
+    def wakeup(self):
+        """Interrupts :meth:`process_once` while it waits for data.
+
+        Connections call this when they queue a message, which another
+        thread may do while the Session is waiting. If it isn't waiting
+        yet, the next :meth:`process_once` doesn't wait at all.
+        """
+        self._wake_pending = True
+        if self._polling and self._waker is not None:
+            self._waker.wake()
+
+    def post(self, function, arguments=()):
+        """Calls `function` with `arguments` on the thread that runs the
+        Session, as soon as possible.
+
+        This may be called from any thread; it is how results of work
+        done on other threads should be handed back to the Session.
+        """
+        self._posted.append((function, arguments))
+        self.wakeup()
+
+    def _run_posted(self):
+        """[Internal] Runs the calls that were posted so far."""
+        posted = self._posted
+        for _ in range(len(posted)):
+            function, arguments = posted.popleft()
+            try:
+                function(*arguments)
+            except:
+                logger.exception('Exception in posted call')
 
     def disconnect_all(self, message=""):
         """Disconnects all connections.
@@ -217,8 +328,10 @@ class Session:
         :param at: Time to execute at (standard \"time_t\" time).
         :param function: The function to call.
         :param arguments: Arguments to give the function.
+
+        Returns a :class:`timers.Timer` that can be cancelled.
         """
-        self.execute_delayed(at-time.time(), function, arguments)
+        return self.timers.call_at(at, function, arguments)
 
     def execute_delayed(self, delay, function, arguments=()):
         """Execute a function after a specified time.
@@ -226,9 +339,21 @@ class Session:
         :param delay: How many seconds to wait.
         :param function: The function to call.
         :param arguments: Arguments to give the function.
+
+        Returns a :class:`timers.Timer` that can be cancelled.
         """
-        bisect.insort(self.delayed_commands,
-                      (delay+time.time(), function, arguments))
+        return self.timers.call_at(delay+time.time(), function, arguments)
+
+    def execute_every(self, period, function, arguments=()):
+        """Execute a function every `period` seconds, until the returned
+        :class:`timers.Timer` is cancelled.
+
+        :param period: How many seconds to wait between calls.
+        :param function: The function to call.
+        :param arguments: Arguments to give the function.
+        """
+        return self.timers.call_repeating(period+time.time(), period,
+                                          function, arguments)
 
     def dcc(self, dcctype="chat", dccinfo=(None, 0)):
         """Creates and returns a :class:`dcc.DCCConnection` object.
@@ -242,10 +367,58 @@ class Session:
         self.connections.append(c)
         return c
 
+    def _create_waker(self):
+        """[Internal] Returns the :class:`_Waker` that :meth:`wakeup` uses,
+        registered with the poller, or None if there is none."""
+        waker = _Waker.create()
+        if waker is not None:
+            self.poller.register(waker.socket, waker)
+        return waker
+
     def register_socket(self, socket, conn):
         """Internal method used to map the sockets on
         :class:`connection.Connection` to the connections themselves."""
         self.socket_map[socket] = conn
+        self.poller.register(socket, conn)
+
+    def queued(self, conn):
+        """Internal method used by connections to say that they queued a
+        message, which :meth:`_send_once` sends once the flood protection
+        of `conn` allows it."""
+        self._send_ready.add(conn)
+        self.wakeup()
+
+    def want_write(self, conn, writable):
+        """Internal method used by connections to ask to be told (through
+        their process_write method) when their socket can be written to."""
+        socket = conn._get_socket()
+        if socket is not None:
+            self.poller.set_writable(socket, writable)
+
+    def unregister_socket(self, socket):
+        """Internal method used to stop waiting for data on a socket,
+        before it is closed."""
+        self.socket_map.pop(socket, None)
+        self.poller.unregister(socket)
+
+    def wants(self, eventtype):
+        """Returns True if low level events of `eventtype` are needed, either
+        by the Session itself or by a registered handler.
+
+        Connections use this to avoid building events that nobody will
+        look at; they still do their own bookkeeping for those lines.
+        """
+        return eventtype in self.internal_events or self.subscribed(eventtype)
+
+    def subscribed(self, eventtype):
+        """Returns True if a registered handler is interested in the high
+        level version of the low level `eventtype`.
+
+        .. seealso:: :data:`Session.interests`
+        """
+        interests = Session.interests
+        return (None in interests or
+                high_level_names.get(eventtype, eventtype) in interests)
 
     def _handle_event(self, server, event):
         """Internal event handler.
@@ -265,49 +438,53 @@ class Session:
             except:
                 logger.exception('Error in CTCP handler')
 
-        # Preparse MODE events, we want them separate in high level
+        if not self.subscribed(event.eventtype):
+            return
+
+        # MODE events are separate per mode in high level
         if event.eventtype in ['mode', 'umode']:
-            modes = server._parse_modes(' '.join(event.argument))
+            modes = _event_modes(server, event)
             # do we have more than 1 mode? split and rehandle
             if len(modes) > 1:
-                for sign, mode, param in modes:
-                    # if the parameter is empty, make it blank
-                    # otherwise the joining breaks later on
-                    if not param:
-                        param = ''
+                for change in modes:
+                    sign, mode, param = change
+                    # The changes were parsed already, the arguments are
+                    # only there for handlers that read them
                     new_event = connection.Event(event.eventtype,
                                                  event.source,
                                                  event.target,
-                                                 [sign+mode, param])
+                                                 [sign+mode, param or ''],
+                                                 modes=[change])
                     # Reraise the individual events as low level
                     self._handle_event(server, new_event)
-                # If we had to preparse, end here
+                # If we had to split, end here
                 return
 
         # Rebuild the low level event into a high level one
         high_event = HighEvent.from_low_event(server, event)
 
-        handlers = Session.handlers
+        for function in Session.handler_index.lookup(high_event):
+            self._call_handler(function, high_event)
 
-        command = high_event.command
-        channel = high_event.channel
-        nickname = high_event.nickname
-        message = high_event.message
+    def _call_handler(self, function, high_event):
+        """Calls the handler `function` with `high_event`.
 
-        if channel:
-            channel = channel.lower()
-        if nickname:
-            nickname = nickname.name.lower()
-
-        for function in handlers.values():
-            try:
-                function(high_event)
-            except:
-                logger.exception('Exception in IRC handler')
+        Handlers marked with :func:`executor.blocking` are handed to the
+        :attr:`executor` instead, if there is one.
+        """
+        key = getattr(function, 'blocking', None)
+        if key is not None and self.executor is not None:
+            self.executor.submit(key(high_event), function, high_event)
+            return
+        try:
+            function(high_event)
+        except:
+            logger.exception('Exception in IRC handler')
 
     def _remove_connection(self, connection):
         """Removes a connection from the connection list."""
         self.connections.remove(connection)
+        self._send_ready.discard(connection)
 
     def _ping_ponger(self, connection, event):
         """Internal responder to PING events."""
@@ -346,88 +523,240 @@ class Session:
 
 #: Global high level event handler container.
 Session.handlers = {}
+#: The high level event types that registered handlers are interested in.
+#: Contains None if there is a handler that wants every event.
+#: This is kept up to date by :func:`register` and :func:`unregister`.
+Session.interests = set()
+
+class _Waker(object):
+    """A socket pair that lets other threads interrupt the poller.
+
+    It is registered with the poller like a connection.
+    """
+
+    def __init__(self, reader, writer):
+        self.socket = reader
+        self._writer = writer
+        self._woken = False
+
+    @classmethod
+    def create(cls):
+        """Returns a new _Waker, or None if the platform has no socket
+        pairs."""
+        if not hasattr(socket, 'socketpair'):
+            return None
+        reader, writer = socket.socketpair()
+        reader.setblocking(0)
+        writer.setblocking(0)
+        return cls(reader, writer)
+
+    def wake(self):
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            self._writer.send(b"\0")
+        except socket.error:
+            pass
+
+    def process_data(self):
+        # Only allow new wakeups once every byte is read; a wake() before
+        # that would write a byte we read here and be lost.
+        while True:
+            try:
+                if not self.socket.recv(512):
+                    break
+            except socket.error:
+                break
+        self._woken = False
+
+
+#: Placeholder for a message that hasn't been read from the low level event.
+_unread = object()
+
+#: The low level events that are turned into text events
+_text_commands = frozenset(['pubmsg', 'pubnotice', 'privmsg', 'privnotice'])
+
+class _optional(object):
+    """[Internal] An optional field of :class:`HighEvent`.
+
+    It is computed from the low level event the first time it is read, by
+    `compute`, which returns None for events that don't have the field.
+    Its value is kept in the slot of the same name with an underscore in
+    front.
+    """
+    def __init__(self, compute):
+        self.compute = compute
+        self.name = compute.__name__
+        self.slot = '_' + compute.__name__
+        self.__doc__ = compute.__doc__
+
+    def __get__(self, event, owner):
+        if event is None:
+            return self
+        slot = self.slot
+        value = getattr(event, slot, _unread)
+        if value is _unread:
+            low_event = event._low_event
+            value = None
+            if low_event is not None:
+                value = self.compute(event, low_event)
+            setattr(event, slot, value)
+        return value
+
+    def __set__(self, event, value):
+        setattr(event, self.slot, value)
+
 
 class HighEvent(object):
     """
     A abstracted event of the IRC library.
-    """
-    def __init__(self, server, command, nickname, channel, message):
-        super(HighEvent, self).__init__()
 
+    Only the fields every event has are set when it is created; the
+    optional ones, listed in :attr:`optional_fields`, are read from the
+    low level event when they are first used and are None for events
+    that don't have them. Handlers can still add attributes of their own.
+    """
+    # The __dict__ holds the attributes handlers add, like the trigger of
+    # a commands.CommandRouter. Python only allocates it when the first
+    # one is set; until then it costs a pointer, 8 of the 240 bytes an
+    # event takes in benchmarks/bench_events.py.
+    __slots__ = ('server', 'command', 'nickname', 'channel', '_message',
+                 '_low_event', '_text_command', '_ctcp', '_kicker',
+                 '_new_nickname', '_server_name', '_modes', '_source',
+                 '_target', '__dict__', '__weakref__')
+
+    #: The fields that are only computed when they are read
+    optional_fields = ('text_command', 'ctcp', 'kicker', 'new_nickname',
+                       'server_name', 'modes', 'source', 'target')
+
+    def __init__(self, server, command, nickname, channel, message,
+                 low_event=None):
         self.command = command
         self.nickname = nickname
         self.server = server
         self.channel = channel
-        self.message = message
+        self._message = message
+        self._low_event = low_event
+
+    @property
+    def message(self):
+        """The message of the event, if any.
+
+        For text, quit and raw events this is only decoded the first time
+        it is read.
+        """
+        message = self._message
+        if message is _unread:
+            arguments = self._low_event.argument
+            message = self._message = arguments[0] if arguments else None
+        return message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+
+    def _defer_message(self, low_event):
+        """[Internal] Makes :attr:`message` the first argument of `low_event`,
+        without reading (and thus decoding) it until it is needed."""
+        self._message = _unread
+        self._low_event = low_event
+
+    @_optional
+    def text_command(self, low_event):
+        """The low level command of a text event: 'pubmsg', 'pubnotice',
+        'privmsg' or 'privnotice'."""
+        if low_event.eventtype in _text_commands:
+            return low_event.eventtype
+
+    @_optional
+    def ctcp(self, low_event):
+        """The CTCP command of a ctcp or ctcpreply event."""
+        if low_event.eventtype in ('ctcp', 'ctcpreply'):
+            # The irclib splits off the first space delimited word for us.
+            return low_event.argument[0]
+
+    @_optional
+    def kicker(self, low_event):
+        """The :class:`Nickname` of who kicked someone in a kick event."""
+        if low_event.eventtype == 'kick':
+            return Nickname(low_event.source)
+
+    @_optional
+    def new_nickname(self, low_event):
+        """The :class:`Nickname` after a nick change, with the host of the
+        old one."""
+        if low_event.eventtype == 'nick':
+            # We cheat here by using the original host and replacing the
+            # name attribute with our new nickname.
+            new_nickname = Nickname(low_event.source)
+            new_nickname.name = low_event.target
+            return new_nickname
+
+    @_optional
+    def server_name(self, low_event):
+        """The name of the server, for connect and raw events."""
+        if low_event.eventtype in ('welcome', 'all_raw_messages'):
+            return low_event.source
+
+    @_optional
+    def modes(self, low_event):
+        """The ``(operation, mode, param)`` tuple of a mode or umode event,
+        or a list of them if it changed more than one mode."""
+        if low_event.eventtype in ('mode', 'umode'):
+            # ServerConnection._parse_modes returns a list of tuples with
+            # (operation, mode, param)
+            # HOWEVER, Session._handle_event splits the modes, so we
+            # (preferably) only want the first one. Let's make sure we can
+            # still get all of them, though
+            modes = _event_modes(self.server, low_event)
+            if len(modes) > 1:
+                return modes
+            return modes[0] if modes else None
+
+    @_optional
+    def source(self, low_event):
+        """The source of the low level event."""
+        return low_event.source
+
+    @_optional
+    def target(self, low_event):
+        """The target of the low level event."""
+        return low_event.target
 
     @classmethod
     def from_low_event(cls, server, low_event):
         """Generates a high level event from a low level one."""
         command = low_event.eventtype
 
-        # We supply the source and server already to reduce code repetition.
-        # Just use it as the HighEvent constructor but with partial applied.
-        creator = lambda *args, **kwargs: cls(server,
-                                              command,
-                                              *args,
-                                              **kwargs)
-
         if command == 'welcome':
             # We treat this as a "connected" event
-            # The name of the server we are connected to
-            server_name = low_event.source
             # Our nickname - this might be different than the one we wanted!
             nickname = Nickname(low_event.target, nickname_only=True)
             # The welcome message
             message = low_event.argument[0]
-
-            event = creator(nickname, None, message)
-            event.command = 'connect'
-            event.server_name = server_name
-            return event
+            return cls(server, 'connect', nickname, None, message, low_event)
         elif command == 'nick':
-            # A nickname change.
+            # A nickname change, the new one is in new_nickname.
             old_nickname = Nickname(low_event.source)
-
-            # We cheat here by using the original host and replacing the
-            # name attribute with our new nickname.
-            new_nickname = Nickname(low_event.source)
-            new_nickname.name = low_event.target
-
-            event = creator(old_nickname, None, None)
-            event.new_nickname = new_nickname
-            return event
+            return cls(server, command, old_nickname, None, None, low_event)
         elif command in ["pubmsg", "pubnotice"]:
             # A channel message
             nickname = Nickname(low_event.source)
             channel = low_event.target
-            message = low_event.argument[0]
-            event = creator(nickname, channel, message)
-            event.text_command = command
-            event.command = 'text'
-            return event
+            return cls(server, 'text', nickname, channel, _unread, low_event)
         elif command in ["privmsg", "privnotice"]:
             # Private message
             # The target is set to our own nickname in privmsg.
             nickname = Nickname(low_event.source)
-            message = low_event.argument[0]
-            event = creator(nickname, None, message)
-            event.text_command = command
-            event.command = 'text'
-            return event
-        elif command == 'ctcp':
-            # A CTCP to us.
+            return cls(server, 'text', nickname, None, _unread, low_event)
+        elif command in ['ctcp', 'ctcpreply']:
+            # A CTCP to us, or a reply to one.
             # Same as privmsg/notice the target is our own nickname
             nickname = Nickname(low_event.source)
-            # The irclib splits off the first space delimited word for us.
-            # This is the CTCP command name
-            ctcp = low_event.argument[0]
-            # The things behind the command are then indexed behind it.
+            # The things behind the CTCP command are indexed behind it.
             message = ' '.join(low_event.argument[1:])
-
-            event = creator(nickname, None, message)
-            event.ctcp = ctcp
-            return event
+            return cls(server, command, nickname, None, message, low_event)
         elif command == 'action':
             # ACTION CTCP are parsed differently than others (for some reason)
             nickname = Nickname(low_event.source)
@@ -438,54 +767,25 @@ class HighEvent(object):
                 channel = None
             # Message is in the argument
             message = low_event.argument[0]
-
-            event = creator(nickname, channel, message)
-            return event
-        elif command == 'ctcpreply':
-            # A CTCP reply.
-            # Same as privmsg/notice the target is our own nickname
-            nickname = Nickname(low_event.source)
-            # The irclib splits off the first space delimited word for us.
-            # This is the CTCP command name
-            ctcp = low_event.argument[0]
-            # The things behind the command are then indexed behind it.
-            message = ' '.join(low_event.argument[1:])
-
-            event = creator(nickname, None, message)
-            event.ctcp = ctcp
-            return event
+            return cls(server, command, nickname, channel, message, low_event)
         elif command == 'quit':
             # A quit from an user.
             nickname = Nickname(low_event.source)
-            message = low_event.argument[0]
-
-            return creator(nickname, None, message)
-        elif command == 'join':
-            # Someone joining our channel
+            return cls(server, command, nickname, None, _unread, low_event)
+        elif command in ['join', 'part']:
+            # Someone joining or leaving our channel
             nickname = Nickname(low_event.source)
             channel = low_event.target
-
-            return creator(nickname, channel, None)
-        elif command == 'part':
-            # Someone leaving our channel
-            nickname = Nickname(low_event.source)
-            channel = low_event.target
-
-            return creator(nickname, channel, None)
+            return cls(server, command, nickname, channel, None, low_event)
         elif command == 'kick':
-            # Someone forcibly leaving our channel.
-            # The person kicking here
-            kicker = Nickname(low_event.source)
+            # Someone forcibly leaving our channel, the kicker is in kicker.
             # The person being kicked
             target = Nickname(low_event.argument[0], nickname_only=True)
             # The reason given by the kicker
             reason = low_event.argument[1]
             # The channel this all went wrong in!
             channel = low_event.target
-
-            event = creator(target, channel, reason)
-            event.kicker = kicker
-            return event
+            return cls(server, command, target, channel, reason, low_event)
         elif command == 'invite':
             # Someone has invited us to a channel.
             # The inviter
@@ -493,25 +793,15 @@ class HighEvent(object):
             # Target contains our nickname
             # First argument is the channel we were invited to
             channel = low_event.argument[0]
-            return creator(nickname, channel, None)
+            return cls(server, command, nickname, channel, None, low_event)
         elif command in ['mode', 'umode']:
-            # Mode change in the channel
+            # Mode change in the channel, the changes are in modes.
             # The nickname that set the mode
             mode_setter = Nickname(low_event.source)
             # Simple channel
             channel = low_event.target
-
-            # ServerConnection._parse_modes returns a list of tuples with
-            # (operation, mode, param)
-            # HOWEVER, we preparse the modes, so we (preferably) only want the
-            # first one. Let's make sure we can still get all of them, though
-            event = creator(mode_setter, channel, None)
-            modes = server._parse_modes(' '.join(low_event.argument))
-            if len(modes) > 1:
-                event.modes = modes
-            else:
-                event.modes = modes[0]
-            return event
+            return cls(server, command, mode_setter, channel, None,
+                       low_event)
         elif command in ['topic', 'currenttopic', 'notopic']:
             # Any message that tells us what the topic is.
             # The channel that had its topic set.
@@ -522,8 +812,6 @@ class HighEvent(object):
             # The person who set the topic.
             # If this isn't a topic command, there is no setter
             topic_setter = None
-            if command == 'topic':
-                setter = Nickname(low_event.source)
             # The argument contains the topic string
             # Treat notopic as empty string
             topic = ''
@@ -531,24 +819,26 @@ class HighEvent(object):
                 topic = ' '.join(low_event.argument[1:])
             elif command == 'topic':
                 topic = low_event.argument[0]
-            event = creator(topic_setter, channel, topic)
-            event.command = 'topic'
-            return event
+            return cls(server, 'topic', topic_setter, channel, topic,
+                       low_event)
         elif command == 'all_raw_messages':
             # This event contains all messages, unparsed
-            server_name = low_event.source
-            event = creator(None, None, low_event.argument[0])
-            event.command = 'raw'
-            return event
+            return cls(server, 'raw', None, None, _unread, low_event)
 
         # The event was not high level: thus, it's not raw, but simply unparsed
         # You will probably be able to register to these, but they won't have
         # much use
-        event = creator(None, None, low_event.argument[0] if
-                        len(low_event.argument) > 0 else u'')
-        event.source = low_event.source
-        event.target = low_event.target
-        return event
+        return cls(server, command, None, None, low_event.argument[0] if
+                   len(low_event.argument) > 0 else u'', low_event)
+
+
+
+def _event_modes(server, low_event):
+    """[Internal] Returns the mode changes of a mode or umode `low_event`,
+    parsing them only if the connection didn't already."""
+    if low_event.modes is None:
+        low_event.modes = server._parse_modes(' '.join(low_event.argument))
+    return low_event.modes
 
 
 class Nickname(object):
@@ -557,6 +847,8 @@ class Nickname(object):
 
     Contains information such as actual nickname, hostmask and more.
     """
+    __slots__ = ('name', 'host')
+
     def __init__(self, host, nickname_only=False):
         """
         The constructor really just expects the raw host send by IRC servers.
@@ -564,58 +856,361 @@ class Nickname(object):
         It parses this for you into segments.
 
         if `nickname_only` is set to True it expects a bare nickname unicode
-        object to be used as nickname and nothing more.
+        object to be used as nickname and nothing more; :attr:`host` is
+        None then.
         """
-        super(Nickname, self).__init__()
-
         if nickname_only:
             self.name = host
+            self.host = None
         else:
-            self.name = utils.nm_to_n(host)
+            self.name = utils.parse_hostmask(host)[0]
             self.host = host
 
+    @property
+    def user(self):
+        """The user part of the hostmask, or None if it isn't known."""
+        if self.host is not None:
+            return utils.parse_hostmask(self.host)[1]
+
+    @property
+    def hostname(self):
+        """The host part of the hostmask, or None if it isn't known."""
+        if self.host is not None:
+            return utils.parse_hostmask(self.host)[2]
+
 
 def register(func):
+    """Registers `func` as a global high level event handler.
+
+    If the handler was decorated with :meth:`Filters.events` it is only
+    counted as interested in those events; events nobody is interested in
+    are not built at all. The channels, nicknames, CTCP types and events
+    declared with :class:`Filters` are used to index the handler, so that
+    it is only called for events that can pass its filters.
+    """
     Session.handlers[func.__module__ + ":" + func.__name__] = func
+    _update_interests()
     return func
 
 
+def unregister(func):
+    """Removes a handler added with :func:`register`."""
+    Session.handlers.pop(func.__module__ + ":" + func.__name__, None)
+    _update_interests()
+    return func
+
+
+def _update_interests():
+    """Recomputes :data:`Session.interests` and :data:`Session.handler_index`
+    from the registered handlers."""
+    interests = set()
+    for handler in Session.handlers.values():
+        events = getattr(handler, 'keys', {}).get('command')
+        if events is None:
+            interests.add(None)
+        else:
+            interests.update(events)
+    Session.interests.clear()
+    Session.interests.update(interests)
+    Session.handler_index = _HandlerIndex(Session.handlers.values())
+
+
+class _HandlerIndex(object):
+    """Finds the handlers that want a high level event.
+
+    Every handler is indexed on one of the keys its filters declared, the
+    most selective one; handlers without any are looked at for every
+    event.
+
+    The filters of :class:`Filters` are compiled as well: their checks are
+    done here with set lookups, the `match` patterns of all handlers are
+    searched for together, once per event, and the undecorated handler is
+    called directly. Handlers with other filters are called as they are,
+    so their filters decide for themselves.
+
+    The index is built by the first :meth:`lookup`, so that registering
+    many handlers in a row doesn't build it again for each of them.
+    """
+    #: The kinds of keys, from the most to the least selective
+    kinds = ('match', 'channel', 'nick', 'ctcp', 'command')
+    #: The order the compiled checks are done in, cheapest first
+    check_order = ('command', 'ctcp', 'attribute', 'channel', 'nick',
+                   'match')
+
+    def __init__(self, handlers):
+        # The handlers to index, until the index is built
+        self._handlers = list(handlers)
+        #: The regular expressions of the `match` filters, once built
+        self.patterns = None
+
+    def _build(self):
+        """[Internal] Indexes the handlers."""
+        handlers = self._handlers
+        self.unkeyed = []
+        # Per kind, the handlers and the values they declared
+        self.keyed = dict((kind, []) for kind in self.kinds)
+        # Per kind and casemapping name, the handlers by folded value
+        self._tables = {}
+        patterns = self._pattern_ids = {}
+        for order, handler in enumerate(handlers):
+            function, conditions = _filter_chain(handler)
+            checks = None
+            if conditions is not None:
+                checks = self._compile(conditions, patterns)
+            entry = (order, function, checks)
+            keys = getattr(handler, 'keys', {})
+            for kind in self.kinds:
+                if keys.get(kind) is not None:
+                    self.keyed[kind].append((entry, keys[kind]))
+                    break
+            else:
+                self.unkeyed.append(entry)
+        for entry, values in self.keyed['match']:
+            for pattern in values:
+                patterns.setdefault(pattern, len(patterns))
+        self.patterns = PatternSet(sorted(patterns, key=patterns.get))
+        self._handlers = None
+
+    def _compile(self, conditions, patterns):
+        """[Internal] Turns the specs of a filter chain into checks.
+
+        `patterns` maps every `match` pattern seen so far to its index.
+        """
+        checks = []
+        for kind, value in conditions:
+            if kind in ('channel', 'nick'):
+                value = _folded_names(value)
+            elif kind == 'match':
+                value = patterns.setdefault(value, len(patterns))
+            checks.append((self.check_order.index(kind), kind, value))
+        checks.sort()
+        return [(kind, value) for rank, kind, value in checks]
+
+    def _table(self, kind, fold, name):
+        """[Internal] Returns the handlers of `kind` by their declared
+        values, folded with `fold`."""
+        table = self._tables.get((kind, name))
+        if table is None:
+            table = self._tables[(kind, name)] = {}
+            for entry, values in self.keyed[kind]:
+                for value in set(map(fold, values)):
+                    table.setdefault(value, []).append(entry)
+        return table
+
+    def lookup(self, high_event):
+        """Returns the handlers that want `high_event`, in the order they
+        are in :data:`Session.handlers`."""
+        if self._handlers is not None:
+            self._build()
+        # Values computed for the checks, like the matched patterns
+        state = {}
+        found = []
+        if self.unkeyed:
+            found.append(self.unkeyed)
+        if self.keyed['match']:
+            table = self._table('match', self._pattern_ids.get, None)
+            for index in self._matched(high_event, state):
+                found.append(table.get(index, ()))
+        if self.keyed['channel'] and high_event.channel is not None:
+            casemap = _casemap(high_event)
+            table = self._table('channel', casemap.fold, casemap.name)
+            found.append(table.get(casemap.fold(high_event.channel), ()))
+        if self.keyed['nick'] and high_event.nickname:
+            casemap = _casemap(high_event)
+            table = self._table('nick', casemap.fold, casemap.name)
+            found.append(table.get(casemap.fold(high_event.nickname.name),
+                                   ()))
+        ctcp = getattr(high_event, 'ctcp', None)
+        if self.keyed['ctcp'] and ctcp is not None:
+            table = self._table('ctcp', _upper, None)
+            found.append(table.get(ctcp.upper(), ()))
+        if self.keyed['command']:
+            table = self._table('command', _identity, None)
+            found.append(table.get(high_event.command, ()))
+
+        found = [entries for entries in found if entries]
+        if not found:
+            return []
+        if len(found) == 1:
+            entries = found[0]
+        else:
+            entries = sorted(entry for entries in found for entry in entries)
+        return [function for order, function, checks in entries
+                if checks is None or self._passes(checks, high_event, state)]
+
+    def _passes(self, checks, high_event, state):
+        """[Internal] Returns True if `high_event` passes the compiled
+        filters `checks`."""
+        for kind, value in checks:
+            if kind == 'command':
+                if high_event.command not in value:
+                    return False
+            elif kind == 'ctcp':
+                ctcp = getattr(high_event, 'ctcp', None)
+                if ctcp is None or ctcp.upper() not in value:
+                    return False
+            elif kind == 'attribute':
+                attribute, values = value
+                if (getattr(high_event, attribute, None) or None) \
+                        not in values:
+                    return False
+            elif kind == 'channel':
+                if high_event.channel is None:
+                    return False
+                casemap = _casemap(high_event)
+                if casemap.fold(high_event.channel) not in value(casemap):
+                    return False
+            elif kind == 'nick':
+                if not high_event.nickname:
+                    return False
+                casemap = _casemap(high_event)
+                if casemap.fold(high_event.nickname.name) \
+                        not in value(casemap):
+                    return False
+            elif kind == 'match':
+                if value not in self._matched(high_event, state):
+                    return False
+        return True
+
+    def _matched(self, high_event, state):
+        """[Internal] Returns the indices of the patterns found in the
+        message of `high_event`, searching for them only once."""
+        matched = state.get('match')
+        if matched is None:
+            message = high_event.message
+            matched = state['match'] = \
+                self.patterns.search(message) if message else ()
+        return matched
+
+
+def _upper(value):
+    return value.upper()
+
+
+def _identity(value):
+    return value
+
+
+#: Finds the registered handlers that may want an event.
+#: This is kept up to date by :func:`register` and :func:`unregister`.
+Session.handler_index = _HandlerIndex([])
+
+
 def boolean_filter(func):
-    filter_func = [None]
+    """Turns a function that returns a filter into a decorator factory.
 
-    def callback_getter(callback):
-        def callback_wrapper(*args, **kwargs):
-            if filter_func[0](*args, **kwargs):
-                callback(*args, **kwargs)
-        return callback_wrapper
+    The filter is called with the arguments of the handler and the
+    handler only runs if it returns True. A filter can describe what it
+    checks with a `spec` attribute, a (kind, value) tuple; see
+    :class:`_HandlerIndex` for the kinds. Handlers whose filters all have
+    one are indexed and compiled by :func:`register`.
+    """
+    def callback_getter(filter_func):
+        def decorator(callback):
+            @functools.wraps(callback)
+            def callback_wrapper(*args, **kwargs):
+                if filter_func(*args, **kwargs):
+                    return callback(*args, **kwargs)
+            spec = getattr(filter_func, 'spec', None)
+            # Keep track of the events, channels, nicknames and CTCP
+            # types the handler is limited to, so register can index it.
+            keys = dict(getattr(callback, 'keys', {}))
+            if spec is not None and spec[0] in _HandlerIndex.kinds:
+                kind, values = spec
+                if kind == 'match':
+                    values = frozenset([values])
+                if kind not in keys:
+                    keys[kind] = values
+                elif kind in ('command', 'ctcp'):
+                    keys[kind] = keys[kind] & values
+                # Names are only folded when we know the casemapping;
+                # either set is a good enough index.
+            callback_wrapper.keys = keys
+            # And of the whole chain, so register can compile it.
+            function, conditions = _filter_chain(callback)
+            if conditions is None or spec is None:
+                function, conditions = callback_wrapper, None
+            else:
+                conditions = conditions + [spec]
+            callback_wrapper._filter_chain = (callback_wrapper, function,
+                                              conditions)
+            return callback_wrapper
+        return decorator
 
     def filter_wrapper(*args, **kwargs):
-        filter_func[0] = func(*args, **kwargs)
-
-        return callback_getter
+        return callback_getter(func(*args, **kwargs))
 
     return filter_wrapper
 
 
+def _filter_chain(handler):
+    """[Internal] Returns the undecorated function of `handler` and the
+    specs of its filters, or `handler` and None if they can't be
+    compiled."""
+    chain = getattr(handler, '_filter_chain', None)
+    if chain is None:
+        return handler, []
+    owner, function, conditions = chain
+    if owner is not handler or conditions is None:
+        # Another decorator copied the attributes of a filtered handler
+        return handler, None
+    return function, conditions
+
+
+def _casemap(high_event):
+    """Returns the casemapping of the connection `high_event` came from."""
+    return getattr(high_event.server, 'casemapping', casemapping.rfc1459)
+
+
+def _folded_names(names):
+    """Returns a function that gives the set of `names` folded with the
+    casemapping of a connection, computed once per casemapping."""
+    folded = {}
+    def get(casemap):
+        result = folded.get(casemap.name)
+        if result is None:
+            result = folded[casemap.name] = frozenset(map(casemap.fold, names))
+        return result
+    return get
+
+
 class Filters(object):
     @boolean_filter
     def channels(self, channels):
+        spec = ('channel', frozenset(channels))
+        channels = _folded_names(channels)
         def filter(high_event):
-            return high_event.channel in channels
+            casemap = _casemap(high_event)
+            return high_event.channel is not None\
+                and casemap.fold(high_event.channel) in channels(casemap)
+        filter.spec = spec
         return filter
 
     @boolean_filter
     def nicks(self, *nicks):
-        nicks = map(lambda x:nicks.lower(), nicks)
+        spec = ('nick', frozenset(nicks))
+        nicks = _folded_names(nicks)
         def filter(high_event):
+            casemap = _casemap(high_event)
             return high_event.nickname\
-                and high_event.nickname.name.lower() in nicks
+                and casemap.fold(high_event.nickname.name) in nicks(casemap)
+        filter.spec = spec
         return filter
 
     @boolean_filter
     def events(self, *events):
         def filter(high_event):
             return high_event.command in events
+        filter.spec = ('command', frozenset(events))
+        return filter
+
+    @boolean_filter
+    def ctcps(self, *ctcps):
+        ctcps = frozenset(ctcp.upper() for ctcp in ctcps)
+        def filter(high_event):
+            ctcp = getattr(high_event, 'ctcp', None)
+            return ctcp is not None and ctcp.upper() in ctcps
+        filter.spec = ('ctcp', ctcps)
         return filter
 
     @boolean_filter
@@ -623,12 +1218,14 @@ class Filters(object):
         cregex = re.compile(regex, re.I)
         def filter(high_event):
             return high_event.message and cregex.search(high_event.message)
+        filter.spec = ('match', regex)
         return filter
 
     @boolean_filter
     def attributematch(self, attribute, *values):
         def filter(high_event):
-            return (getattr(high_event, attribute) or None) in values
+            return (getattr(high_event, attribute, None) or None) in values
+        filter.spec = ('attribute', (attribute, values))
         return filter
 
     #TODO: insert more specific handlers for event-specific attributes
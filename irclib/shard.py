@@ -0,0 +1,494 @@
+"""
+Module that spreads server connections over several processes.
+
+A :class:`session.Session` runs on a single thread, so one process can't
+use more than one core for parsing lines and keeping track of channels;
+a bot with connections to many networks can run out of it. A
+:class:`Supervisor` starts a number of shard processes that each run a
+Session of their own, and puts every connection in one of them.
+
+Handlers registered with :func:`session.register` run in the shards, on
+the events of the connections there. Handlers registered with
+:meth:`Supervisor.register` run in the supervisor's process instead: the
+shards send it the events those handlers are interested in over a Unix
+socket, and the `server` of these events is a :class:`RemoteConnection`
+that sends the commands called on it back to the shard.
+
+Example::
+
+    irc = session.Session()
+    supervisor = Supervisor(irc, shards=4)
+    supervisor.start()
+
+    @supervisor.register
+    @filters.events('text')
+    def log(high_event):
+        ...
+
+    for network in networks:
+        supervisor.server().connect(network, 6667, 'Hanyuu')
+    irc.process_forever()
+
+The shards are forked, so they only have the handlers that were
+registered with :func:`session.register` before :meth:`Supervisor.start`.
+Handlers of the supervisor can be registered at any time.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import functools
+import itertools
+import multiprocessing
+import socket
+import struct
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from . import casemapping
+from . import connection
+from . import replies
+from . import session
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+#: The methods of a :class:`RemoteConnection` that are sent to the shard
+#: without waiting for a result.
+remote_methods = frozenset([
+    'action', 'admin', 'ctcp', 'ctcp_reply', 'disconnect', 'globops',
+    'info', 'invite', 'ison', 'join', 'kick', 'kick_many', 'links', 'list',
+    'lusers', 'mode', 'motd', 'nick', 'notice', 'oper', 'part', 'pass_',
+    'ping', 'pong', 'privmsg', 'privmsg_many', 'quit', 'reconnect',
+    'send_raw', 'set_modes', 'squit', 'stats', 'time', 'topic', 'trace',
+    'user', 'userhost', 'users', 'version', 'wallops', 'whowas',
+])
+
+#: The methods of a :class:`RemoteConnection` that return a
+#: :class:`replies.Future` of their result in the shard.
+future_methods = frozenset(['check_identified', 'connect', 'names', 'who',
+                            'whois'])
+
+#: Events that are always sent to the supervisor, to keep the state of
+#: its :class:`RemoteConnection` objects up to date.
+state_events = ('connect', 'disconnect')
+
+# Every message on a link is a pickle with its length in front
+_header = struct.Struct(b'!I')
+
+# How much to read from a link at once
+_read_size = 256 * 1024
+
+
+class Link(connection.Connection):
+    """One end of the Unix socket between the supervisor and a shard.
+
+    Messages are tuples that are pickled and sent with their length in
+    front, and `callback` is called with every message that arrives. The
+    messages sent while the Session handles the data it read are sent
+    together once it is done with them.
+    """
+
+    def __init__(self, irclibobj, sock, callback):
+        connection.Connection.__init__(self, irclibobj)
+        self.socket = sock
+        self.callback = callback
+        self._in_buffer = bytearray()
+        self._flush_posted = False
+        sock.setblocking(0)
+        irclibobj.register_socket(sock, self)
+
+    def _get_socket(self):
+        """[Internal]"""
+        return self.socket
+
+    def send(self, message):
+        """Sends the tuple `message` to the other end.
+
+        Raises :exc:`pickle.PicklingError` or :exc:`TypeError` if it can't
+        be pickled, in which case nothing is sent.
+        """
+        data = pickle.dumps(message, 2)
+        if self.socket is None:
+            return
+        self.out_buffer += _header.pack(len(data))
+        self.out_buffer += data
+        if not self._flush_posted:
+            self._flush_posted = True
+            self.irclibobj.post(self._flush_batch)
+
+    def _flush_batch(self):
+        """[Internal] Sends the messages buffered since the last batch."""
+        self._flush_posted = False
+        if self.socket is not None:
+            self._flush()
+
+    def process_data(self):
+        """Reads and dispatches the messages from the other end.
+
+        Only for internal use.
+        """
+        try:
+            data = self.socket.recv(_read_size)
+        except socket.error, x:
+            if not connection._would_block(x):
+                self.disconnect("Connection reset by peer")
+            return
+        if not data:
+            self.disconnect("Link closed")
+            return
+
+        buf = self._in_buffer
+        buf += data
+        offset = 0
+        while len(buf) - offset >= _header.size:
+            size, = _header.unpack_from(buf, offset)
+            end = offset + _header.size + size
+            if len(buf) < end:
+                break
+            message = pickle.loads(str(buf[offset + _header.size:end]))
+            offset = end
+            try:
+                self.callback(message)
+            except Exception:
+                logger.exception('Exception in link callback')
+        del buf[:offset]
+
+    def disconnect(self, message=""):
+        """Closes the link; `callback` gets a ``('closed', message)``
+        message."""
+        if self.socket is None:
+            return
+        self.irclibobj.unregister_socket(self.socket)
+        try:
+            self.socket.close()
+        except socket.error, x:
+            pass
+        self.socket = None
+        del self.out_buffer[:]
+        del self._in_buffer[:]
+        self._want_write = False
+        self.callback(('closed', message))
+
+
+def _event_state(high_event):
+    """[Internal] Returns the attributes of `high_event` that are sent to
+    the supervisor, with its optional fields filled in."""
+    state = dict(getattr(high_event, '__dict__', ()))
+    for name in ('command', 'nickname', 'channel', 'message') + \
+            session.HighEvent.optional_fields:
+        state[name] = getattr(high_event, name)
+    return state
+
+
+def _rebuild_event(state, server):
+    """[Internal] Turns the result of :func:`_event_state` back into a
+    :class:`session.HighEvent` of `server`."""
+    event = session.HighEvent(server, None, None, None, None)
+    for name, value in state.items():
+        setattr(event, name, value)
+    return event
+
+
+class _Shard(object):
+    """[Internal] The part of a shard process that talks to the
+    supervisor."""
+
+    def __init__(self, irclibobj, sock):
+        self.irclibobj = irclibobj
+        self.link = Link(irclibobj, sock, self.receive)
+        # The connections of this shard by their id in the supervisor
+        self.connections = {}
+        self.running = True
+        self._forwarder = None
+
+    def run(self):
+        irc = self.irclibobj
+        while self.running:
+            wait = 1.0
+            deadline = irc.next_deadline()
+            if deadline is not None:
+                wait = min(max(deadline - time.time(), 0), wait)
+            irc.process_once(wait)
+
+    def receive(self, message):
+        getattr(self, 'do_' + message[0])(*message[1:])
+
+    def do_interests(self, commands):
+        """Sends the events with a command in `commands` to the
+        supervisor, or all events if it is None."""
+        if self._forwarder is not None:
+            session.unregister(self._forwarder)
+        def shard_forwarder(high_event):
+            self.forward(high_event)
+        if commands is not None:
+            commands = set(commands).union(state_events)
+            shard_forwarder = session.filters.events(*commands)(
+                shard_forwarder)
+        self._forwarder = session.register(shard_forwarder)
+
+    def do_call(self, conn_id, call_id, name, arguments, keywords):
+        """Calls the method `name` of a connection; the result is sent
+        back if `call_id` isn't None."""
+        server = self.connections.get(conn_id)
+        if server is None:
+            server = self.connections[conn_id] = self.irclibobj.server()
+            server.shard_id = conn_id
+        future = replies.Future()
+        try:
+            result = getattr(server, name)(*arguments, **keywords)
+        except Exception as e:
+            if call_id is None:
+                logger.exception('Exception in call from the supervisor')
+                return
+            future.set_exception(e)
+        else:
+            if call_id is None:
+                return
+            if isinstance(result, replies.Future):
+                future = result
+            else:
+                future.set_result(None if result is server else result)
+        future.add_done_callback(functools.partial(self.reply, call_id))
+
+    def do_stop(self, message):
+        self.irclibobj.disconnect_all(message)
+        self.link.disconnect()
+
+    def do_closed(self, message):
+        if self.running:
+            self.running = False
+            self.irclibobj.disconnect_all(message)
+
+    def reply(self, call_id, future):
+        """Sends the result of the call `call_id` to the supervisor."""
+        exception = future.exception()
+        try:
+            if exception is None:
+                self.link.send(('result', call_id, future.result(), None))
+            else:
+                self.link.send(('result', call_id, None, exception))
+        except (pickle.PicklingError, TypeError) as e:
+            self.link.send(('result', call_id, None,
+                            replies.ReplyError(repr(e))))
+
+    def forward(self, high_event):
+        """Sends `high_event` to the supervisor."""
+        server = high_event.server
+        conn_id = getattr(server, 'shard_id', None)
+        if conn_id is None:
+            return
+        try:
+            self.link.send(('event', conn_id, _event_state(high_event),
+                            getattr(server, 'real_nickname', None),
+                            server.casemapping.name))
+        except (pickle.PicklingError, TypeError):
+            logger.exception('Event can not be sent to the supervisor')
+
+
+def _run_shard(sock, inherited):
+    """[Internal] The main function of a shard process."""
+    # Other shards only see EOF on their links once we let go of them
+    for other in inherited:
+        other.close()
+    _Shard(session.Session(), sock).run()
+
+
+class RemoteConnection(object):
+    """Stands in for a :class:`connection.ServerConnection` in a shard.
+
+    The methods in :data:`remote_methods`, like :meth:`privmsg` or
+    :meth:`join`, are sent to the shard and return None. The methods in
+    :data:`future_methods` return a :class:`replies.Future` of what the
+    method returned in the shard; their `callback` has to be given as a
+    keyword argument. The tracker queries and other methods are not
+    available.
+    """
+
+    def __init__(self, supervisor, shard, conn_id):
+        self.supervisor = supervisor
+        #: The number of the shard the connection is in
+        self.shard = shard
+        #: The id of the connection in the supervisor and its shard
+        self.id = conn_id
+        #: Kept up to date from the events of the connection
+        self.casemapping = casemapping.CaseMapping()
+        self.real_nickname = None
+        self.connected = False
+
+    def __getattr__(self, name):
+        if name in remote_methods:
+            return functools.partial(self.supervisor._call, self, name,
+                                     False)
+        if name in future_methods:
+            return functools.partial(self.supervisor._call, self, name, True)
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<RemoteConnection {} in shard {}>'.format(self.id,
+                                                          self.shard)
+
+    def get_nickname(self):
+        """Returns our nickname on the server, as of the last event."""
+        return self.real_nickname
+
+    def is_connected(self):
+        return self.connected
+
+
+class Supervisor(object):
+    """Runs the connections made with :meth:`server` in `shards` worker
+    processes, by default one per core.
+
+    The links to the shards are handled by `irclibobj`, the Session of
+    this process, which also calls the handlers registered with
+    :meth:`register` and can have connections of its own.
+    """
+
+    def __init__(self, irclibobj, shards=None):
+        self.irclibobj = irclibobj
+        self.shards = shards or multiprocessing.cpu_count()
+        #: The handlers that run in this process, see :meth:`register`
+        self.handlers = {}
+        self.handler_index = session._HandlerIndex([])
+        #: The :class:`RemoteConnection` objects, by their id
+        self.connections = []
+        self.links = []
+        self.processes = []
+        # The Futures of calls waiting for their result, by call id
+        self._calls = {}
+        self._call_ids = itertools.count()
+        self._interests = ()
+        self._stopping = False
+
+    def start(self):
+        """Starts the shard processes."""
+        for number in range(self.shards):
+            ours, theirs = socket.socketpair()
+            inherited = [link.socket for link in self.links] + [ours]
+            process = multiprocessing.Process(
+                target=_run_shard, args=(theirs, inherited),
+                name='irclib-shard-{}'.format(number))
+            process.daemon = True
+            process.start()
+            theirs.close()
+            self.processes.append(process)
+            link = Link(self.irclibobj, ours,
+                        functools.partial(self._receive, number))
+            link.send(('interests', self._interests))
+            self.links.append(link)
+
+    def stop(self, message="", timeout=5):
+        """Disconnects every connection and stops the shards."""
+        self._stopping = True
+        for link in self.links:
+            if link.socket is not None:
+                link.send(('stop', message))
+                link.socket.setblocking(1)
+                link._flush()
+        for process in self.processes:
+            process.join(timeout)
+        for link in self.links:
+            link.disconnect(message)
+
+    def server(self):
+        """Creates a :class:`RemoteConnection` in the shard with the fewest
+        connections."""
+        if not self.links:
+            raise connection.IRCError("The supervisor has not been started.")
+        counts = [0] * len(self.links)
+        for c in self.connections:
+            counts[c.shard] += 1
+        c = RemoteConnection(self, counts.index(min(counts)),
+                             len(self.connections))
+        self.connections.append(c)
+        return c
+
+    def register(self, func):
+        """Registers `func` as a high level event handler that runs in
+        this process, like :func:`session.register`.
+
+        Only the events these handlers are interested in are sent by the
+        shards.
+        """
+        self.handlers[func.__module__ + ":" + func.__name__] = func
+        self._update_interests()
+        return func
+
+    def unregister(self, func):
+        """Removes a handler added with :meth:`register`."""
+        self.handlers.pop(func.__module__ + ":" + func.__name__, None)
+        self._update_interests()
+        return func
+
+    def _update_interests(self):
+        """[Internal] Rebuilds the handler index and tells the shards
+        which events to send."""
+        interests = set()
+        for handler in self.handlers.values():
+            events = getattr(handler, 'keys', {}).get('command')
+            if events is None:
+                interests.add(None)
+            else:
+                interests.update(events)
+        self.handler_index = session._HandlerIndex(self.handlers.values())
+        interests = None if None in interests else tuple(sorted(interests))
+        if interests != self._interests:
+            self._interests = interests
+            for link in self.links:
+                link.send(('interests', interests))
+
+    def _call(self, server, name, wants_result, *arguments, **keywords):
+        """[Internal] Calls the method `name` of `server` in its shard."""
+        link = self.links[server.shard]
+        if link.socket is None:
+            raise connection.ServerNotConnectedError("The shard is gone.")
+        call_id = future = None
+        if wants_result:
+            callback = keywords.pop('callback', None)
+            call_id = next(self._call_ids)
+            future = replies.Future()
+            if callback is not None:
+                future.add_done_callback(callback)
+            self._calls[call_id] = (server.shard, future)
+        link.send(('call', server.id, call_id, name, arguments, keywords))
+        return future
+
+    def _receive(self, shard, message):
+        """[Internal] Handles a message from `shard`."""
+        kind = message[0]
+        if kind == 'event':
+            conn_id, state, nickname, mapping = message[1:]
+            server = self.connections[conn_id]
+            server.real_nickname = nickname
+            server.casemapping.set_mapping(mapping)
+            event = _rebuild_event(state, server)
+            if event.command == 'connect':
+                server.connected = True
+            elif event.command == 'disconnect':
+                server.connected = False
+            for function in self.handler_index.lookup(event):
+                self.irclibobj._call_handler(function, event)
+        elif kind == 'result':
+            call_id, result, exception = message[1:]
+            shard, future = self._calls.pop(call_id)
+            if exception is None:
+                future.set_result(result)
+            else:
+                future.set_exception(exception)
+        elif kind == 'closed':
+            if not self._stopping:
+                logger.error("Lost the link to shard {}: {}"
+                             .format(shard, message[1]))
+            for server in self.connections:
+                if server.shard == shard:
+                    server.connected = False
+            error = connection.ServerNotConnectedError("The shard is gone.")
+            for call_id, (owner, future) in list(self._calls.items()):
+                if owner == shard:
+                    del self._calls[call_id]
+                    future.set_exception(error)
@@ -0,0 +1,160 @@
+"""
+Module that contains the scheduler for calls the Session makes at a later
+time, such as reply timeouts and :meth:`session.Session.execute_delayed`.
+"""
+from __future__ import unicode_literals
+from __future__ import print_function
+from __future__ import absolute_import
+import heapq
+import itertools
+
+from . import logger
+
+logger = logger.getChild(__name__)
+
+
+class Timer(object):
+    """A scheduled call, as returned by the :class:`Scheduler` methods.
+
+    Call :meth:`cancel` to keep it from running (again).
+    """
+    __slots__ = ('when', 'function', 'arguments', 'interval', 'cancelled',
+                 '_scheduler')
+
+    def __init__(self, when, function, arguments=(), interval=None):
+        #: The time the call is due at
+        self.when = when
+        self.function = function
+        self.arguments = arguments
+        #: Seconds between the calls of a repeating timer, or None
+        self.interval = interval
+        self.cancelled = False
+        # The scheduler whose heap holds this timer, if any
+        self._scheduler = None
+
+    def cancel(self):
+        """Cancels the call. Does nothing if it already ran."""
+        if self.cancelled:
+            return
+        self.cancelled = True
+        if self._scheduler is not None:
+            self._scheduler._timer_cancelled()
+            self._scheduler = None
+
+    def __repr__(self):
+        return "<Timer {} at {}{}>".format(
+            getattr(self.function, '__name__', self.function), self.when,
+            " cancelled" if self.cancelled else "")
+
+
+class Scheduler(object):
+    """Keeps timers in a binary heap ordered by their due time.
+
+    Scheduling and running a timer cost O(log n). Cancelled timers are
+    left in the heap and skipped when they come up, until they make up a
+    quarter of it and the heap is rebuilt without them: popping them
+    costs O(log n) each, more than the O(n) rebuild once there are that
+    many.
+    """
+
+    #: The amount of cancelled timers that may stay in the heap before it
+    #: is considered for a rebuild.
+    min_compact = 64
+
+    def __init__(self):
+        # Entries are (when, sequence, timer); the sequence number keeps
+        # timers due at the same time in the order they were scheduled.
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled = 0
+
+    def __len__(self):
+        """Returns the amount of pending timers."""
+        return len(self._heap) - self._cancelled
+
+    def call_at(self, when, function, arguments=()):
+        """Schedules `function` to be called with `arguments` at the time
+        `when`. Returns the :class:`Timer`."""
+        timer = Timer(when, function, arguments)
+        self._push(timer)
+        return timer
+
+    def call_repeating(self, when, interval, function, arguments=()):
+        """Schedules `function` to be called with `arguments` at the time
+        `when`, and every `interval` seconds after that until it is
+        cancelled. Returns the :class:`Timer`."""
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        timer = Timer(when, function, arguments, interval)
+        self._push(timer)
+        return timer
+
+    def next_deadline(self):
+        """Returns the time the next timer is due at, or None if there
+        are no timers."""
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        return heap[0][0] if heap else None
+
+    def run_due(self, now):
+        """Runs every timer that is due at the time `now`.
+
+        The due timers are taken off the heap before any of them is
+        called, so timers that the calls schedule for `now` or earlier
+        run on the next call. Repeating timers are scheduled again before
+        they are called, so they may cancel themselves. Exceptions are
+        logged.
+        """
+        heap = self._heap
+        if not heap or heap[0][0] > now:
+            return
+        heappop = heapq.heappop
+        due = []
+        while heap and heap[0][0] <= now:
+            entry = heappop(heap)
+            timer = entry[2]
+            if timer.cancelled:
+                self._cancelled -= 1
+            else:
+                timer._scheduler = None
+                due.append(entry)
+        for when, _, timer in due:
+            if timer.cancelled:
+                # By one of the calls before it
+                continue
+            if timer.interval is not None:
+                # Keep to the original rhythm, but don't try to catch up
+                # on calls we missed.
+                timer.when = when + timer.interval
+                if timer.when <= now:
+                    timer.when = now + timer.interval
+                self._push(timer)
+            try:
+                timer.function(*timer.arguments)
+            except:
+                logger.exception('Exception in timer')
+
+    def clear(self):
+        """Cancels every timer."""
+        heap, self._heap = self._heap, []
+        self._cancelled = 0
+        for when, _, timer in heap:
+            timer._scheduler = None
+            timer.cancelled = True
+
+    def _push(self, timer):
+        timer._scheduler = self
+        heapq.heappush(self._heap, (timer.when, next(self._sequence), timer))
+
+    def _timer_cancelled(self):
+        """[Internal] Rebuilds the heap once a quarter of it is cancelled
+        timers."""
+        self._cancelled += 1
+        if self._cancelled > self.min_compact and \
+                self._cancelled * 4 > len(self._heap):
+            self._heap = [entry for entry in self._heap
+                          if not entry[2].cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
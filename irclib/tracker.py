@@ -7,6 +7,8 @@ from __future__ import print_function
 from __future__ import absolute_import
 import sqlite3
 
+from . import casemapping
+
 
 class SqliteCursor:
     """A simple Sqlite cursor."""
@@ -40,15 +42,25 @@ class IRCTracker:
     that are associated to nicknames on channels. It also tracks channel
     topics.
     
-    This tracker uses an internal Sqlite database to store its information.    
+    This tracker uses an internal Sqlite database to store its information.
+    The IDs of nicknames and channels are looked up by their folded names,
+    so they are compared the way the server compares them.
     """
-    def __init__(self):
-        """Creates an instance of the IRCTracker."""
+    def __init__(self, casemap=None):
+        """Creates an instance of the IRCTracker.
+
+        :param casemap: The :class:`casemapping.CaseMapping` names are
+                        compared with; RFC 1459 by default.
+        """
+        self.casemap = casemap or casemapping.CaseMapping()
+        # Map folded names to their IDs in the database
+        self._nick_ids = {}
+        self._chan_ids = {}
         self._conn = sqlite3.connect(":memory:", check_same_thread=False)
         self._conn.row_factory = sqlite3.Row
         with SqliteCursor(self) as cur:
-            cur.execute("create table nicks (id integer primary key autoincrement, nick varchar(50) collate nocase);")
-            cur.execute("create table channels (id integer primary key autoincrement, chan varchar(100) collate nocase, topic text);")
+            cur.execute("create table nicks (id integer primary key autoincrement, nick varchar(50));")
+            cur.execute("create table channels (id integer primary key autoincrement, chan varchar(100), topic text);")
             cur.execute("create table nick_chan_link (id integer primary key autoincrement, nick_id integer not null constraint fk_n_c REFERENCES nicks(id), chan_id integer not null constraint fk_c_n REFERENCES channels(id), modes varchar(20));")
 
     def join(self, chan, nick):
@@ -58,10 +70,10 @@ class IRCTracker:
         with SqliteCursor(self) as cur:
             if not nick_id:
                 cur.execute("INSERT INTO nicks (nick) VALUES (?)", (nick,))
-                nick_id = self.__get_nick_id(nick)
+                nick_id = self._nick_ids[self.casemap.fold(nick)] = cur.lastrowid
             if not chan_id:
                 cur.execute("INSERT INTO channels (chan, topic) VALUES (?, '')", (chan,))
-                chan_id = self.__get_chan_id(chan)
+                chan_id = self._chan_ids[self.casemap.fold(chan)] = cur.lastrowid
             if not self.in_chan(chan, nick):
                 cur.execute("INSERT INTO nick_chan_link (nick_id, chan_id, modes) VALUES (?, ?, '')", (nick_id, chan_id))
         pass
@@ -78,10 +90,12 @@ class IRCTracker:
                 res = cur.fetchall()
                 if len(res) == 0:
                     cur.execute("DELETE FROM nicks WHERE id=?", (nick_id,))
+                    del self._nick_ids[self.casemap.fold(nick)]
                 cur.execute("SELECT * FROM nick_chan_link WHERE chan_id=?", (chan_id,))
                 res = cur.fetchall()
                 if len(res) == 0:
                     cur.execute("DELETE FROM channels WHERE id=?", (chan_id,))
+                    del self._chan_ids[self.casemap.fold(chan)]
     
     def quit(self, nick):
         """Tells the tracker that the nickname 'nick' has left the server."""
@@ -102,6 +116,8 @@ class IRCTracker:
             nick_id = self.__get_nick_id(nick)
             with SqliteCursor(self) as cur:
                 cur.execute("UPDATE nicks SET nick=? WHERE id=?", (newnick, nick_id))
+            del self._nick_ids[self.casemap.fold(nick)]
+            self._nick_ids[self.casemap.fold(newnick)] = nick_id
     
     def add_mode(self, chan, nick, mode):
         """Sets 'mode' on 'nick' in the channel 'chan'."""
@@ -123,42 +139,35 @@ class IRCTracker:
         """If 'topic' is None, this gets the topic in the channel 'chan'.
         
         Otherwise, the topic will be set to 'topic'."""
-        if self.has_chan(chan):
+        chan_id = self.__get_chan_id(chan)
+        if chan_id:
             if topic == None:
                 with SqliteCursor(self) as cur:
-                    cur.execute("SELECT topic FROM channels WHERE chan=?", (chan,))
+                    cur.execute("SELECT topic FROM channels WHERE id=?", (chan_id,))
                     return cur.fetchone()[0]
             else:
                 with SqliteCursor(self) as cur:
-                    cur.execute("UPDATE channels SET topic=? WHERE chan=?", (topic, chan))
+                    cur.execute("UPDATE channels SET topic=? WHERE id=?", (topic, chan_id))
                     return
         return None
     
     
     def has_nick(self, nick):
         """Returns True if the tracker is familiar with the nickname 'nick'."""
-        with SqliteCursor(self) as cur:
-            cur.execute("SELECT * FROM nicks WHERE nick=? LIMIT 1", (nick,))
-            res = cur.fetchall()
-            if len(res) == 1:
-                return True
-        return False
+        return self.__get_nick_id(nick) is not None
 
     def has_chan(self, chan):
         """Returns True if the tracker is familiar with the channel 'chan'."""
-        with SqliteCursor(self) as cur:
-            cur.execute("select * from channels where chan=? limit 1", (chan,))
-            res = cur.fetchall()
-            if len(res) == 1:
-                return True
-        return False 
+        return self.__get_chan_id(chan) is not None
     
     def in_chan(self, chan, nick):
         """Returns true if the nickname 'nick' is in the channel 'chan'."""
-        if self.has_chan(chan) and self.has_nick(nick):
+        chan_id = self.__get_chan_id(chan)
+        if not chan_id:
+            return False
+        nick_id = self.__get_nick_id(nick)
+        if nick_id:
             with SqliteCursor(self) as cur:
-                chan_id = self.__get_chan_id(chan)
-                nick_id = self.__get_nick_id(nick)
                 cur.execute("SELECT * FROM nick_chan_link WHERE nick_id=? AND chan_id=?", (nick_id, chan_id))
                 res = cur.fetchall()
                 if len(res) == 1:
@@ -192,21 +201,15 @@ class IRCTracker:
     
     def __get_nick_id(self, nick):
         """Retrieves the internal nickname ID for a nickname."""
-        with SqliteCursor(self) as cur:
-            cur.execute("select * from nicks where nick=? limit 1", (nick,))
-            res = cur.fetchall()
-            if len(res) == 1:
-                return res[0][0]
-        return None
+        if nick is None:
+            return None
+        return self._nick_ids.get(self.casemap.fold(nick))
     
     def __get_chan_id(self, chan):
         """Retrieves the internal channel ID for a channel."""
-        with SqliteCursor(self) as cur:
-            cur.execute("select * from channels where chan=? limit 1", (chan,))
-            res = cur.fetchall()
-            if len(res) == 1:
-                return res[0][0]
-        return None
+        if chan is None:
+            return None
+        return self._chan_ids.get(self.casemap.fold(chan))
     
     def execute(self, query):
         """Executes a Sqlite query and returns the results."""
@@ -3,6 +3,9 @@ from __future__ import print_function
 from __future__ import absolute_import
 import re
 import string
+import codecs
+
+from . import casemapping
 
 #: The character used for low level CTCP quoting
 _LOW_LEVEL_QUOTE = "\020"
@@ -31,22 +34,24 @@ _low_level_mapping = {
 _low_level_regexp = re.compile(_LOW_LEVEL_QUOTE + "(.)", re.UNICODE)
 
 
+#: Decodes ASCII without going through the codec registry
+_ascii_decode = codecs.ascii_decode
+
 _special = "-[]\\`^{}"
 
 #: The characters that are permitted in IRC nicknames
 nick_characters = string.ascii_letters + string.digits + _special
 
-#: A translation map for translating IRC lowercase and uppercase
-_ircstring_translation = string.maketrans(string.ascii_uppercase + "[]\\^",
-                                        string.ascii_lowercase + "{}|~")
-
-def mask_matches(nick, mask):
+def mask_matches(nick, mask, casemap=casemapping.rfc1459):
     """Check if a nick matches a mask.
 
+    Names are compared according to `casemap`, usually the
+    :attr:`casemapping` of the connection they came from.
+
     Returns True if the nick matches, otherwise False.
     """
-    nick = irc_lower(nick)
-    mask = irc_lower(mask)
+    nick = casemap.fold(nick)
+    mask = casemap.fold(mask)
     mask = mask.replace("\\", "\\\\")
     for ch in ".$|[](){}+":
         mask = mask.replace(ch, "\\" + ch)
@@ -61,11 +66,22 @@ def irc_lower(s):
     """Returns a lowercased string.
 
     The definition of lowercased comes from the IRC specification (RFC
-    1459).
+    1459). Use the :attr:`casemapping` of a connection to follow what the
+    server announced instead.
+    """
+    return casemapping.rfc1459.fold(s)
+
+def decode(data, encoding='utf-8'):
+    """Decodes bytes received from the server into text.
+
+    Most of the protocol is pure ASCII, which is decoded directly without
+    looking up `encoding` first. Anything else is decoded with `encoding`,
+    replacing the characters that can't be decoded.
     """
-    if (type(s) == unicode):
-        s = s.encode('utf-8')
-    return s.translate(_ircstring_translation)
+    try:
+        return _ascii_decode(data)[0]
+    except UnicodeDecodeError:
+        return data.decode(encoding, 'replace')
 
 def _ctcp_dequote(message):
     """[Internal] Dequote a message according to CTCP specifications.
@@ -139,31 +155,68 @@ def ip_quad_to_numstr(quad):
         s = s[:-1]
     return s
 
+#: The amount of nickmasks :func:`parse_hostmask` remembers
+HOSTMASK_CACHE_SIZE = 4096
+
+# The parsed masks used since the cache was last rotated, and the ones
+# used in the round before that
+_hostmasks = {}
+_old_hostmasks = {}
+
+def parse_hostmask(s):
+    """Split a nickmask into its nick, user and host parts at once.
+
+    Returns a ``(nick, user, host)`` tuple; the user and host are None
+    if the mask doesn't have them, like the name of a server.
+
+    The parts of recently seen masks are cached, as the same few thousand
+    users send most of the lines. The cache is an approximate LRU that
+    costs a single dictionary lookup on a hit: it has two generations of
+    half of :data:`HOSTMASK_CACHE_SIZE`, masks that are used again are
+    moved to the new generation, and the old one is dropped when the new
+    one is full.
+    """
+    global _hostmasks, _old_hostmasks
+    parts = _hostmasks.get(s)
+    if parts is not None:
+        return parts
+    parts = _old_hostmasks.get(s)
+    if parts is None:
+        nick, bang, userhost = s.partition("!")
+        user, at, host = (userhost if bang else s).partition("@")
+        parts = (nick, user if bang else None, host if at else None)
+    if len(_hostmasks) >= HOSTMASK_CACHE_SIZE // 2:
+        _old_hostmasks, _hostmasks = _hostmasks, {}
+    _hostmasks[s] = parts
+    return parts
+
 def nm_to_n(s):
     """Get the nick part of a nickmask.
 
     (The source of an :class:`connection.Event` is a nickmask.)
     """
-    return s.split("!")[0]
+    return parse_hostmask(s)[0]
 
 def nm_to_uh(s):
-    """Get the userhost part of a nickmask.
+    """Get the userhost part of a nickmask, or None if it has none.
 
     (The source of an :class:`connection.Event` is a nickmask.)
     """
-    return s.split("!")[1]
+    nick, user, host = parse_hostmask(s)
+    if user is None or host is None:
+        return user
+    return user + "@" + host
 
 def nm_to_h(s):
-    """Get the host part of a nickmask.
+    """Get the host part of a nickmask, or None if it has none.
 
     (The source of an :class:`connection.Event` is a nickmask.)
     """
-    return s.split("@")[1]
+    return parse_hostmask(s)[2]
 
 def nm_to_u(s):
-    """Get the user part of a nickmask.
+    """Get the user part of a nickmask, or None if it has none.
 
     (The source of an :class:`connection.Event` is a nickmask.)
     """
-    s = s.split("!")[1]
-    return s.split("@")[0]
+    return parse_hostmask(s)[1]